@@ -0,0 +1,330 @@
+# admin_metricas.py
+# Agregados del dashboard (/api/admin/resumen).
+#
+# Un "rollup" es el agregado de un conjunto de recibos (en el espejo, los de
+# un día UTC). Los rollups se combinan sumando, así que el resumen de un rango
+# es la combinación de los rollups de sus días y no hace falta recorrer cada
+# recibo en cada carga del dashboard.
+#
+# El estado de facturación se resuelve al armar el rollup (una consulta bulk
+# a la DB de facturas) y queda sólo como cantidades y montos; como cambia al
+# facturar, el espejo recalcula el día de la venta facturada (ver
+# receipts_mirror.marcar_facturada).
+#
+# Para armar un rollup se recorre la lista de recibos una sola vez, pasando
+# lo necesario a columnas compactas (array): códigos de grupo y montos. Los
+# agrupamientos salen después de esas columnas, con numpy.bincount si numpy
+# está instalado (opcional) o con un loop simple si no.
+from array import array
+from datetime import date, datetime, timedelta
+
+from json_db import obtener_facturas_bulk
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DIAS_SEMANA = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
+
+# Totales que se combinan sumando
+_TOTALES = (
+    "ventas", "monto_ventas", "reembolsos", "monto_reembolsos",
+    "facturadas", "monto_facturado", "no_facturadas", "monto_no_facturado",
+)
+# Series que se combinan clave a clave: {clave: [cantidad, monto]}
+_SERIES = ("por_hora", "por_dia_semana", "por_fecha", "pagos", "productos", "empleados")
+
+
+def rollup_vacio() -> dict:
+    rollup = {
+        "ventas": 0,
+        "monto_ventas": 0,
+        "reembolsos": 0,
+        "monto_reembolsos": 0,
+        "facturadas": 0,
+        "monto_facturado": 0,
+        "no_facturadas": 0,
+        "monto_no_facturado": 0,
+    }
+    for serie in _SERIES:
+        rollup[serie] = {}
+    return rollup
+
+
+def _sumar(serie: dict, clave: str, cantidad, monto) -> None:
+    acumulado = serie.get(clave)
+    if acumulado is None:
+        serie[clave] = [cantidad, monto]
+    else:
+        acumulado[0] += cantidad
+        acumulado[1] += monto
+
+
+def _momento(fecha: str, dias: dict):
+    """
+    (hora Argentina, día de semana UTC, "dd/mm" Argentina) de un created_at,
+    o None si no se puede parsear. Los datos de cada día se calculan una vez
+    (dias hace de caché); el formato de Loyverse se lee sin parsear la hora.
+    """
+    if fecha and len(fecha) == 24 and fecha[10] == "T" and fecha[-1] == "Z" and fecha[11:13].isdigit():
+        hora = int(fecha[11:13])
+        dia = dias.get(fecha[:10])
+        if dia is None:
+            try:
+                d = date.fromisoformat(fecha[:10])
+            except ValueError:
+                return None
+            dia = dias[fecha[:10]] = (d.weekday(), d.strftime("%d/%m"), (d - timedelta(days=1)).strftime("%d/%m"))
+        if hora < 24:
+            return (hora - 3) % 24, dia[0], dia[2] if hora < 3 else dia[1]
+
+    try:
+        dt = datetime.fromisoformat(fecha.replace("Z", "+00:00"))
+    except Exception:
+        return None
+    return (dt.hour - 3) % 24, dt.weekday(), (dt - timedelta(hours=3)).strftime("%d/%m")
+
+
+def _contar(codigos: array, n: int) -> list:
+    """Cantidad de filas por código (0..n-1)."""
+    if np is not None:
+        return np.bincount(np.frombuffer(codigos, dtype=np.intc), minlength=n).tolist()
+    cuentas = [0] * n
+    for c in codigos:
+        cuentas[c] += 1
+    return cuentas
+
+
+def _sumar_columna(codigos: array, valores: array, n: int) -> list:
+    """Suma de valores por código (0..n-1), en el orden de las filas."""
+    if np is not None:
+        return np.bincount(
+            np.frombuffer(codigos, dtype=np.intc),
+            weights=np.frombuffer(valores, dtype=np.float64),
+            minlength=n,
+        ).tolist()
+    sumas = [0.0] * n
+    for c, v in zip(codigos, valores):
+        sumas[c] += v
+    return sumas
+
+
+def _serie(claves: list, cantidades: list, montos: list) -> dict:
+    return {
+        clave: [cantidad, monto]
+        for clave, cantidad, monto in zip(claves, cantidades, montos)
+        if cantidad
+    }
+
+
+def rollup_de_receipts(receipts_raw: list) -> dict:
+    """Agregado de una lista de recibos crudos de Loyverse."""
+    rollup = rollup_vacio()
+
+    # Índices clave → código (en orden de aparición, para los empates)
+    idx_fechas = {}
+    idx_empleados = {}
+    idx_pagos = {}
+    idx_productos = {}
+    dias = {}
+
+    # Columnas: una fila por venta, por venta con fecha, por pago y por ítem
+    totales = array("d")
+    empleados = array("i")
+    con_fecha_totales = array("d")
+    horas = array("i")
+    dias_semana = array("i")
+    fechas = array("i")
+    pagos = array("i")
+    pagos_montos = array("d")
+    productos = array("i")
+    productos_cantidades = array("d")
+    productos_montos = array("d")
+    facturables = []  # (receipt_number, total) de cada venta
+
+    for r in receipts_raw:
+        tipo = r.get("receipt_type")
+        total = r.get("total_money") or 0
+
+        if tipo == "REFUND":
+            rollup["reembolsos"] += 1
+            rollup["monto_reembolsos"] += total
+            continue
+        if tipo != "SALE":
+            continue
+
+        rollup["monto_ventas"] += total
+        facturables.append((r.get("receipt_number"), total))
+        totales.append(total)
+        # Por id: el nombre del empleado se resuelve al armar el resumen
+        employee_id = r.get("employee_id") or ""
+        codigo = idx_empleados.get(employee_id)
+        if codigo is None:
+            codigo = idx_empleados[employee_id] = len(idx_empleados)
+        empleados.append(codigo)
+
+        momento = _momento(r.get("created_at"), dias)
+        if momento is not None:
+            con_fecha_totales.append(total)
+            horas.append(momento[0])
+            dias_semana.append(momento[1])
+            codigo = idx_fechas.get(momento[2])
+            if codigo is None:
+                codigo = idx_fechas[momento[2]] = len(idx_fechas)
+            fechas.append(codigo)
+
+        for p in r.get("payments", []):
+            nombre = p.get("name") or p.get("type") or "Otro"
+            codigo = idx_pagos.get(nombre)
+            if codigo is None:
+                codigo = idx_pagos[nombre] = len(idx_pagos)
+            pagos.append(codigo)
+            pagos_montos.append(p.get("money_amount") or 0)
+
+        for item in r.get("line_items", []):
+            nombre = item.get("item_name") or "Sin nombre"
+            codigo = idx_productos.get(nombre)
+            if codigo is None:
+                codigo = idx_productos[nombre] = len(idx_productos)
+            productos.append(codigo)
+            productos_cantidades.append(item.get("quantity") or 0)
+            productos_montos.append(item.get("total_money") or 0)
+
+    rollup["ventas"] = len(totales)
+
+    # Facturado vs no facturado (estado actual de la DB)
+    facturas = obtener_facturas_bulk([receipt_id for receipt_id, _ in facturables])
+    for receipt_id, total in facturables:
+        factura = facturas.get(receipt_id)
+        if factura:
+            rollup["monto_facturado"] += factura.get("total", 0)
+            rollup["facturadas"] += 1
+        else:
+            rollup["monto_no_facturado"] += total
+            rollup["no_facturadas"] += 1
+
+    rollup["por_hora"] = _serie(
+        [str(h) for h in range(24)],
+        _contar(horas, 24), _sumar_columna(horas, con_fecha_totales, 24),
+    )
+    rollup["por_dia_semana"] = _serie(
+        [str(d) for d in range(7)],
+        _contar(dias_semana, 7), _sumar_columna(dias_semana, con_fecha_totales, 7),
+    )
+    rollup["por_fecha"] = _serie(
+        list(idx_fechas),
+        _contar(fechas, len(idx_fechas)), _sumar_columna(fechas, con_fecha_totales, len(idx_fechas)),
+    )
+    rollup["pagos"] = _serie(
+        list(idx_pagos),
+        _contar(pagos, len(idx_pagos)), _sumar_columna(pagos, pagos_montos, len(idx_pagos)),
+    )
+    rollup["empleados"] = _serie(
+        list(idx_empleados),
+        _contar(empleados, len(idx_empleados)), _sumar_columna(empleados, totales, len(idx_empleados)),
+    )
+    # Productos: la "cantidad" es la suma de unidades, no de filas
+    rollup["productos"] = {
+        clave: [cantidad, monto]
+        for clave, cantidad, monto in zip(
+            idx_productos,
+            _sumar_columna(productos, productos_cantidades, len(idx_productos)),
+            _sumar_columna(productos, productos_montos, len(idx_productos)),
+        )
+    }
+
+    return rollup
+
+
+def combinar_rollups(rollups: list) -> dict:
+    """
+    Suma rollups. Conviene pasarlos del más nuevo al más viejo (el orden de
+    los recibos): así los empates en los rankings se resuelven igual que
+    agregando los recibos directamente.
+    """
+    total = rollup_vacio()
+    for rollup in rollups:
+        for campo in _TOTALES:
+            total[campo] += rollup[campo]
+        for serie in _SERIES:
+            destino = total[serie]
+            for clave, (cantidad, monto) in rollup[serie].items():
+                _sumar(destino, clave, cantidad, monto)
+    return total
+
+
+def _valor(serie: dict, clave: str):
+    return serie.get(clave, (0, 0))
+
+
+def armar_resumen(agg: dict, employees_map: dict) -> dict:
+    """Respuesta de /api/admin/resumen a partir de un rollup combinado."""
+    # ── MÉTRICAS GENERALES ──
+    total_ventas = agg["ventas"]
+    monto_total_real = agg["monto_ventas"] - agg["monto_reembolsos"]
+    ticket_promedio = round(monto_total_real / total_ventas, 2) if total_ventas else 0
+
+    # ── VENTAS POR HORA ──
+    horas_data = []
+    for h in range(24):
+        cantidad, monto = _valor(agg["por_hora"], str(h))
+        horas_data.append({"hora": f"{h:02d}:00", "cantidad": cantidad, "monto": round(monto, 2)})
+
+    # ── VENTAS POR DÍA DE SEMANA ──
+    dias_data = []
+    for d in range(7):
+        cantidad, monto = _valor(agg["por_dia_semana"], str(d))
+        dias_data.append({"dia": DIAS_SEMANA[d], "cantidad": cantidad, "monto": round(monto, 2)})
+
+    # ── MÉTODOS DE PAGO ──
+    pagos_data = [
+        {"metodo": k, "cantidad": c, "monto": round(m, 2)}
+        for k, (c, m) in sorted(agg["pagos"].items(), key=lambda x: -x[1][1])
+    ]
+
+    # ── PRODUCTOS MÁS VENDIDOS ──
+    productos = [
+        {"nombre": k, "cantidad": c, "monto": round(m, 2)}
+        for k, (c, m) in agg["productos"].items()
+    ]
+    top_productos_cantidad = sorted(productos, key=lambda x: -x["cantidad"])[:15]
+    top_productos_monto = sorted(productos, key=lambda x: -x["monto"])[:15]
+
+    # ── VENTAS POR EMPLEADO ──
+    empleados_agg = {}
+    for employee_id, (c, m) in agg["empleados"].items():
+        nombre = employees_map.get(employee_id or None, "Sin asignar") or "Sin asignar"
+        _sumar(empleados_agg, nombre, c, m)
+
+    empleados_data = [
+        {"empleado": k, "cantidad": c, "monto": round(m, 2)}
+        for k, (c, m) in sorted(empleados_agg.items(), key=lambda x: -x[1][1])
+    ]
+
+    # ── VENTAS POR DÍA (serie temporal) ──
+    serie_diaria = [
+        {"fecha": k, "cantidad": c, "monto": round(m, 2)}
+        for k, (c, m) in sorted(agg["por_fecha"].items(), key=lambda x: x[0])
+    ]
+
+    return {
+        "resumen": {
+            "total_ventas": total_ventas,
+            "monto_total_real": round(monto_total_real, 2),
+            "monto_facturado": round(agg["monto_facturado"], 2),
+            "monto_no_facturado": round(agg["monto_no_facturado"], 2),
+            "monto_total_refunds": round(agg["monto_reembolsos"], 2),
+            "ticket_promedio": ticket_promedio,
+            "cant_facturadas": agg["facturadas"],
+            "cant_no_facturadas": agg["no_facturadas"],
+            "total_reembolsos": agg["reembolsos"],
+        },
+        "por_hora": horas_data,
+        "por_dia_semana": dias_data,
+        "serie_diaria": serie_diaria,
+        "metodos_pago": pagos_data,
+        "top_productos_cantidad": top_productos_cantidad,
+        "top_productos_monto": top_productos_monto,
+        "por_empleado": empleados_data,
+    }
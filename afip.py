@@ -5,34 +5,57 @@ import base64
 import requests
 import ssl
 import json
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.poolmanager import PoolManager
 from xml.etree import ElementTree as ET
 
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.serialization import pkcs7
+except ImportError:
+    pkcs7 = None
+
 # ======================================================
 # CACHE WSAA (token/sign temporales)
 # ======================================================
 WSAA_CACHE = "/tmp/wsaa_token.json"
 
 
-def guardar_wsaa(token, sign):
+def guardar_wsaa(token, sign, expiracion: datetime | None = None):
     try:
         with open(WSAA_CACHE, "w") as f:
-            json.dump({"token": token, "sign": sign}, f)
+            json.dump({
+                "token": token,
+                "sign": sign,
+                "expiracion": expiracion.isoformat() if expiracion else None,
+            }, f)
     except:
         pass
 
 
 def cargar_wsaa():
     if not os.path.exists(WSAA_CACHE):
-        return None, None
+        return None, None, None
     try:
         with open(WSAA_CACHE, "r") as f:
             data = json.load(f)
-            return data.get("token"), data.get("sign")
+            return data.get("token"), data.get("sign"), _parse_expiracion(data.get("expiracion"))
     except:
-        return None, None
+        return None, None, None
+
+
+def _parse_expiracion(texto: str | None) -> datetime | None:
+    """expirationTime del WSAA, ej: 2024-05-10T08:15:02.345-03:00"""
+    if not texto:
+        return None
+    try:
+        return datetime.fromisoformat(texto.strip())
+    except ValueError:
+        return None
 
 
 # ======================================================
@@ -50,6 +73,75 @@ class TLSAdapter(HTTPAdapter):
         )
 
 
+# ======================================================
+# CLIENTE WSFE (pool de conexiones keep-alive compartido)
+# ======================================================
+WSFE_URL_DEFAULT = "https://servicios1.afip.gov.ar/wsfev1/service.asmx"
+
+
+class WSFEClient:
+    """
+    Sesión HTTP única contra WSFE montada sobre TLSAdapter.
+    Reutiliza conexiones ya negociadas (TCP + TLS SECLEVEL=1) entre llamadas.
+    requests.Session es seguro para posts concurrentes una vez montado el
+    adapter; el lock sólo protege la creación y el cierre de la sesión.
+    """
+
+    def __init__(self, pool_size: int = 4, timeout: int = 20):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _get_session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                session.mount("https://", TLSAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    pool_block=True,
+                ))
+                self._session = session
+            return self._session
+
+    def post(self, soap_action: str, soap_body: str) -> requests.Response:
+        wsfe_url = os.environ.get("AFIP_WSFE_URL", WSFE_URL_DEFAULT)
+        headers = {
+            "Content-Type": "text/xml; charset=utf-8",
+            "SOAPAction": f"http://ar.gov.afip.dif.FEV1/{soap_action}",
+        }
+        session = self._get_session()
+        return session.post(wsfe_url, data=soap_body.encode("utf-8"), headers=headers, timeout=self.timeout)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+_WSFE_CLIENT: WSFEClient | None = None
+_WSFE_CLIENT_LOCK = threading.Lock()
+
+
+def get_wsfe_client() -> WSFEClient:
+    global _WSFE_CLIENT
+    with _WSFE_CLIENT_LOCK:
+        if _WSFE_CLIENT is None:
+            pool_size = int(os.environ.get("AFIP_WSFE_POOL_SIZE", "4"))
+            _WSFE_CLIENT = WSFEClient(pool_size=pool_size)
+        return _WSFE_CLIENT
+
+
+def cerrar_wsfe_client() -> None:
+    global _WSFE_CLIENT
+    with _WSFE_CLIENT_LOCK:
+        if _WSFE_CLIENT is not None:
+            _WSFE_CLIENT.close()
+            _WSFE_CLIENT = None
+
+
 # ======================================================
 # HELPERS DOC
 # ======================================================
@@ -79,10 +171,35 @@ def doc_tipo_y_nro(cliente: dict | None):
     return 99, 0
 
 
+def _tag_local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _xml_items(items: list) -> str:
+    xml_items = ""
+    for it in items:
+        descripcion = it["descripcion"]
+        cantidad = float(it["cantidad"])
+        precio = float(it["precio"])
+        importe_item = round(cantidad * precio, 2)
+
+        xml_items += f"""
+        <ar:Item>
+            <ar:Pro_cod>{descripcion}</ar:Pro_cod>
+            <ar:Pro_ds>{descripcion}</ar:Pro_ds>
+            <ar:Pro_qty>{cantidad}</ar:Pro_qty>
+            <ar:Pro_umed>7</ar:Pro_umed>
+            <ar:Pro_precio>{precio}</ar:Pro_precio>
+            <ar:Pro_total_item>{importe_item}</ar:Pro_total_item>
+        </ar:Item>
+        """
+    return xml_items
+
+
 # ======================================================
 # 1) GENERAR CMS DER → BASE64
 # ======================================================
-def generar_cms_der_b64(crt_path: str, key_path: str) -> str:
+def _login_ticket_request_xml() -> str:
     TZ = timezone(timedelta(hours=-3))
     now = datetime.now(TZ)
 
@@ -92,7 +209,7 @@ def generar_cms_der_b64(crt_path: str, key_path: str) -> str:
     generation_time = gen[:-2] + ":" + gen[-2:]
     expiration_time = exp[:-2] + ":" + exp[-2:]
 
-    xml_data = f"""<?xml version="1.0" encoding="UTF-8"?>
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
 <loginTicketRequest version="1.0">
   <header>
     <uniqueId>1</uniqueId>
@@ -103,6 +220,48 @@ def generar_cms_der_b64(crt_path: str, key_path: str) -> str:
 </loginTicketRequest>
 """
 
+
+class CMSSigner:
+    """
+    Firma CMS en proceso (equivalente a openssl smime -sign -binary -nodetach
+    -outform DER). Certificado y clave se leen una sola vez y quedan en memoria.
+    """
+
+    def __init__(self, crt_path: str, key_path: str):
+        if pkcs7 is None:
+            raise Exception("Falta el paquete cryptography para firmar CMS en proceso")
+
+        with open(crt_path, "rb") as f:
+            self.cert = x509.load_pem_x509_certificate(f.read())
+        with open(key_path, "rb") as f:
+            self.key = serialization.load_pem_private_key(f.read(), password=None)
+
+    def firmar(self, data: bytes) -> bytes:
+        return (
+            pkcs7.PKCS7SignatureBuilder()
+            .set_data(data)
+            .add_signer(self.cert, self.key, hashes.SHA256())
+            .sign(serialization.Encoding.DER, [pkcs7.PKCS7Options.Binary])
+        )
+
+
+_CMS_SIGNERS: dict = {}
+_CMS_SIGNERS_LOCK = threading.Lock()
+
+
+def get_cms_signer(crt_path: str, key_path: str) -> CMSSigner:
+    # La clave incluye el mtime para tomar un certificado rotado sin reiniciar
+    clave = (crt_path, key_path, os.path.getmtime(crt_path), os.path.getmtime(key_path))
+    with _CMS_SIGNERS_LOCK:
+        signer = _CMS_SIGNERS.get(clave)
+        if signer is None:
+            signer = CMSSigner(crt_path, key_path)
+            _CMS_SIGNERS.clear()
+            _CMS_SIGNERS[clave] = signer
+        return signer
+
+
+def firmar_cms_openssl(xml_data: str, crt_path: str, key_path: str) -> bytes:
     with tempfile.TemporaryDirectory() as tmp:
         req_xml = os.path.join(tmp, "req.xml")
         cms_der = os.path.join(tmp, "req.cms")
@@ -126,7 +285,21 @@ def generar_cms_der_b64(crt_path: str, key_path: str) -> str:
             raise Exception("OpenSSL error: " + res.stderr.decode(errors="ignore"))
 
         with open(cms_der, "rb") as f:
-            cms_bytes = f.read()
+            return f.read()
+
+
+def generar_cms_der_b64(crt_path: str, key_path: str) -> str:
+    xml_data = _login_ticket_request_xml()
+
+    cms_bytes = None
+    if os.environ.get("AFIP_CMS_OPENSSL") != "1":
+        try:
+            cms_bytes = get_cms_signer(crt_path, key_path).firmar(xml_data.encode("utf-8"))
+        except Exception as e:
+            print(f"⚠️ WSAA → firma CMS en proceso falló, se usa openssl: {e}")
+
+    if cms_bytes is None:
+        cms_bytes = firmar_cms_openssl(xml_data, crt_path, key_path)
 
     return base64.b64encode(cms_bytes).decode()
 
@@ -178,28 +351,26 @@ def login_cms_directo(cms_b64: str):
 
     token = None
     sign = None
+    expiracion = None
 
     for elem in inner.iter():
         if elem.tag.endswith("token"):
             token = elem.text
         if elem.tag.endswith("sign"):
             sign = elem.text
+        if elem.tag.endswith("expirationTime"):
+            expiracion = _parse_expiracion(elem.text)
 
     if not token or not sign:
         raise Exception("No se pudo extraer token/sign del WSAA")
 
-    return token, sign
+    return token, sign, expiracion
 
 
 # ======================================================
 # 3) WSFE – FECompUltimoAutorizado
 # ======================================================
 def wsfe_ultimo_comprobante(token: str, sign: str, cuit: int, pto_vta: int, tipo_cbte: int):
-    wsfe_url = os.environ.get(
-        "AFIP_WSFE_URL",
-        "https://servicios1.afip.gov.ar/wsfev1/service.asmx"
-    )
-
     soap_body = f"""<?xml version="1.0" encoding="UTF-8"?>
 <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ar="http://ar.gov.afip.dif.FEV1/">
   <soapenv:Header/>
@@ -217,14 +388,7 @@ def wsfe_ultimo_comprobante(token: str, sign: str, cuit: int, pto_vta: int, tipo
 </soapenv:Envelope>
 """
 
-    headers = {
-        "Content-Type": "text/xml; charset=utf-8",
-        "SOAPAction": "http://ar.gov.afip.dif.FEV1/FECompUltimoAutorizado",
-    }
-
-    session = requests.Session()
-    session.mount("https://", TLSAdapter())
-    r = session.post(wsfe_url, data=soap_body.encode("utf-8"), headers=headers, timeout=20)
+    r = get_wsfe_client().post("FECompUltimoAutorizado", soap_body)
 
     if r.status_code != 200:
         raise Exception(f"WSFE devolvió {r.status_code}: {r.text}")
@@ -249,23 +413,238 @@ def wsfe_ultimo_comprobante(token: str, sign: str, cuit: int, pto_vta: int, tipo
 # ======================================================
 # AUTH (token/sign) con cache y refresh automático
 # ======================================================
-def obtener_auth_wsaa():
-    key_path = "/etc/secrets/afip_new.key"
-    crt_path = "/etc/secrets/afip_new.crt"
+AFIP_KEY_PATH = "/etc/secrets/afip_new.key"
+AFIP_CRT_PATH = "/etc/secrets/afip_new.crt"
+
+# Ticket de acceso en memoria: {"token", "sign", "expiracion"}. Se lee sin
+# lock (se reemplaza entero); _WSAA_RENOVACION_LOCK sólo serializa las
+# renovaciones, que firman y esperan al WSAA.
+_WSAA_TICKET: dict | None = None
+_WSAA_CARGA_LOCK = threading.Lock()
+_WSAA_RENOVACION_LOCK = threading.RLock()
+
+_WSAA_STOP = threading.Event()
+_WSAA_THREAD: threading.Thread | None = None
+
+
+# WSAA no entrega un TA nuevo mientras el actual siga vigente
+# (coe.alreadyAuthenticated), así que la renovación se agenda al vencimiento.
+# Un reintento fallido se repite cada AFIP_WSAA_REINTENTO_SEG; con un TA de
+# cache viejo (sin expiración conocida) se espera AFIP_WSAA_REINTENTO_LARGO_SEG.
+AFIP_WSAA_REINTENTO_SEG = int(os.environ.get("AFIP_WSAA_REINTENTO_SEG", "30"))
+AFIP_WSAA_REINTENTO_LARGO_SEG = int(os.environ.get("AFIP_WSAA_REINTENTO_LARGO_SEG", "21600"))
+
+
+def _ticket_vigente(ticket: dict | None) -> bool:
+    if not ticket or not ticket.get("token") or not ticket.get("sign"):
+        return False
+    expiracion = ticket.get("expiracion")
+    if expiracion is None:
+        return False
+    return datetime.now(timezone.utc) < expiracion
+
+
+def _ticket_sin_expiracion(ticket: dict | None) -> bool:
+    return bool(ticket and ticket.get("token") and ticket.get("expiracion") is None)
+
+
+def _ticket_actual() -> dict | None:
+    global _WSAA_TICKET
+    ticket = _WSAA_TICKET
+    if ticket is not None:
+        return ticket
+    # Primera lectura: desde el cache en /tmp (sin pisar una renovación)
+    with _WSAA_CARGA_LOCK:
+        if _WSAA_TICKET is None:
+            token, sign, expiracion = cargar_wsaa()
+            if token and sign:
+                _WSAA_TICKET = {"token": token, "sign": sign, "expiracion": expiracion}
+        return _WSAA_TICKET
 
-    if not os.path.exists(key_path):
+
+def renovar_wsaa():
+    """Pide un TA nuevo al WSAA y lo deja en memoria y en /tmp."""
+    global _WSAA_TICKET
+
+    if not os.path.exists(AFIP_KEY_PATH):
         raise Exception("No existe clave privada AFIP")
-    if not os.path.exists(crt_path):
+    if not os.path.exists(AFIP_CRT_PATH):
         raise Exception("No existe certificado AFIP")
 
-    token, sign = cargar_wsaa()
-    if token and sign:
+    with _WSAA_RENOVACION_LOCK:
+        cms_b64 = generar_cms_der_b64(AFIP_CRT_PATH, AFIP_KEY_PATH)
+        token, sign, expiracion = login_cms_directo(cms_b64)
+        with _WSAA_CARGA_LOCK:
+            _WSAA_TICKET = {"token": token, "sign": sign, "expiracion": expiracion}
+        guardar_wsaa(token, sign, expiracion)
+        print(f"DEBUG WSAA → TA renovado, vence {expiracion}")
         return token, sign
 
-    cms_b64 = generar_cms_der_b64(crt_path, key_path)
-    token, sign = login_cms_directo(cms_b64)
-    guardar_wsaa(token, sign)
-    return token, sign
+
+def obtener_auth_wsaa():
+    ticket = _ticket_actual()
+    if _ticket_vigente(ticket):
+        return ticket["token"], ticket["sign"]
+
+    # Cache de formato viejo (sin expiracion): se sigue usando hasta que AFIP
+    # lo rechace (errores 600-602); ahí FECAESolicitar lo renueva y reintenta.
+    # El loop de fondo no lo puede renovar antes: WSAA lo rechazaría.
+    if _ticket_sin_expiracion(ticket):
+        return ticket["token"], ticket["sign"]
+
+    with _WSAA_RENOVACION_LOCK:
+        ticket = _ticket_actual()
+        if _ticket_vigente(ticket):
+            return ticket["token"], ticket["sign"]
+        return renovar_wsaa()
+
+
+def _loop_renovacion_wsaa():
+    while not _WSAA_STOP.is_set():
+        espera = AFIP_WSAA_REINTENTO_SEG
+        try:
+            if not _ticket_vigente(_ticket_actual()):
+                with _WSAA_RENOVACION_LOCK:
+                    if not _ticket_vigente(_ticket_actual()):
+                        renovar_wsaa()
+        except Exception as e:
+            print(f"⚠️ WSAA → renovación en segundo plano falló: {e}")
+            if _ticket_sin_expiracion(_ticket_actual()):
+                # No se sabe cuándo vence: hasta entonces WSAA rechaza el
+                # pedido, y si WSFE lo rechaza antes se renueva en el momento
+                espera = AFIP_WSAA_REINTENTO_LARGO_SEG
+
+        ticket = _ticket_actual()
+        if _ticket_vigente(ticket):
+            # Próximo intento apenas vence el TA vigente
+            restante = ticket["expiracion"] - datetime.now(timezone.utc)
+            espera = max(AFIP_WSAA_REINTENTO_SEG, restante.total_seconds() + 1)
+        _WSAA_STOP.wait(espera)
+
+
+def iniciar_renovacion_wsaa() -> None:
+    global _WSAA_THREAD
+    if not os.path.exists(AFIP_KEY_PATH) or not os.path.exists(AFIP_CRT_PATH):
+        print("DEBUG WSAA → sin certificado AFIP, no se inicia la renovación automática")
+        return
+    if _WSAA_THREAD is not None and _WSAA_THREAD.is_alive():
+        return
+    _WSAA_STOP.clear()
+    _WSAA_THREAD = threading.Thread(target=_loop_renovacion_wsaa, name="wsaa-renovacion", daemon=True)
+    _WSAA_THREAD.start()
+
+
+def detener_renovacion_wsaa() -> None:
+    _WSAA_STOP.set()
+
+
+# ======================================================
+# NUMERACIÓN LOCAL DE COMPROBANTES
+# ======================================================
+AFIP_ERR_FUERA_DE_SECUENCIA = "10016"
+# Token/Sign rechazados por WSFE (vencido, inválido, CUIT no autorizado)
+AFIP_ERR_TOKEN = {"600", "601", "602"}
+
+
+def _consultar_ultimo(cuit: int, pto_vta: int, tipo_cbte: int) -> int:
+    token, sign = obtener_auth_wsaa()
+    try:
+        return wsfe_ultimo_comprobante(token, sign, cuit, pto_vta, tipo_cbte)
+    except:
+        token, sign = renovar_wsaa()
+        return wsfe_ultimo_comprobante(token, sign, cuit, pto_vta, tipo_cbte)
+
+
+class ReservaNumeracion:
+    def __init__(self, numerador, clave, ultimo: int):
+        self._numerador = numerador
+        self._clave = clave
+        self.ultimo = ultimo
+        self.incierta = False
+
+    def marcar_incierta(self) -> None:
+        """Un pedido quedó sin respuesta legible: resincronizar al liberar."""
+        self.incierta = True
+
+    def confirmar(self, cbte_nro: int) -> None:
+        self.ultimo = max(self.ultimo, cbte_nro)
+        self._numerador._ultimos[self._clave] = self.ultimo
+
+    def resincronizar(self) -> None:
+        self.ultimo = _consultar_ultimo(*self._clave)
+        self._numerador._ultimos[self._clave] = self.ultimo
+        print(f"DEBUG WSFE → numeración resincronizada {self._clave}: último {self.ultimo}")
+
+
+class NumeradorComprobantes:
+    """
+    Último número autorizado por (cuit, pto_vta, cbte_tipo), sembrado desde
+    FECompUltimoAutorizado la primera vez y avanzado localmente después.
+
+    El lock de cada clave se mantiene durante el FECAESolicitar: AFIP exige
+    números consecutivos, así que dos pedidos del mismo tipo se serializan
+    en lugar de pedir el mismo número (o llegar desordenados).
+    """
+
+    def __init__(self):
+        self._ultimos = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _lock_para(self, clave) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(clave, threading.Lock())
+
+    @contextmanager
+    def reservar(self, cuit: int, pto_vta: int, tipo_cbte: int):
+        clave = (cuit, pto_vta, tipo_cbte)
+        with self._lock_para(clave):
+            ultimo = self._ultimos.get(clave)
+            if ultimo is None:
+                ultimo = _consultar_ultimo(cuit, pto_vta, tipo_cbte)
+                self._ultimos[clave] = ultimo
+            reserva = ReservaNumeracion(self, clave, ultimo)
+            try:
+                yield reserva
+            except BaseException:
+                # Resultado incierto (timeout, respuesta ilegible): resincronizar
+                # con AFIP en el próximo pedido
+                self._ultimos.pop(clave, None)
+                raise
+            if reserva.incierta:
+                self._ultimos.pop(clave, None)
+
+
+NUMERADOR = NumeradorComprobantes()
+
+
+def _solicitar_cae(soap_body: str):
+    """POST de FECAESolicitar con CantReg=1. Devuelve (cae, vto, errores, codigos, texto)."""
+    r = get_wsfe_client().post("FECAESolicitar", soap_body)
+
+    if r.status_code != 200:
+        raise Exception(f"WSFE devolvió {r.status_code}: {r.text}")
+
+    tree = ET.fromstring(r.text)
+
+    cae = None
+    vto = None
+    errores = []
+    codigos = set()
+
+    for elem in tree.iter():
+        nombre = _tag_local(elem.tag)
+        if nombre == "CAE":
+            cae = elem.text
+        if nombre == "CAEFchVto":
+            vto = elem.text
+        if nombre in ("ErrMsg", "Msg"):
+            errores.append(elem.text)
+        if nombre == "Code" and elem.text:
+            codigos.add(elem.text.strip())
+
+    errores = [str(e) for e in errores if e]
+    return cae, vto, errores, codigos, r.text
 
 
 # ======================================================
@@ -282,45 +661,19 @@ def wsfe_facturar(tipo_cbte: int, cliente: dict | None, items: list, total: floa
 
     doc_tipo, doc_nro = doc_tipo_y_nro(cliente)
 
-    # Auth
-    token, sign = obtener_auth_wsaa()
-
-    # Último comprobante (refresh si token venció)
-    try:
-        ultimo = wsfe_ultimo_comprobante(token, sign, cuit_int, pto_vta, tipo_cbte)
-    except:
-        cms_b64 = generar_cms_der_b64("/etc/secrets/afip_new.crt", "/etc/secrets/afip_new.key")
-        token, sign = login_cms_directo(cms_b64)
-        guardar_wsaa(token, sign)
-        ultimo = wsfe_ultimo_comprobante(token, sign, cuit_int, pto_vta, tipo_cbte)
-
-    cbte_nro = ultimo + 1
-
     # Items XML
-    xml_items = ""
-    for it in items:
-        descripcion = it["descripcion"]
-        cantidad = float(it["cantidad"])
-        precio = float(it["precio"])
-        importe_item = round(cantidad * precio, 2)
-
-        xml_items += f"""
-        <ar:Item>
-            <ar:Pro_cod>{descripcion}</ar:Pro_cod>
-            <ar:Pro_ds>{descripcion}</ar:Pro_ds>
-            <ar:Pro_qty>{cantidad}</ar:Pro_qty>
-            <ar:Pro_umed>7</ar:Pro_umed>
-            <ar:Pro_precio>{precio}</ar:Pro_precio>
-            <ar:Pro_total_item>{importe_item}</ar:Pro_total_item>
-        </ar:Item>
-        """
-
-    wsfe_url = os.environ.get(
-        "AFIP_WSFE_URL",
-        "https://servicios1.afip.gov.ar/wsfev1/service.asmx"
-    )
-
-    soap_body = f"""<?xml version="1.0" encoding="UTF-8"?>
+    xml_items = _xml_items(items)
+
+    # Número local: FECompUltimoAutorizado sólo al sembrar o ante error 10016
+    with NUMERADOR.reservar(cuit_int, pto_vta, tipo_cbte) as reserva:
+        renovado = False
+        resincronizado = False
+        while True:
+            # Auth
+            token, sign = obtener_auth_wsaa()
+            cbte_nro = reserva.ultimo + 1
+
+            soap_body = f"""<?xml version="1.0" encoding="UTF-8"?>
 <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
     xmlns:ar="http://ar.gov.afip.dif.FEV1/">
   <soapenv:Header/>
@@ -364,41 +717,26 @@ def wsfe_facturar(tipo_cbte: int, cliente: dict | None, items: list, total: floa
 </soapenv:Envelope>
 """
 
-    headers = {
-        "Content-Type": "text/xml; charset=utf-8",
-        "SOAPAction": "http://ar.gov.afip.dif.FEV1/FECAESolicitar",
-    }
-
-    session = requests.Session()
-    session.mount("https://", TLSAdapter())
-    r = session.post(wsfe_url, data=soap_body.encode("utf-8"), headers=headers, timeout=20)
-
-    if r.status_code != 200:
-        raise Exception(f"WSFE devolvió {r.status_code}: {r.text}")
-
-    tree = ET.fromstring(r.text)
-
-    cae = None
-    vto = None
-    errores = []
-    obs = []
+            cae, vto, errores, codigos, respuesta = _solicitar_cae(soap_body)
 
-    for elem in tree.iter():
-        if elem.tag.endswith("CAE"):
-            cae = elem.text
-        if elem.tag.endswith("CAEFchVto"):
-            vto = elem.text
-        if elem.tag.endswith("ErrMsg"):
-            errores.append(elem.text)
+            if not cae and codigos & AFIP_ERR_TOKEN and not renovado:
+                renovar_wsaa()
+                renovado = True
+                continue
+            if not cae and AFIP_ERR_FUERA_DE_SECUENCIA in codigos and not resincronizado:
+                reserva.resincronizar()
+                resincronizado = True
+                continue
+            break
 
-    errores = [str(e) for e in errores if e]
-    obs = [str(o) for o in obs if o]
+        if cae:
+            reserva.confirmar(cbte_nro)
 
     if not cae:
         msg = "La AFIP rechazó la factura.\n"
         if errores:
             msg += "Errores: " + " | ".join(errores) + "\n"
-        msg += "\nRespuesta completa AFIP:\n" + r.text[:2000]
+        msg += "\nRespuesta completa AFIP:\n" + respuesta[:2000]
         raise Exception(msg)
 
     return {
@@ -409,6 +747,231 @@ def wsfe_facturar(tipo_cbte: int, cliente: dict | None, items: list, total: floa
     }
 
 
+# ======================================================
+# 4b) WSFE – FECAESolicitar en lote (CantReg > 1)
+# ======================================================
+def _parsear_fecae_lote(xml_text: str):
+    """
+    Devuelve ({cbte_nro: {"resultado", "cae", "vencimiento", "observaciones", "codigos"}},
+    errores_generales, codigos)
+    """
+    tree = ET.fromstring(xml_text)
+
+    detalles = {}
+    errores = []
+    codigos = set()
+
+    for elem in tree.iter():
+        nombre = _tag_local(elem.tag)
+
+        if nombre == "FECAEDetResponse":
+            det = {"resultado": None, "cae": None, "vencimiento": None, "observaciones": [], "codigos": set()}
+            cbte_desde = None
+            for campo in elem.iter():
+                campo_nombre = _tag_local(campo.tag)
+                if campo_nombre == "CbteDesde":
+                    cbte_desde = int(campo.text)
+                elif campo_nombre == "Resultado":
+                    det["resultado"] = campo.text
+                elif campo_nombre == "CAE":
+                    det["cae"] = campo.text or None
+                elif campo_nombre == "CAEFchVto":
+                    det["vencimiento"] = campo.text or None
+                elif campo_nombre == "Msg" and campo.text:
+                    det["observaciones"].append(campo.text)
+                elif campo_nombre == "Code" and campo.text:
+                    det["codigos"].add(campo.text.strip())
+            if cbte_desde is not None:
+                detalles[cbte_desde] = det
+
+        elif nombre == "Err":
+            code = None
+            msg = None
+            for campo in elem:
+                if _tag_local(campo.tag) == "Code":
+                    code = campo.text
+                elif _tag_local(campo.tag) == "Msg":
+                    msg = campo.text
+            errores.append(f"{code}: {msg}" if code else str(msg))
+
+        elif nombre == "Code" and elem.text:
+            codigos.add(elem.text.strip())
+
+    return detalles, errores, codigos
+
+
+def _solicitar_cae_bloque(token: str, sign: str, cuit_int: int, pto_vta: int, tipo_cbte: int,
+                          bloque: list, desde: int, fecha_cbte: str):
+    """FECAESolicitar con CantReg=len(bloque), numerados desde `desde`."""
+    xml_detalles = ""
+    for offset, fac in enumerate(bloque):
+        doc_tipo, doc_nro = doc_tipo_y_nro(fac.get("cliente"))
+        cbte_nro = desde + offset
+        total = fac["total"]
+        xml_detalles += f"""
+          <ar:FECAEDetRequest>
+            <ar:Concepto>1</ar:Concepto>
+            <ar:DocTipo>{doc_tipo}</ar:DocTipo>
+            <ar:DocNro>{doc_nro}</ar:DocNro>
+            <ar:CbteDesde>{cbte_nro}</ar:CbteDesde>
+            <ar:CbteHasta>{cbte_nro}</ar:CbteHasta>
+            <ar:CbteFch>{fecha_cbte}</ar:CbteFch>
+            <ar:ImpTotal>{total}</ar:ImpTotal>
+            <ar:ImpTotConc>0</ar:ImpTotConc>
+            <ar:ImpNeto>{total}</ar:ImpNeto>
+            <ar:ImpOpEx>0</ar:ImpOpEx>
+            <ar:ImpIVA>0</ar:ImpIVA>
+            <ar:ImpTrib>0</ar:ImpTrib>
+            <ar:MonId>PES</ar:MonId>
+            <ar:MonCotiz>1</ar:MonCotiz>
+            <ar:Items>
+              {_xml_items(fac["items"])}
+            </ar:Items>
+          </ar:FECAEDetRequest>"""
+
+    soap_body = f"""<?xml version="1.0" encoding="UTF-8"?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+    xmlns:ar="http://ar.gov.afip.dif.FEV1/">
+  <soapenv:Header/>
+  <soapenv:Body>
+    <ar:FECAESolicitar>
+      <ar:Auth>
+        <ar:Token>{token}</ar:Token>
+        <ar:Sign>{sign}</ar:Sign>
+        <ar:Cuit>{cuit_int}</ar:Cuit>
+      </ar:Auth>
+      <ar:FeCAEReq>
+        <ar:FeCabReq>
+          <ar:CantReg>{len(bloque)}</ar:CantReg>
+          <ar:PtoVta>{pto_vta}</ar:PtoVta>
+          <ar:CbteTipo>{tipo_cbte}</ar:CbteTipo>
+        </ar:FeCabReq>
+        <ar:FeDetReq>{xml_detalles}
+        </ar:FeDetReq>
+      </ar:FeCAEReq>
+    </ar:FECAESolicitar>
+  </soapenv:Body>
+</soapenv:Envelope>
+"""
+
+    r = get_wsfe_client().post("FECAESolicitar", soap_body)
+    if r.status_code != 200:
+        raise Exception(f"WSFE devolvió {r.status_code}: {r.text}")
+
+    return _parsear_fecae_lote(r.text)
+
+
+def wsfe_facturar_lote(tipo_cbte: int, facturas: list) -> list:
+    """
+    Autoriza N comprobantes con la menor cantidad de FECAESolicitar posible.
+
+    facturas: lista de {"cliente", "items", "total"} (mismo formato que wsfe_facturar).
+    Devuelve una lista alineada con la entrada; cada elemento es
+    {"cae", "vencimiento", "cbte_nro", "pto_vta"} o {"error": "..."}.
+    Si falla un bloque se devuelven igual los CAE de los bloques anteriores.
+    Una factura rechazada por datos solo se marca con su error; las que venían
+    detrás se vuelven a pedir con la numeración corrida.
+    """
+    if not facturas:
+        return []
+
+    cuit = os.environ.get("AFIP_CUIT")
+    if not cuit:
+        raise Exception("Falta AFIP_CUIT")
+    cuit_int = int(cuit)
+
+    pto_vta = int(os.environ.get("AFIP_PTO_VTA", "1"))
+    max_reg = int(os.environ.get("AFIP_MAX_REG_X_REQ", "250"))
+
+    # Un solo bloque de numeración para todo el lote
+    with NUMERADOR.reservar(cuit_int, pto_vta, tipo_cbte) as reserva:
+        # Auth (se renueva una vez si WSFE rechaza el token)
+        token, sign = obtener_auth_wsaa()
+        renovado = False
+
+        resultados = [None] * len(facturas)
+        fecha_cbte = datetime.now().strftime('%Y%m%d')
+
+        # Índices todavía sin resultado. AFIP autoriza en orden: si rechaza una
+        # factura por datos, las que venían detrás en el mismo pedido quedan fuera
+        # de secuencia (10016) y se vuelven a mandar desde reserva.ultimo + 1.
+        pendientes = list(range(len(facturas)))
+
+        while pendientes:
+            indices = pendientes[:max_reg]
+            bloque = [facturas[i] for i in indices]
+            desde = reserva.ultimo + 1
+            resincronizado = False
+            try:
+                while True:
+                    desde = reserva.ultimo + 1
+                    detalles, errores, codigos = _solicitar_cae_bloque(
+                        token, sign, cuit_int, pto_vta, tipo_cbte, bloque, desde, fecha_cbte
+                    )
+
+                    primero = detalles.get(desde)
+                    rechazado = not primero or not primero["cae"]
+                    if rechazado and codigos & AFIP_ERR_TOKEN and not renovado:
+                        token, sign = renovar_wsaa()
+                        renovado = True
+                        continue
+                    if rechazado and AFIP_ERR_FUERA_DE_SECUENCIA in codigos and not resincronizado:
+                        reserva.resincronizar()
+                        resincronizado = True
+                        continue
+                    break
+            except Exception as e:
+                # Los CAE anteriores ya están otorgados: se devuelven para
+                # registrarlos. Este bloque pudo haberse autorizado sin que
+                # llegara la respuesta, así que se resincroniza al liberar.
+                print(f"⚠️ WSFE → falló el bloque desde {desde}: {e}")
+                reserva.marcar_incierta()
+                for i in indices:
+                    resultados[i] = {"error": f"Sin respuesta válida de AFIP (verificar antes de reintentar): {e}"}
+                for i in pendientes[len(indices):]:
+                    resultados[i] = {"error": "No enviada: falló el bloque anterior"}
+                break
+
+            # Rechazo general (sin detalle de la primera, o fuera de secuencia aun
+            # después de resincronizar): reintentar de a una no cambiaría nada
+            primero = detalles.get(desde)
+            if not (primero and primero["cae"]) and (
+                not primero or AFIP_ERR_FUERA_DE_SECUENCIA in primero["codigos"]
+            ):
+                motivos = (primero["observaciones"] if primero else []) + errores
+                resultados[indices[0]] = {
+                    "error": "La AFIP rechazó la factura. " + (" | ".join(motivos) or "Sin detalle")
+                }
+                for i in pendientes[1:]:
+                    resultados[i] = {"error": "No enviada: la AFIP rechazó el pedido anterior"}
+                break
+
+            rechazada = False
+            for offset, i in enumerate(indices):
+                cbte_nro = desde + offset
+                det = detalles.get(cbte_nro)
+                if det and det["cae"] and det["resultado"] == "A":
+                    resultados[i] = {
+                        "cae": det["cae"],
+                        "vencimiento": det["vencimiento"],
+                        "cbte_nro": cbte_nro,
+                        "pto_vta": pto_vta,
+                    }
+                    reserva.confirmar(cbte_nro)
+                elif not rechazada:
+                    # La primera rechazada es la que tiene el problema de datos
+                    motivos = (det["observaciones"] if det else []) + errores
+                    resultados[i] = {
+                        "error": "La AFIP rechazó la factura. " + (" | ".join(motivos) or "Sin detalle")
+                    }
+                    rechazada = True
+                # Las siguientes rechazadas quedan pendientes para el próximo pedido
+
+            pendientes = [i for i in pendientes if resultados[i] is None]
+
+    return resultados
+
+
 # ======================================================
 # 5) WSFE – NOTA DE CRÉDITO C (CbteTipo=13)
 #    Asociada a Factura C (CbteTipo=11)
@@ -437,49 +1000,23 @@ def wsfe_nota_credito_c(cliente: dict | None,
 
     doc_tipo, doc_nro = doc_tipo_y_nro(cliente)
 
-    # Auth
-    token, sign = obtener_auth_wsaa()
-
-    # Último NC
-    try:
-        ultimo = wsfe_ultimo_comprobante(token, sign, cuit_int, pto_vta, TIPO_NC_C)
-    except:
-        cms_b64 = generar_cms_der_b64("/etc/secrets/afip_new.crt", "/etc/secrets/afip_new.key")
-        token, sign = login_cms_directo(cms_b64)
-        guardar_wsaa(token, sign)
-        ultimo = wsfe_ultimo_comprobante(token, sign, cuit_int, pto_vta, TIPO_NC_C)
-
-    cbte_nro = ultimo + 1
-
     # Items XML
-    xml_items = ""
-    for it in items:
-        descripcion = it["descripcion"]
-        cantidad = float(it["cantidad"])
-        precio = float(it["precio"])
-        importe_item = round(cantidad * precio, 2)
-
-        xml_items += f"""
-        <ar:Item>
-            <ar:Pro_cod>{descripcion}</ar:Pro_cod>
-            <ar:Pro_ds>{descripcion}</ar:Pro_ds>
-            <ar:Pro_qty>{cantidad}</ar:Pro_qty>
-            <ar:Pro_umed>7</ar:Pro_umed>
-            <ar:Pro_precio>{precio}</ar:Pro_precio>
-            <ar:Pro_total_item>{importe_item}</ar:Pro_total_item>
-        </ar:Item>
-        """
-
-    wsfe_url = os.environ.get(
-        "AFIP_WSFE_URL",
-        "https://servicios1.afip.gov.ar/wsfev1/service.asmx"
-    )
+    xml_items = _xml_items(items)
 
     # CbtesAsoc: referenciar la Factura C original
     asoc_pto = int(factura_asociada["pto_vta"])
     asoc_nro = int(factura_asociada["cbte_nro"])
 
-    soap_body = f"""<?xml version="1.0" encoding="UTF-8"?>
+    # Número local: FECompUltimoAutorizado sólo al sembrar o ante error 10016
+    with NUMERADOR.reservar(cuit_int, pto_vta, TIPO_NC_C) as reserva:
+        renovado = False
+        resincronizado = False
+        while True:
+            # Auth
+            token, sign = obtener_auth_wsaa()
+            cbte_nro = reserva.ultimo + 1
+
+            soap_body = f"""<?xml version="1.0" encoding="UTF-8"?>
 <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
     xmlns:ar="http://ar.gov.afip.dif.FEV1/">
   <soapenv:Header/>
@@ -534,39 +1071,26 @@ def wsfe_nota_credito_c(cliente: dict | None,
 </soapenv:Envelope>
 """
 
-    headers = {
-        "Content-Type": "text/xml; charset=utf-8",
-        "SOAPAction": "http://ar.gov.afip.dif.FEV1/FECAESolicitar",
-    }
+            cae, vto, errores, codigos, respuesta = _solicitar_cae(soap_body)
 
-    session = requests.Session()
-    session.mount("https://", TLSAdapter())
-    r = session.post(wsfe_url, data=soap_body.encode("utf-8"), headers=headers, timeout=20)
-
-    if r.status_code != 200:
-        raise Exception(f"WSFE devolvió {r.status_code}: {r.text}")
-
-    tree = ET.fromstring(r.text)
-
-    cae = None
-    vto = None
-    errores = []
-
-    for elem in tree.iter():
-        if elem.tag.endswith("CAE"):
-            cae = elem.text
-        if elem.tag.endswith("CAEFchVto"):
-            vto = elem.text
-        if elem.tag.endswith("ErrMsg"):
-            errores.append(elem.text)
+            if not cae and codigos & AFIP_ERR_TOKEN and not renovado:
+                renovar_wsaa()
+                renovado = True
+                continue
+            if not cae and AFIP_ERR_FUERA_DE_SECUENCIA in codigos and not resincronizado:
+                reserva.resincronizar()
+                resincronizado = True
+                continue
+            break
 
-    errores = [str(e) for e in errores if e]
+        if cae:
+            reserva.confirmar(cbte_nro)
 
     if not cae:
         msg = "La AFIP rechazó la Nota de Crédito.\n"
         if errores:
             msg += "Errores: " + " | ".join(errores) + "\n"
-        msg += "\nRespuesta completa AFIP:\n" + r.text[:2000]
+        msg += "\nRespuesta completa AFIP:\n" + respuesta[:2000]
         raise Exception(msg)
 
     return {
@@ -5,10 +5,11 @@ from typing import List, Optional
 import base64
 from datetime import datetime
 
-from afip import wsfe_facturar
+from afip import wsfe_facturar, wsfe_facturar_lote
 from pdf_afip import generar_pdf_factura_c
 from json_db import esta_facturada, guardar_factura, obtener_factura
 from google_drive_client import upload_pdf_to_drive
+from receipts_mirror import marcar_facturada
 
 RAZON_SOCIAL = "JOAQUIN VEGLI"
 DOMICILIO = "ALSINA 155 LOC 15, BAHIA BLANCA, BUENOS AIRES. CP: 8000"
@@ -47,8 +48,77 @@ def obtener_factura_existente(receipt_id: str):
     return {"exists": True, "invoice": data}
 
 
+def _cliente_afip(req: FacturaRequest) -> dict:
+    return {
+        "dni": req.cliente.dni if req.cliente else None,
+        "cuit": req.cliente.cuit if req.cliente else None,
+    }
+
+
+def _items_afip(req: FacturaRequest) -> list:
+    return [{
+        "descripcion": it.nombre,
+        "cantidad": it.cantidad,
+        "precio": it.precio_unitario,
+    } for it in req.items]
+
+
+def _registrar_factura(req: FacturaRequest, result: dict):
+    """
+    Genera el PDF, lo sube a Supabase y guarda la factura en la DB.
+    Devuelve (factura_data, pdf_path).
+    """
+    cae = result["cae"]
+    venc = result["vencimiento"]
+    cbte_nro = result["cbte_nro"]
+    pto_vta = result["pto_vta"]
+
+    fecha_hoy = datetime.now().strftime("%d/%m/%Y")
+    pdf_path = generar_pdf_factura_c(
+        razon_social=RAZON_SOCIAL,
+        domicilio=DOMICILIO,
+        cuit=CUIT,
+        pto_vta=int(pto_vta),
+        cbte_nro=cbte_nro,
+        fecha=fecha_hoy,
+        cae=cae,
+        cae_vto=venc,
+        cliente_nombre=req.cliente.name if req.cliente else "Consumidor Final",
+        cliente_dni=req.cliente.dni if req.cliente else None,
+        cliente_cuit=req.cliente.cuit if req.cliente else None,
+        cliente_domicilio=req.cliente.domicilio if req.cliente else None,
+        items=_items_afip(req),
+        total=req.total,
+    )
+
+    pdf_filename = f"FACT-C-{pto_vta:04d}-{cbte_nro:08d}.pdf"
+    drive_id, drive_url = upload_pdf_to_drive(pdf_path, pdf_filename)
+
+    factura_data = {
+        "cbte_nro": cbte_nro,
+        "pto_vta": pto_vta,
+        "cae": cae,
+        "vencimiento": venc,
+        "fecha": fecha_hoy,
+        "drive_id": drive_id,
+        "drive_url": drive_url,
+        "email_cliente": req.cliente.email if req.cliente else None,
+        "cliente_nombre": req.cliente.name if req.cliente else "Consumidor Final",
+        "cliente_dni": req.cliente.dni if req.cliente else None,
+        "cliente_cuit": req.cliente.cuit if req.cliente else None,
+        "cliente_domicilio": req.cliente.domicilio if req.cliente else None,
+        "total": req.total,
+    }
+    guardar_factura(req.receipt_id, factura_data)
+    # El dashboard del espejo guarda facturado / no facturado por día
+    marcar_facturada(req.receipt_id)
+
+    return factura_data, pdf_path
+
+
 @router.post("/facturar")
-async def facturar(req: FacturaRequest):
+def facturar(req: FacturaRequest):
+    # def (no async): AFIP bloquea (y espera la numeración del tipo); corre en el threadpool
     if esta_facturada(req.receipt_id):
         raise HTTPException(
             status_code=400,
@@ -59,64 +129,12 @@ async def facturar(req: FacturaRequest):
 
         result = wsfe_facturar(
             tipo_cbte=TIPO_FACTURA_C,
-            cliente={
-                "dni": req.cliente.dni if req.cliente else None,
-                "cuit": req.cliente.cuit if req.cliente else None,
-            },
-            items=[{
-                "descripcion": it.nombre,
-                "cantidad": it.cantidad,
-                "precio": it.precio_unitario,
-            } for it in req.items],
+            cliente=_cliente_afip(req),
+            items=_items_afip(req),
             total=req.total,
         )
 
-        cae = result["cae"]
-        venc = result["vencimiento"]
-        cbte_nro = result["cbte_nro"]
-        pto_vta = result["pto_vta"]
-
-        fecha_hoy = datetime.now().strftime("%d/%m/%Y")
-        pdf_path = generar_pdf_factura_c(
-            razon_social=RAZON_SOCIAL,
-            domicilio=DOMICILIO,
-            cuit=CUIT,
-            pto_vta=int(pto_vta),
-            cbte_nro=cbte_nro,
-            fecha=fecha_hoy,
-            cae=cae,
-            cae_vto=venc,
-            cliente_nombre=req.cliente.name if req.cliente else "Consumidor Final",
-            cliente_dni=req.cliente.dni if req.cliente else None,
-            cliente_cuit=req.cliente.cuit if req.cliente else None,
-            cliente_domicilio=req.cliente.domicilio if req.cliente else None,
-            items=[{
-                "descripcion": it.nombre,
-                "cantidad": it.cantidad,
-                "precio": it.precio_unitario,
-            } for it in req.items],
-            total=req.total,
-        )
-
-        pdf_filename = f"FACT-C-{pto_vta:04d}-{cbte_nro:08d}.pdf"
-        drive_id, drive_url = upload_pdf_to_drive(pdf_path, pdf_filename)
-
-        factura_data = {
-            "cbte_nro": cbte_nro,
-            "pto_vta": pto_vta,
-            "cae": cae,
-            "vencimiento": venc,
-            "fecha": fecha_hoy,
-            "drive_id": drive_id,
-            "drive_url": drive_url,
-            "email_cliente": req.cliente.email if req.cliente else None,
-            "cliente_nombre": req.cliente.name if req.cliente else "Consumidor Final",
-            "cliente_dni": req.cliente.dni if req.cliente else None,
-            "cliente_cuit": req.cliente.cuit if req.cliente else None,
-            "cliente_domicilio": req.cliente.domicilio if req.cliente else None,
-            "total": req.total,
-        }
-        guardar_factura(req.receipt_id, factura_data)
+        factura_data, pdf_path = _registrar_factura(req, result)
 
         with open(pdf_path, "rb") as f:
             pdf_b64 = base64.b64encode(f.read()).decode("utf-8")
@@ -124,13 +142,79 @@ async def facturar(req: FacturaRequest):
         return {
             "status": "ok",
             "receipt_id": req.receipt_id,
-            "cae": cae,
-            "vencimiento": venc,
-            "cbte_nro": cbte_nro,
+            "cae": result["cae"],
+            "vencimiento": result["vencimiento"],
+            "cbte_nro": result["cbte_nro"],
             "pdf_base64": pdf_b64,
             "invoice": factura_data,
-            "pdf_url": drive_url,
+            "pdf_url": factura_data["drive_url"],
         }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/facturar/lote")
+def facturar_lote(reqs: List[FacturaRequest]):
+    """
+    Factura varias ventas con un único FECAESolicitar por bloque (CantReg > 1).
+    Devuelve un resultado por receipt_id; un rechazo no aborta el resto del lote.
+    Es def (no async): AFIP, PDF, Supabase y DB bloquean y corren en el threadpool.
+    """
+    TIPO_FACTURA_C = 11
+
+    resultados = []
+    pendientes = []
+    vistos = set()
+
+    for req in reqs:
+        if req.receipt_id in vistos:
+            resultados.append({"receipt_id": req.receipt_id, "status": "error",
+                               "detail": "receipt_id repetido en el lote"})
+            continue
+        vistos.add(req.receipt_id)
+        if esta_facturada(req.receipt_id):
+            resultados.append({"receipt_id": req.receipt_id, "status": "error",
+                               "detail": f"La venta {req.receipt_id} ya fue facturada anteriormente."})
+            continue
+        pendientes.append(req)
+
+    try:
+        afip_results = wsfe_facturar_lote(
+            tipo_cbte=TIPO_FACTURA_C,
+            facturas=[{
+                "cliente": _cliente_afip(req),
+                "items": _items_afip(req),
+                "total": req.total,
+            } for req in pendientes],
+        )
+    except Exception as e:
+        # Sólo errores previos al primer envío (config, WSAA): no hay CAE otorgados
+        raise HTTPException(status_code=500, detail=str(e))
+
+    for req, result in zip(pendientes, afip_results):
+        if "error" in result:
+            resultados.append({"receipt_id": req.receipt_id, "status": "error", "detail": result["error"]})
+            continue
+        try:
+            factura_data, _ = _registrar_factura(req, result)
+        except Exception as e:
+            # AFIP ya otorgó el CAE: se informa para no perderlo
+            resultados.append({"receipt_id": req.receipt_id, "status": "error", "detail": str(e),
+                               "cae": result["cae"], "cbte_nro": result["cbte_nro"]})
+            continue
+        resultados.append({
+            "receipt_id": req.receipt_id,
+            "status": "ok",
+            "cae": result["cae"],
+            "vencimiento": result["vencimiento"],
+            "cbte_nro": result["cbte_nro"],
+            "invoice": factura_data,
+            "pdf_url": factura_data["drive_url"],
+        })
+
+    return {
+        "status": "ok",
+        "facturadas": sum(1 for r in resultados if r["status"] == "ok"),
+        "resultados": resultados,
+    }
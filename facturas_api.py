@@ -1,7 +1,7 @@
 # facturas_api.py
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Query
 from typing import Optional
-from json_db import _load_db
+from json_db import buscar_facturas, notas_credito_de_venta
 
 router = APIRouter()
 
@@ -11,36 +11,48 @@ def listar_facturas(
     hasta: Optional[str] = None,
     cliente: Optional[str] = None,
     nro: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
 ):
     """
-    Devuelve facturas y notas de crédito de la DB.
+    Devuelve facturas y notas de crédito de la DB, por cbte_nro descendente.
     Filtros opcionales:
       - desde / hasta: "DD/MM/YYYY"
       - cliente: búsqueda parcial por nombre
       - nro: número de comprobante (cbte_nro)
+    Paginación opcional:
+      - limit: tamaño de página (sin limit se devuelve todo, como antes)
+      - cursor: el next_cursor de la página anterior
+    Sin limit, "total" es la cantidad de facturas que coinciden. Paginado no
+    se cuentan todas: "cantidad" es la de esta página y "next_cursor" es None
+    en la última.
     """
-    db = _load_db()
-    facturas = db.get("facturas", {})
-    notas = db.get("notas_credito", {})
+    # Los filtros se aplican sobre la DB antes de enriquecer: sólo se arma
+    # la respuesta de las facturas que efectivamente se devuelven.
+    try:
+        filas, next_cursor = buscar_facturas(
+            desde=desde, hasta=hasta, cliente=cliente, nro=nro,
+            limit=limit, cursor=cursor,
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
 
-    # Construir lista de facturas enriquecida
     resultado = []
-    for receipt_id, f in facturas.items():
-        # Buscar nota de crédito asociada a esta factura
+    for receipt_id, f in filas:
+        # Nota de crédito asociada a esta factura (índice sale_receipt_id → NC)
         nc_asociada = None
-        for refund_id, nc in notas.items():
-            asociada_a = nc.get("asociada_a", {})
-            if asociada_a.get("sale_receipt_id") == receipt_id:
-                nc_asociada = {
-                    "refund_receipt_id": refund_id,
-                    "cbte_nro": nc.get("cbte_nro"),
-                    "pto_vta": nc.get("pto_vta"),
-                    "cae": nc.get("cae"),
-                    "fecha": nc.get("fecha"),
-                    "monto": nc.get("monto"),
-                    "items": nc.get("items", []),
-                }
-                break
+        asociadas = notas_credito_de_venta(receipt_id)
+        if asociadas:
+            refund_id, nc = asociadas[0]
+            nc_asociada = {
+                "refund_receipt_id": refund_id,
+                "cbte_nro": nc.get("cbte_nro"),
+                "pto_vta": nc.get("pto_vta"),
+                "cae": nc.get("cae"),
+                "fecha": nc.get("fecha"),
+                "monto": nc.get("monto"),
+                "items": nc.get("items", []),
+            }
 
         resultado.append({
             "receipt_id": receipt_id,
@@ -59,44 +71,6 @@ def listar_facturas(
             "nota_credito": nc_asociada,
         })
 
-    # Ordenar por cbte_nro descendente
-    resultado.sort(key=lambda x: x["cbte_nro"] or 0, reverse=True)
-
-    # Filtro por fecha
-    if desde:
-        resultado = [f for f in resultado if _fecha_gte(f["fecha"], desde)]
-    if hasta:
-        resultado = [f for f in resultado if _fecha_lte(f["fecha"], hasta)]
-
-    # Filtro por cliente
-    if cliente:
-        q = cliente.lower()
-        resultado = [
-            f for f in resultado
-            if q in (f["cliente_nombre"] or "").lower()
-            or q in (f["cliente_dni"] or "")
-            or q in (f["cliente_cuit"] or "")
-        ]
-
-    # Filtro por número de comprobante
-    if nro:
-        resultado = [f for f in resultado if str(f["cbte_nro"]) == nro.strip()]
-
+    if limit:
+        return {"facturas": resultado, "cantidad": len(resultado), "next_cursor": next_cursor}
     return {"facturas": resultado, "total": len(resultado)}
-
-
-def _parse_fecha(fecha_str: str):
-    """Convierte 'DD/MM/YYYY' a (yyyy, mm, dd) para comparar."""
-    try:
-        d, m, y = fecha_str.split("/")
-        return (int(y), int(m), int(d))
-    except Exception:
-        return (0, 0, 0)
-
-def _fecha_gte(fecha: str, desde: str):
-    """fecha >= desde, ambas en 'DD/MM/YYYY'"""
-    return _parse_fecha(fecha) >= _parse_fecha(desde)
-
-def _fecha_lte(fecha: str, hasta: str):
-    """fecha <= hasta, ambas en 'DD/MM/YYYY'"""
-    return _parse_fecha(fecha) <= _parse_fecha(hasta)
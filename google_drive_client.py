@@ -2,7 +2,10 @@
 import os
 import json
 import time
-from typing import Tuple, Dict, Any
+import random
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Tuple, Dict, Any
 
 import httpx
 from supabase import create_client, Client
@@ -89,10 +92,10 @@ def download_facturas_db(local_path: str = "facturas_db.json") -> Dict[str, Any]
 # ============================================================
 # 3) SUBIR JSON DE FACTURAS
 # ============================================================
-def upload_facturas_db(local_path: str = "facturas_db.json") -> None:
+def upload_facturas_db(local_path: str = "facturas_db.json") -> bool:
     if not os.path.exists(local_path):
         print("DEBUG → No existe facturas_db.json local para subir")
-        return
+        return False
 
     try:
         supabase = get_supabase()
@@ -107,6 +110,244 @@ def upload_facturas_db(local_path: str = "facturas_db.json") -> None:
         )
 
         print("DEBUG → facturas_db.json subido a Supabase correctamente")
+        return True
 
     except Exception as e:
         print(f"⚠️ Error subiendo facturas_db a Supabase: {e}")
+        return False
+
+
+# ============================================================
+# 4) JOURNAL DE FACTURAS (segmentos append-only)
+# ============================================================
+FACTURAS_JOURNAL_DIR = "db/journal"
+
+
+def upload_journal_segment(nombre: str, contenido: bytes) -> bool:
+    try:
+        supabase = get_supabase()
+
+        supabase.storage.from_(SUPABASE_BUCKET).upload(
+            path=f"{FACTURAS_JOURNAL_DIR}/{nombre}",
+            file=contenido,
+            file_options={"content-type": "application/x-ndjson", "upsert": "true"},
+        )
+        return True
+
+    except Exception as e:
+        print(f"⚠️ Error subiendo segmento de journal {nombre} a Supabase: {e}")
+        return False
+
+
+def list_journal_segments() -> list:
+    """Nombres de los segmentos en Supabase, ordenados."""
+    try:
+        supabase = get_supabase()
+
+        nombres = []
+        offset = 0
+        while True:
+            page = supabase.storage.from_(SUPABASE_BUCKET).list(
+                FACTURAS_JOURNAL_DIR,
+                {"limit": 1000, "offset": offset, "sortBy": {"column": "name", "order": "asc"}},
+            )
+            nombres.extend(f["name"] for f in page if f.get("name", "").endswith(".jsonl"))
+            if len(page) < 1000:
+                break
+            offset += 1000
+
+        return sorted(nombres)
+
+    except Exception as e:
+        print(f"⚠️ Error listando journal en Supabase: {e}")
+        return []
+
+
+def download_journal_segment(nombre: str) -> bytes | None:
+    try:
+        supabase = get_supabase()
+        return supabase.storage.from_(SUPABASE_BUCKET).download(f"{FACTURAS_JOURNAL_DIR}/{nombre}")
+    except Exception as e:
+        print(f"⚠️ Error descargando segmento de journal {nombre}: {e}")
+        return None
+
+
+def remove_journal_segments(nombres: list) -> None:
+    if not nombres:
+        return
+    try:
+        supabase = get_supabase()
+        supabase.storage.from_(SUPABASE_BUCKET).remove(
+            [f"{FACTURAS_JOURNAL_DIR}/{n}" for n in nombres]
+        )
+    except Exception as e:
+        print(f"⚠️ Error borrando segmentos de journal en Supabase: {e}")
+
+
+# ============================================================
+# 5) BACKUP DE LA BASE SQLITE
+# ============================================================
+FACTURAS_SQLITE_PATH = "db/facturas_db.sqlite3"
+
+
+def download_facturas_sqlite(local_path: str) -> bool:
+    """
+    Devuelve False si la base todavía no existe en Supabase. Cualquier otro
+    error se levanta: arrancar sin ella dejaría afuera lo ya facturado.
+    """
+    supabase = get_supabase()
+    url = supabase.storage.from_(SUPABASE_BUCKET).get_public_url(FACTURAS_SQLITE_PATH)
+
+    # Timestamp para evitar caché
+    r = httpx.get(f"{url}?t={int(time.time())}", timeout=60, follow_redirects=True)
+
+    if r.status_code in (400, 404):
+        print("DEBUG → facturas_db.sqlite3 no existe en Supabase todavía")
+        return False
+
+    r.raise_for_status()
+
+    # Archivo temporal: una descarga cortada no deja una base a medias
+    tmp_path = local_path + ".download"
+    with open(tmp_path, "wb") as f:
+        f.write(r.content)
+    os.replace(tmp_path, local_path)
+
+    print(f"DEBUG → facturas_db.sqlite3 descargado de Supabase ({len(r.content)} bytes)")
+    return True
+
+
+def upload_facturas_sqlite(local_path: str) -> bool:
+    if not os.path.exists(local_path):
+        print("DEBUG → No existe backup sqlite local para subir")
+        return False
+
+    try:
+        supabase = get_supabase()
+
+        with open(local_path, "rb") as f:
+            contenido = f.read()
+
+        supabase.storage.from_(SUPABASE_BUCKET).upload(
+            path=FACTURAS_SQLITE_PATH,
+            file=contenido,
+            file_options={"content-type": "application/vnd.sqlite3", "upsert": "true"},
+        )
+        return True
+
+    except Exception as e:
+        print(f"⚠️ Error subiendo facturas_db.sqlite3 a Supabase: {e}")
+        return False
+
+
+# ============================================================
+# 6) SUBIDA DIFERIDA EN SEGUNDO PLANO
+# ============================================================
+class UploaderDiferido:
+    """
+    Ejecuta `subir` en un thread aparte. Varias marcas seguidas se agrupan en
+    una sola subida cuando pasan `debounce` segundos sin cambios; si falla se
+    reintenta con backoff y el estado queda "pendiente" hasta que salga bien.
+    """
+
+    def __init__(self, subir: Callable[[], bool], debounce: float = 3.0,
+                 max_reintentos: int = 5, nombre: str = "uploader"):
+        self._subir = subir
+        self.debounce = debounce
+        self.max_reintentos = max_reintentos
+        self.nombre = nombre
+
+        self._cond = threading.Condition()
+        self._pendiente = False
+        self._subiendo = False
+        self._forzar = False
+        self._detenido = False
+        self._proximo_intento = 0.0
+        self._thread: threading.Thread | None = None
+
+        self.ultimo_upload_ok: datetime | None = None
+        self.ultimo_error: str | None = None
+
+    def marcar(self) -> None:
+        with self._cond:
+            self._pendiente = True
+            self._proximo_intento = time.monotonic() + self.debounce
+            if self._thread is None or not self._thread.is_alive():
+                self._detenido = False
+                self._thread = threading.Thread(target=self._loop, name=self.nombre, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pendiente and not self._detenido:
+                    self._cond.wait()
+                if not self._pendiente:
+                    return
+                # Debounce: esperar a que dejen de llegar cambios
+                while not self._forzar and not self._detenido:
+                    restante = self._proximo_intento - time.monotonic()
+                    if restante <= 0:
+                        break
+                    self._cond.wait(restante)
+                self._pendiente = False
+                self._subiendo = True
+
+            ok = self._intentar_subir()
+
+            with self._cond:
+                self._subiendo = False
+                if not ok:
+                    # Sigue sucio; el próximo intento espera un minuto
+                    self._pendiente = True
+                    self._proximo_intento = time.monotonic() + 60
+                if not self._pendiente:
+                    self._forzar = False
+                self._cond.notify_all()
+                if not ok and self._detenido:
+                    return
+
+    def _intentar_subir(self) -> bool:
+        espera = 1.0
+        for intento in range(1, self.max_reintentos + 1):
+            try:
+                ok = self._subir()
+                if ok is False:
+                    raise Exception("la subida devolvió False")
+                self.ultimo_upload_ok = datetime.now(timezone.utc)
+                self.ultimo_error = None
+                return True
+            except Exception as e:
+                self.ultimo_error = str(e)
+                print(f"⚠️ {self.nombre} → intento {intento} falló: {e}")
+
+            if self._detenido or intento == self.max_reintentos:
+                break
+            time.sleep(espera + random.uniform(0, espera / 2))
+            espera = min(espera * 2, 30)
+        return False
+
+    def flush(self, timeout: float = 30) -> bool:
+        """Sube ya lo pendiente (sin esperar el debounce). True si quedó todo subido."""
+        with self._cond:
+            if not self._pendiente and not self._subiendo:
+                return True
+            self._forzar = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._pendiente and not self._subiendo, timeout)
+
+    def detener(self, timeout: float = 30) -> bool:
+        ok = self.flush(timeout)
+        with self._cond:
+            self._detenido = True
+            self._cond.notify_all()
+        return ok
+
+    def estado(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "pendiente": self._pendiente or self._subiendo,
+                "ultimo_upload_ok": self.ultimo_upload_ok.isoformat() if self.ultimo_upload_ok else None,
+                "ultimo_error": self.ultimo_error,
+            }
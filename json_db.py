@@ -1,16 +1,50 @@
 # json_db.py
 import os
 import json
-from typing import Any, Dict, Optional
+import shutil
+import threading
+from bisect import bisect_left, insort
+from typing import Any, Dict, Iterable, Optional
 
-from google_drive_client import download_facturas_db, upload_facturas_db
+import sqlite_db
+from google_drive_client import (
+    download_facturas_db,
+    upload_facturas_db,
+    upload_journal_segment,
+    list_journal_segments,
+    download_journal_segment,
+    remove_journal_segments,
+    download_facturas_sqlite,
+    upload_facturas_sqlite,
+    UploaderDiferido,
+)
 
 LOCAL_PATH = "facturas_db.json"
+JOURNAL_PATH = "facturas_db.journal.jsonl"
+
+# "json"    → snapshot completo en cada escritura (comportamiento original)
+# "journal" → una línea por cambio + compactación periódica del snapshot
+# "sqlite"  → sqlite_db (WAL, índices), sin cargar todo el historial en memoria
+DB_BACKEND = os.environ.get("FACTURAS_DB_BACKEND", "json")
+COMPACTAR_CADA = int(os.environ.get("FACTURAS_DB_COMPACTAR_CADA", "500"))
+UPLOAD_DEBOUNCE = float(os.environ.get("FACTURAS_DB_UPLOAD_DEBOUNCE", "3"))
 
 # ============================================================
 # CACHÉ EN MEMORIA — evita depender del caché de Cloudinary
 # ============================================================
 _DB_CACHE: Dict[str, Any] | None = None
+_DB_LOCK = threading.RLock()
+
+
+def _normalizar_db(data: Dict[str, Any]) -> Dict[str, Any]:
+    # Compatibilidad con formato viejo (dict plano sin claves "facturas"/"notas_credito")
+    if "facturas" not in data and "notas_credito" not in data:
+        data = {"facturas": data, "notas_credito": {}}
+    if "facturas" not in data:
+        data["facturas"] = {}
+    if "notas_credito" not in data:
+        data["notas_credito"] = {}
+    return data
 
 
 def _load_db() -> Dict[str, Any]:
@@ -20,20 +54,21 @@ def _load_db() -> Dict[str, Any]:
     if _DB_CACHE is not None:
         return _DB_CACHE
 
-    # Primera vez: intentar bajar desde Cloudinary
-    print("DEBUG json_db → Cargando DB desde Cloudinary por primera vez")
-    data = download_facturas_db(LOCAL_PATH) or {}
+    with _DB_LOCK:
+        if _DB_CACHE is not None:
+            return _DB_CACHE
 
-    # Compatibilidad con formato viejo (dict plano sin claves "facturas"/"notas_credito")
-    if "facturas" not in data and "notas_credito" not in data:
-        data = {"facturas": data, "notas_credito": {}}
-    if "facturas" not in data:
-        data["facturas"] = {}
-    if "notas_credito" not in data:
-        data["notas_credito"] = {}
+        # Primera vez: intentar bajar desde Cloudinary
+        print("DEBUG json_db → Cargando DB desde Cloudinary por primera vez")
+        data = _normalizar_db(download_facturas_db(LOCAL_PATH) or {})
 
-    _DB_CACHE = data
-    return _DB_CACHE
+        if DB_BACKEND == "journal":
+            _journal_reproducir(data)
+
+        _completar_fecha_ord(data)
+        _reindexar(data)
+        _DB_CACHE = data
+        return _DB_CACHE
 
 
 def _save_db(db: Dict[str, Any]) -> None:
@@ -46,41 +81,583 @@ def _save_db(db: Dict[str, Any]) -> None:
     with open(LOCAL_PATH, "w", encoding="utf-8") as f:
         json.dump(db, f, indent=2, ensure_ascii=False)
 
-    # Subir a Cloudinary como backup
-    upload_facturas_db(LOCAL_PATH)
+    # Subir a Cloudinary como backup (en segundo plano, agrupando ráfagas)
+    _UPLOADER.marcar()
+
+
+def _persistir(db: Dict[str, Any], tabla: str, clave: str, info: Dict[str, Any]) -> None:
+    with _DB_LOCK:
+        anterior = db[tabla].get(clave)
+        db[tabla][clave] = info
+        _indexar(tabla, clave, info, anterior)
+        if DB_BACKEND == "journal":
+            _journal_append(db, tabla, clave, info)
+        else:
+            _save_db(db)
+
+
+# ============================================================
+# FECHAS "DD/MM/YYYY"
+# ============================================================
+def _parse_fecha(fecha_str: str):
+    """Convierte 'DD/MM/YYYY' a (yyyy, mm, dd) para comparar."""
+    try:
+        d, m, y = fecha_str.split("/")
+        return (int(y), int(m), int(d))
+    except Exception:
+        return (0, 0, 0)
+
+def _fecha_ord(fecha_str: str) -> int:
+    """'DD/MM/YYYY' → YYYYMMDD como entero (0 si es inválida). Ordena igual que _parse_fecha."""
+    y, m, d = _parse_fecha(fecha_str)
+    return y * 10000 + m * 100 + d
+
+def _con_fecha_ord(info: Dict[str, Any]) -> Dict[str, Any]:
+    """Copia de info con "fecha_ord" calculado: se parsea una sola vez, al guardar."""
+    return {**info, "fecha_ord": _fecha_ord(info.get("fecha"))}
+
+def _completar_fecha_ord(db: Dict[str, Any]) -> None:
+    """Backfill de "fecha_ord" en registros guardados antes de que existiera."""
+    for tabla in ("facturas", "notas_credito"):
+        for info in db[tabla].values():
+            if "fecha_ord" not in info:
+                info["fecha_ord"] = _fecha_ord(info.get("fecha"))
+
+
+# ============================================================
+# ÍNDICES EN MEMORIA (backends json / journal)
+# ============================================================
+_NC_POR_VENTA: Dict[str, list] = {}  # sale_receipt_id → [refund_receipt_id, ...] en orden de alta
+_ALTA_NC: Dict[str, int] = {}        # refund_receipt_id → orden de alta (como el rowid de sqlite)
+_ORDEN_FACTURAS: list = []           # [(cbte_nro, receipt_id), ...] ascendente
+_FECHAS_FACTURAS: list = []          # [(fecha_ord, receipt_id), ...] ascendente
+_CLIENTE_FACTURAS: Dict[str, set] = {}   # texto buscable (nombre en minúsculas, DNI, CUIT) → receipt_ids
+_TRIGRAMAS_CLIENTE: Dict[str, set] = {}  # trigrama → textos buscables que lo contienen
+
+# Si los índices de fecha / cliente dejan menos de esta fracción de las
+# facturas se usan esas candidatas; si no, conviene recorrer por cbte_nro.
+_FRACCION_CANDIDATAS = 0.25
+
+
+def _venta_asociada(nc: Dict[str, Any] | None) -> Optional[str]:
+    return ((nc or {}).get("asociada_a") or {}).get("sale_receipt_id")
+
+
+def _clave_orden(receipt_id: str, info: Dict[str, Any]) -> tuple:
+    return (info.get("cbte_nro") or 0, receipt_id)
+
+
+def _clave_fecha(receipt_id: str, info: Dict[str, Any]) -> tuple:
+    return (info.get("fecha_ord", 0), receipt_id)
+
+
+def _textos_cliente(info: Dict[str, Any]) -> set:
+    textos = {
+        (info.get("cliente_nombre", "Consumidor Final") or "").lower(),
+        info.get("cliente_dni") or "",
+        info.get("cliente_cuit") or "",
+    }
+    textos.discard("")
+    return textos
+
+
+def _trigramas(texto: str) -> set:
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+
+def _indexar_cliente(receipt_id: str, info: Dict[str, Any], anterior: Dict[str, Any] | None) -> None:
+    nuevos = _textos_cliente(info)
+    viejos = _textos_cliente(anterior) if anterior is not None else set()
+
+    for texto in viejos - nuevos:
+        receipt_ids = _CLIENTE_FACTURAS.get(texto)
+        if receipt_ids is None:
+            continue
+        receipt_ids.discard(receipt_id)
+        if not receipt_ids:
+            del _CLIENTE_FACTURAS[texto]
+            for tri in _trigramas(texto):
+                textos = _TRIGRAMAS_CLIENTE.get(tri)
+                if textos is not None:
+                    textos.discard(texto)
+                    if not textos:
+                        del _TRIGRAMAS_CLIENTE[tri]
+
+    for texto in nuevos - viejos:
+        receipt_ids = _CLIENTE_FACTURAS.get(texto)
+        if receipt_ids is None:
+            receipt_ids = _CLIENTE_FACTURAS[texto] = set()
+            for tri in _trigramas(texto):
+                _TRIGRAMAS_CLIENTE.setdefault(tri, set()).add(texto)
+        receipt_ids.add(receipt_id)
+
+
+def _quitar_ordenado(lista: list, clave: tuple) -> None:
+    i = bisect_left(lista, clave)
+    if i < len(lista) and lista[i] == clave:
+        del lista[i]
+
+
+def _indexar(tabla: str, clave: str, info: Dict[str, Any], anterior: Dict[str, Any] | None) -> None:
+    if tabla == "facturas":
+        if anterior is not None:
+            _quitar_ordenado(_ORDEN_FACTURAS, _clave_orden(clave, anterior))
+            _quitar_ordenado(_FECHAS_FACTURAS, _clave_fecha(clave, anterior))
+        insort(_ORDEN_FACTURAS, _clave_orden(clave, info))
+        insort(_FECHAS_FACTURAS, _clave_fecha(clave, info))
+        _indexar_cliente(clave, info, anterior)
+
+    if tabla == "notas_credito":
+        _ALTA_NC.setdefault(clave, len(_ALTA_NC))
+        venta_anterior = _venta_asociada(anterior)
+        venta = _venta_asociada(info)
+        if venta_anterior and venta_anterior != venta:
+            refunds = _NC_POR_VENTA.get(venta_anterior, [])
+            if clave in refunds:
+                refunds.remove(clave)
+        if venta:
+            refunds = _NC_POR_VENTA.setdefault(venta, [])
+            if clave not in refunds:
+                # Una NC reasignada a otra venta conserva su lugar de alta
+                insort(refunds, clave, key=_ALTA_NC.get)
+
+
+def _reindexar(db: Dict[str, Any]) -> None:
+    _ORDEN_FACTURAS[:] = sorted(_clave_orden(k, v) for k, v in db["facturas"].items())
+    _FECHAS_FACTURAS[:] = sorted(_clave_fecha(k, v) for k, v in db["facturas"].items())
+    _CLIENTE_FACTURAS.clear()
+    _TRIGRAMAS_CLIENTE.clear()
+    for clave, info in db["facturas"].items():
+        _indexar_cliente(clave, info, None)
+    _NC_POR_VENTA.clear()
+    _ALTA_NC.clear()
+    for clave, info in db["notas_credito"].items():
+        _indexar("notas_credito", clave, info, None)
+
+
+# ============================================================
+# JOURNAL APPEND-ONLY
+#   - cada guardar_* agrega una línea JSON a JOURNAL_PATH
+#   - a Supabase se suben sólo las líneas nuevas, como segmentos
+#   - cada COMPACTAR_CADA cambios se reescribe el snapshot completo
+#     (con "journal_seq") y se borran los segmentos ya incluidos
+# ============================================================
+_JOURNAL_PENDIENTE: list = []  # líneas todavía no subidas a Supabase
+_JOURNAL_SEQ_SNAPSHOT = 0      # último seq incluido en el snapshot
+_JOURNAL_ULTIMO_SEQ = 0        # último seq escrito
+
+
+def _aplicar_registro(db: Dict[str, Any], registro: Dict[str, Any]) -> None:
+    tabla = registro.get("tabla")
+    if tabla in ("facturas", "notas_credito"):
+        db[tabla][registro["id"]] = registro["info"]
+
+
+def _parsear_lineas(contenido: bytes | str) -> list:
+    if isinstance(contenido, bytes):
+        contenido = contenido.decode("utf-8")
+    registros = []
+    for linea in contenido.splitlines():
+        linea = linea.strip()
+        if not linea:
+            continue
+        try:
+            registros.append(json.loads(linea))
+        except json.JSONDecodeError:
+            # Última línea cortada por un crash a mitad de escritura
+            print(f"⚠️ json_db → línea de journal inválida descartada: {linea[:80]}")
+    return registros
+
+
+def _journal_reproducir(db: Dict[str, Any]) -> None:
+    """Aplica sobre el snapshot los cambios del journal (Supabase + disco local)."""
+    global _JOURNAL_SEQ_SNAPSHOT, _JOURNAL_ULTIMO_SEQ
+
+    snapshot_seq = int(db.pop("journal_seq", 0))
+
+    registros = {}
+    for nombre in list_journal_segments():
+        contenido = download_journal_segment(nombre)
+        if contenido:
+            for reg in _parsear_lineas(contenido):
+                registros[reg["seq"]] = reg
+
+    if os.path.exists(JOURNAL_PATH):
+        with open(JOURNAL_PATH, "r", encoding="utf-8") as f:
+            locales = _parsear_lineas(f.read())
+        for reg in locales:
+            if reg["seq"] not in registros:
+                # Escrito localmente pero nunca subido
+                _JOURNAL_PENDIENTE.append(json.dumps(reg, ensure_ascii=False))
+            registros[reg["seq"]] = reg
+
+    ultimo_seq = snapshot_seq
+    for seq in sorted(registros):
+        if seq <= snapshot_seq:
+            continue
+        _aplicar_registro(db, registros[seq])
+        ultimo_seq = seq
+
+    _JOURNAL_SEQ_SNAPSHOT = snapshot_seq
+    _JOURNAL_ULTIMO_SEQ = ultimo_seq
+    print(f"DEBUG json_db → journal reproducido: snapshot {snapshot_seq}, último {ultimo_seq}")
+
+
+def _journal_subir_pendiente() -> bool:
+    with _DB_LOCK:
+        lineas = list(_JOURNAL_PENDIENTE)
+    if not lineas:
+        return True
+
+    primero = json.loads(lineas[0])["seq"]
+    ultimo = json.loads(lineas[-1])["seq"]
+    contenido = ("\n".join(lineas) + "\n").encode("utf-8")
+    if not upload_journal_segment(f"{primero:012d}-{ultimo:012d}.jsonl", contenido):
+        return False
+
+    with _DB_LOCK:
+        del _JOURNAL_PENDIENTE[:len(lineas)]
+    return True
+
+
+def _journal_append(db: Dict[str, Any], tabla: str, clave: str, info: Dict[str, Any]) -> None:
+    global _JOURNAL_ULTIMO_SEQ
+
+    seq = _JOURNAL_ULTIMO_SEQ + 1
+    linea = json.dumps({"seq": seq, "tabla": tabla, "id": clave, "info": info}, ensure_ascii=False)
+
+    with open(JOURNAL_PATH, "a", encoding="utf-8") as f:
+        f.write(linea + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    _JOURNAL_ULTIMO_SEQ = seq
+    _JOURNAL_PENDIENTE.append(linea)
+    _UPLOADER.marcar()
+
+
+def _journal_subir() -> bool:
+    if not _journal_subir_pendiente():
+        return False
+    if _JOURNAL_ULTIMO_SEQ - _JOURNAL_SEQ_SNAPSHOT >= COMPACTAR_CADA:
+        return _journal_compactar(_load_db())
+    return True
+
+
+def _journal_recortar(seq: int) -> None:
+    """Saca del journal local las líneas que ya están en el snapshot (hasta seq)."""
+    if not os.path.exists(JOURNAL_PATH):
+        return
+    with open(JOURNAL_PATH, "r", encoding="utf-8") as f:
+        registros = _parsear_lineas(f.read())
+    tmp_path = JOURNAL_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for reg in registros:
+            if reg["seq"] > seq:
+                f.write(json.dumps(reg, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, JOURNAL_PATH)
+
+
+def _journal_compactar(db: Dict[str, Any]) -> bool:
+    global _JOURNAL_SEQ_SNAPSHOT
+
+    with _DB_LOCK:
+        seq = _JOURNAL_ULTIMO_SEQ
+        tmp_path = LOCAL_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "facturas": db["facturas"],
+                "notas_credito": db["notas_credito"],
+                "journal_seq": seq,
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, LOCAL_PATH)
+
+    # Hasta que el snapshot se suba, el journal local y los segmentos siguen
+    # siendo la fuente
+    if not upload_facturas_db(LOCAL_PATH):
+        return False
+
+    with _DB_LOCK:
+        _journal_recortar(seq)
+        _JOURNAL_SEQ_SNAPSHOT = seq
+
+    viejos = [
+        nombre for nombre in list_journal_segments()
+        if int(nombre.split("-")[-1].split(".")[0]) <= seq
+    ]
+    remove_journal_segments(viejos)
+    print(f"DEBUG json_db → journal compactado hasta seq {seq}")
+    return True
+
+
+# ============================================================
+# BACKEND SQLITE
+# ============================================================
+_SQLITE_LISTO = False
+
+
+def _sqlite():
+    global _SQLITE_LISTO
+    if _SQLITE_LISTO:
+        return sqlite_db
+
+    with _DB_LOCK:
+        if not _SQLITE_LISTO:
+            descargada = False
+            if not os.path.exists(sqlite_db.SQLITE_PATH):
+                # Si Supabase falla se levanta y el próximo uso reintenta:
+                # caer al facturas_db.json dejaría afuera lo facturado desde
+                # la migración
+                try:
+                    descargada = download_facturas_sqlite(sqlite_db.SQLITE_PATH)
+                except Exception as e:
+                    raise Exception(f"No se pudo descargar facturas_db.sqlite3 de Supabase: {e}")
+            sqlite_db.conectar()
+            if not descargada and sqlite_db.esta_vacia():
+                # Primera vez: migrar el facturas_db.json existente
+                print("DEBUG json_db → SQLite vacía, importando facturas_db.json")
+                sqlite_db.importar_json(download_facturas_db(LOCAL_PATH) or {})
+            _SQLITE_LISTO = True
+    return sqlite_db
+
+
+def _sqlite_backup() -> bool:
+    tmp_path = sqlite_db.SQLITE_PATH + ".backup"
+    sqlite_db.exportar_copia(tmp_path)
+    return upload_facturas_sqlite(tmp_path)
+
+
+# ============================================================
+# BACKUP EN SEGUNDO PLANO
+# ============================================================
+def _subir_backup() -> bool:
+    if DB_BACKEND == "sqlite":
+        return _sqlite_backup()
+    if DB_BACKEND == "journal":
+        return _journal_subir()
+
+    # Foto del archivo tomada bajo el lock: nunca se sube un JSON a medio escribir
+    upload_path = LOCAL_PATH + ".upload"
+    with _DB_LOCK:
+        shutil.copyfile(LOCAL_PATH, upload_path)
+    return upload_facturas_db(upload_path)
+
+
+_UPLOADER = UploaderDiferido(_subir_backup, debounce=UPLOAD_DEBOUNCE, nombre="facturas-db-backup")
+
+
+def estado_backup() -> Dict[str, Any]:
+    """Última subida exitosa a Supabase y si quedan cambios sin subir."""
+    return _UPLOADER.estado()
+
+
+def flush_backup(timeout: float = 30) -> bool:
+    return _UPLOADER.detener(timeout)
 
 
 # -------------------------
 # FACTURAS (VENTAS)
 # -------------------------
 def obtener_factura(receipt_id: str) -> Optional[Dict[str, Any]]:
+    if DB_BACKEND == "sqlite":
+        return _sqlite().obtener_factura(receipt_id)
     db = _load_db()
     return db.get("facturas", {}).get(receipt_id)
 
 
+def obtener_facturas_bulk(receipt_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    {receipt_id: factura} de los ids facturados (los demás no aparecen).
+    Una sola llamada al backend para toda una página de ventas.
+    """
+    if DB_BACKEND == "sqlite":
+        return _sqlite().obtener_facturas_bulk(receipt_ids)
+    facturas = _load_db().get("facturas", {})
+    return {rid: facturas[rid] for rid in receipt_ids if rid in facturas}
+
+
 def esta_facturada(receipt_id: str) -> bool:
     return obtener_factura(receipt_id) is not None
 
 
 def guardar_factura(receipt_id: str, info: Dict[str, Any]) -> None:
+    info = _con_fecha_ord(info)
+    if DB_BACKEND == "sqlite":
+        _sqlite().guardar_factura(receipt_id, info)
+        _UPLOADER.marcar()
+        return
+    db = _load_db()
+    _persistir(db, "facturas", receipt_id, info)
+
+
+def _iterar_facturas_desc(desde_clave: tuple | None):
+    """(clave_orden, receipt_id, info) por cbte_nro descendente, empezando debajo de desde_clave."""
     db = _load_db()
-    db["facturas"][receipt_id] = info
-    _save_db(db)
+    clave = desde_clave
+    while True:
+        # Se vuelve a ubicar la posición en cada paso: tolera altas concurrentes
+        with _DB_LOCK:
+            i = bisect_left(_ORDEN_FACTURAS, clave) if clave is not None else len(_ORDEN_FACTURAS)
+            if i == 0:
+                return
+            clave = _ORDEN_FACTURAS[i - 1]
+            info = db["facturas"].get(clave[1])
+        if info is not None:
+            yield clave, clave[1], info
+
+
+def _facturas_en_rango(desde_ord: int | None, hasta_ord: int | None) -> set | None:
+    """receipt_ids del rango de fechas (bisect sobre el índice), o None si el rango es muy amplio."""
+    with _DB_LOCK:
+        lo = bisect_left(_FECHAS_FACTURAS, (desde_ord,)) if desde_ord is not None else 0
+        hi = bisect_left(_FECHAS_FACTURAS, (hasta_ord + 1,)) if hasta_ord is not None else len(_FECHAS_FACTURAS)
+        if hi - lo > len(_FECHAS_FACTURAS) * _FRACCION_CANDIDATAS:
+            return None
+        return {receipt_id for _, receipt_id in _FECHAS_FACTURAS[lo:hi]}
+
+
+def _facturas_de_cliente(q: str) -> set:
+    """receipt_ids cuyo nombre (en minúsculas), DNI o CUIT contiene q."""
+    with _DB_LOCK:
+        trigramas = _trigramas(q)
+        if trigramas:
+            conjuntos = sorted((_TRIGRAMAS_CLIENTE.get(tri, set()) for tri in trigramas), key=len)
+            textos = set.intersection(*conjuntos)
+        else:
+            # Búsquedas de 1-2 caracteres: se recorren los textos distintos, no las facturas
+            textos = _CLIENTE_FACTURAS.keys()
+        receipt_ids = set()
+        for texto in textos:
+            if q in texto:
+                receipt_ids |= _CLIENTE_FACTURAS[texto]
+        return receipt_ids
+
+
+def _iterar_candidatas(desde_clave: tuple | None, receipt_ids: set):
+    """Como _iterar_facturas_desc, pero sólo sobre las facturas candidatas."""
+    db = _load_db()
+    with _DB_LOCK:
+        facturas = db["facturas"]
+        candidatas = sorted(
+            ((_clave_orden(rid, facturas[rid]), rid, facturas[rid]) for rid in receipt_ids if rid in facturas),
+            reverse=True,
+        )
+    if desde_clave is not None:
+        candidatas = [c for c in candidatas if c[0] < desde_clave]
+    return iter(candidatas)
+
+
+def _parse_cursor(cursor: str) -> tuple:
+    """'cbte_nro:receipt_id' → (cbte_nro, receipt_id). ValueError si es inválido."""
+    cbte, receipt_id = cursor.split(":", 1)
+    return (int(cbte), receipt_id)
+
+
+def _coincide_factura(info: Dict[str, Any], desde_ord: int | None, hasta_ord: int | None,
+                      cliente: str | None, nro: str | None) -> bool:
+    if desde_ord is not None or hasta_ord is not None:
+        fecha_ord = info.get("fecha_ord")
+        if fecha_ord is None:
+            fecha_ord = _fecha_ord(info.get("fecha"))
+        if desde_ord is not None and fecha_ord < desde_ord:
+            return False
+        if hasta_ord is not None and fecha_ord > hasta_ord:
+            return False
+    if cliente:
+        q = cliente.lower()
+        if not (
+            q in (info.get("cliente_nombre", "Consumidor Final") or "").lower()
+            or q in (info.get("cliente_dni") or "")
+            or q in (info.get("cliente_cuit") or "")
+        ):
+            return False
+    if nro and str(info.get("cbte_nro")) != nro.strip():
+        return False
+    return True
+
+
+def buscar_facturas(desde: str | None = None, hasta: str | None = None,
+                    cliente: str | None = None, nro: str | None = None,
+                    limit: int | None = None, cursor: str | None = None):
+    """
+    Facturas por cbte_nro descendente, filtradas antes de armar la respuesta.
+    Devuelve ([(receipt_id, info), ...], next_cursor); next_cursor es None
+    cuando no hay más páginas.
+    """
+    desde_clave = _parse_cursor(cursor) if cursor else None
+    desde_ord = _fecha_ord(desde) if desde else None
+    hasta_ord = _fecha_ord(hasta) if hasta else None
+
+    if DB_BACKEND == "sqlite":
+        filas = _sqlite().iterar_facturas_desc(desde_clave, desde_ord, hasta_ord, cliente)
+    else:
+        _load_db()  # los índices se arman al cargar
+        candidatas = None
+        if desde_ord is not None or hasta_ord is not None:
+            candidatas = _facturas_en_rango(desde_ord, hasta_ord)
+        if cliente:
+            de_cliente = _facturas_de_cliente(cliente.lower())
+            candidatas = de_cliente if candidatas is None else candidatas & de_cliente
+        # Ordenar las candidatas cuesta ~len(candidatas); recorrer por cbte_nro
+        # hasta llenar la página cuesta ~limit * total / len(candidatas).
+        total = len(_ORDEN_FACTURAS)
+        if (
+            candidatas is not None
+            and len(candidatas) <= total * _FRACCION_CANDIDATAS
+            and not (limit and limit * total < len(candidatas) ** 2)
+        ):
+            filas = _iterar_candidatas(desde_clave, candidatas)
+        else:
+            filas = _iterar_facturas_desc(desde_clave)
+
+    resultado = []
+    for clave, receipt_id, info in filas:
+        if not _coincide_factura(info, desde_ord, hasta_ord, cliente, nro):
+            continue
+        resultado.append((receipt_id, info))
+        if limit and len(resultado) >= limit:
+            return resultado, f"{clave[0]}:{clave[1]}"
+    return resultado, None
 
 
 # -------------------------
 # NOTAS DE CRÉDITO (REEMBOLSOS)
 # -------------------------
 def obtener_nota_credito(refund_receipt_id: str) -> Optional[Dict[str, Any]]:
+    if DB_BACKEND == "sqlite":
+        return _sqlite().obtener_nota_credito(refund_receipt_id)
     db = _load_db()
     return db.get("notas_credito", {}).get(refund_receipt_id)
 
 
+def obtener_notas_credito_bulk(refund_receipt_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """{refund_receipt_id: nota_credito} de los reembolsos con NC emitida."""
+    if DB_BACKEND == "sqlite":
+        return _sqlite().obtener_notas_credito_bulk(refund_receipt_ids)
+    notas = _load_db().get("notas_credito", {})
+    return {rid: notas[rid] for rid in refund_receipt_ids if rid in notas}
+
+
 def nota_credito_emitida(refund_receipt_id: str) -> bool:
     return obtener_nota_credito(refund_receipt_id) is not None
 
 
 def guardar_nota_credito(refund_receipt_id: str, info: Dict[str, Any]) -> None:
+    info = _con_fecha_ord(info)
+    if DB_BACKEND == "sqlite":
+        _sqlite().guardar_nota_credito(refund_receipt_id, info)
+        _UPLOADER.marcar()
+        return
+    db = _load_db()
+    _persistir(db, "notas_credito", refund_receipt_id, info)
+
+
+def notas_credito_de_venta(sale_receipt_id: str) -> list:
+    """[(refund_receipt_id, info), ...] de las NC asociadas a una venta, en orden de alta."""
+    if DB_BACKEND == "sqlite":
+        return _sqlite().notas_credito_de_venta(sale_receipt_id)
     db = _load_db()
-    db["notas_credito"][refund_receipt_id] = info
-    _save_db(db)
+    notas = db["notas_credito"]
+    return [(refund_id, notas[refund_id]) for refund_id in _NC_POR_VENTA.get(sale_receipt_id, [])]
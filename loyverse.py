@@ -1,64 +1,291 @@
 # loyverse.py
 import httpx
 import os
-from datetime import datetime
+import time
+import random
+import asyncio
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
 
 BASE_URL = "https://api.loyverse.com/v1.0"
 TOKEN = os.environ.get("LOYVERSE_TOKEN")
 if not TOKEN:
     raise Exception("LOYVERSE_TOKEN no está definida en Environment Variables")
 
+LOYVERSE_MAX_CONEXIONES = int(os.environ.get("LOYVERSE_MAX_CONEXIONES", "20"))
+# Rangos largos de recibos: se parten en ventanas de N días que se bajan en paralelo
+LOYVERSE_RECEIPTS_VENTANA_DIAS = int(os.environ.get("LOYVERSE_RECEIPTS_VENTANA_DIAS", "7"))
+LOYVERSE_RECEIPTS_CONCURRENCIA = int(os.environ.get("LOYVERSE_RECEIPTS_CONCURRENCIA", "4"))
+# Reintentos de get_con_reintentos / paginar (listados de clientes, empleados, recibos)
+LOYVERSE_REINTENTOS = int(os.environ.get("LOYVERSE_REINTENTOS", "4"))
+BACKOFF_BASE = 0.5   # segundos
+BACKOFF_MAX = 30.0
 
-async def get_receipts_between(desde, hasta):
-    headers = {"Authorization": f"Bearer {TOKEN}"}
-    created_at_min = desde.strftime("%Y-%m-%dT00:00:00.000Z")
-    created_at_max = hasta.strftime("%Y-%m-%dT23:59:59.999Z")
 
-    all_receipts = []
-    cursor = None
+# ============================================================
+# CLIENTE HTTP COMPARTIDO
+#   Un solo httpx.AsyncClient para toda la app: reutiliza conexiones
+#   (keep-alive, y HTTP/2 si está instalado h2) en vez de abrir un
+#   cliente y un handshake TLS por llamada. Se crea y se cierra en el
+#   lifespan de main.py.
+# ============================================================
+_CLIENT: httpx.AsyncClient | None = None
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        while True:
-            url = (
-                f"{BASE_URL}/receipts?"
-                f"limit=250"
-                f"&created_at_min={created_at_min}"
-                f"&created_at_max={created_at_max}"
-                f"&expand=customer"
-            )
-            if cursor:
-                url += f"&cursor={cursor}"
-
-            r = await client.get(url, headers=headers)
-            if r.status_code != 200:
-                return {
-                    "error": "Loyverse devolvió error",
-                    "status": r.status_code,
-                    "body": r.text,
-                    "url": url,
-                }
-
-            data = r.json()
-            receipts = data.get("receipts", [])
-            all_receipts.extend(receipts)
-
-            cursor = data.get("cursor")
-            if not cursor or len(receipts) < 250:
-                break
 
-    return all_receipts
+def _crear_cliente() -> httpx.AsyncClient:
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+
+    return httpx.AsyncClient(
+        headers={"Authorization": f"Bearer {TOKEN}"},
+        timeout=30,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=LOYVERSE_MAX_CONEXIONES,
+            max_keepalive_connections=LOYVERSE_MAX_CONEXIONES,
+            keepalive_expiry=60,
+        ),
+    )
+
+
+async def iniciar_cliente() -> None:
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = _crear_cliente()
+
+
+async def cerrar_cliente() -> None:
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Cliente compartido. Fuera de la app (scripts) se crea en el primer uso."""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = _crear_cliente()
+    return _CLIENT
+
+
+# ============================================================
+# GET CON REINTENTOS
+#   429 (respetando Retry-After), 5xx y errores de red se reintentan
+#   hasta LOYVERSE_REINTENTOS veces con backoff + jitter
+# ============================================================
+def retry_after(r: httpx.Response) -> Optional[float]:
+    """Segundos indicados por Retry-After (número o fecha HTTP), si vino."""
+    valor = r.headers.get("Retry-After")
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(valor).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def backoff(intento: int) -> float:
+    # "Full jitter": evita que los workers reintenten todos juntos
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** intento)))
+
+
+async def get_con_reintentos(path: str, params: Dict[str, Any] | None = None) -> dict:
+    """JSON de GET BASE_URL + path. Si Loyverse sigue fallando, levanta."""
+    for intento in range(LOYVERSE_REINTENTOS + 1):
+        ultimo = intento == LOYVERSE_REINTENTOS
+        try:
+            r = await get_client().get(f"{BASE_URL}{path}", params=params)
+        except httpx.TransportError as e:
+            if ultimo:
+                raise Exception(f"Error de red pidiendo {path} a Loyverse: {e}")
+            await asyncio.sleep(backoff(intento))
+            continue
+
+        if r.status_code == 200:
+            return r.json()
+        if ultimo or (r.status_code != 429 and r.status_code < 500):
+            break
+        espera = retry_after(r) if r.status_code == 429 else None
+        await asyncio.sleep(espera if espera is not None else backoff(intento))
+    raise Exception(f"Loyverse devolvió {r.status_code} en {path}: {r.text[:200]}")
+
+
+async def paginar(path: str, params: Dict[str, Any], clave: str):
+    """Listas de data[clave] página por página, siguiendo el cursor."""
+    params = dict(params)
+    while True:
+        data = await get_con_reintentos(path, params)
+        items = data.get(clave, [])
+        yield items
+        cursor = data.get("cursor")
+        if not cursor or not items:
+            return
+        params["cursor"] = cursor
+
+
+async def esperar_en_curso(lock: asyncio.Lock) -> bool:
+    """
+    Si otra tarea tiene el lock (p. ej. una sincronización en curso), la
+    espera y devuelve True: alcanza con su resultado.
+    """
+    if not lock.locked():
+        return False
+    async with lock:
+        return True
 
 
-async def get_customer(customer_id: str):
-    headers = {"Authorization": f"Bearer {TOKEN}"}
-    url = f"{BASE_URL}/customers/{customer_id}"
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.get(url, headers=headers)
-        if r.status_code == 404:
-            return None
+def _ventanas(desde, hasta, dias: int) -> list:
+    """[(desde, hasta), ...] consecutivas de `dias` días que cubren el rango (inclusive)."""
+    ventanas = []
+    inicio = desde
+    while inicio <= hasta:
+        fin = min(hasta, inicio + timedelta(days=dias - 1))
+        ventanas.append((inicio, fin))
+        inicio = fin + timedelta(days=1)
+    return ventanas
+
+
+async def _paginas_ventana(created_at_min: str, created_at_max: str):
+    """
+    Páginas (listas de recibos) de una ventana, siguiendo el cursor. Si
+    Loyverse devuelve error, se emite el dict de error y termina.
+    """
+    client = get_client()
+    cursor = None
+
+    while True:
+        url = (
+            f"{BASE_URL}/receipts?"
+            f"limit=250"
+            f"&created_at_min={created_at_min}"
+            f"&created_at_max={created_at_max}"
+            f"&expand=customer"
+        )
+        if cursor:
+            url += f"&cursor={cursor}"
+
+        r = await client.get(url)
         if r.status_code != 200:
-            return None
-        return r.json()
+            yield {
+                "error": "Loyverse devolvió error",
+                "status": r.status_code,
+                "body": r.text,
+                "url": url,
+            }
+            return
+
+        data = r.json()
+        receipts = data.get("receipts", [])
+        yield receipts
+
+        cursor = data.get("cursor")
+        if not cursor or len(receipts) < 250:
+            return
+
+
+async def _receipts_ventana(created_at_min: str, created_at_max: str, semaforo: asyncio.Semaphore):
+    """Todos los recibos de una ventana. Lista de recibos o dict de error."""
+    receipts_ventana = []
+    async with semaforo:
+        async for pagina in _paginas_ventana(created_at_min, created_at_max):
+            if isinstance(pagina, dict):
+                return pagina
+            receipts_ventana.extend(pagina)
+    return receipts_ventana
+
+
+async def iterar_paginas_receipts(desde, hasta):
+    """
+    Páginas de recibos del rango a medida que llegan de Loyverse (ventanas en
+    paralelo, de la más nueva a la más vieja, sin orden garantizado entre
+    ventanas), sin repetir receipt_number. Si Loyverse falla se emite el
+    dict de error y termina.
+    """
+    ventanas = _ventanas(desde, hasta, LOYVERSE_RECEIPTS_VENTANA_DIAS)
+    semaforo = asyncio.Semaphore(LOYVERSE_RECEIPTS_CONCURRENCIA)
+    cola: asyncio.Queue = asyncio.Queue(maxsize=LOYVERSE_RECEIPTS_CONCURRENCIA * 2)
+
+    async def productor(inicio, fin):
+        try:
+            async with semaforo:
+                async for pagina in _paginas_ventana(
+                    inicio.strftime("%Y-%m-%dT00:00:00.000Z"),
+                    fin.strftime("%Y-%m-%dT23:59:59.999Z"),
+                ):
+                    await cola.put(("pagina", pagina))
+        except Exception as e:
+            await cola.put(("excepcion", e))
+        await cola.put(("fin", None))
+
+    tareas = [asyncio.create_task(productor(inicio, fin)) for inicio, fin in reversed(ventanas)]
+    pendientes = len(tareas)
+    vistos = set()
+    try:
+        while pendientes:
+            tipo, valor = await cola.get()
+            if tipo == "fin":
+                pendientes -= 1
+                continue
+            if tipo == "excepcion":
+                raise valor
+            if isinstance(valor, dict):
+                yield valor
+                return
+            nuevos = []
+            for r in valor:
+                numero = r.get("receipt_number")
+                if numero is not None:
+                    if numero in vistos:
+                        continue
+                    vistos.add(numero)
+                nuevos.append(r)
+            if nuevos:
+                yield nuevos
+    finally:
+        for tarea in tareas:
+            tarea.cancel()
+
+
+async def get_receipts_between(desde, hasta):
+    ventanas = _ventanas(desde, hasta, LOYVERSE_RECEIPTS_VENTANA_DIAS)
+    semaforo = asyncio.Semaphore(LOYVERSE_RECEIPTS_CONCURRENCIA)
+    resultados = await asyncio.gather(*[
+        _receipts_ventana(
+            inicio.strftime("%Y-%m-%dT00:00:00.000Z"),
+            fin.strftime("%Y-%m-%dT23:59:59.999Z"),
+            semaforo,
+        )
+        for inicio, fin in ventanas
+    ])
+
+    for resultado in resultados:
+        if not isinstance(resultado, list):
+            return resultado
+
+    # Loyverse devuelve cada ventana de más nuevo a más viejo: recorriendo las
+    # ventanas de la última a la primera se mantiene ese orden. Un recibo
+    # puede repetirse si cambia mientras se pagina; se deja la primera copia.
+    all_receipts = []
+    vistos = set()
+    for resultado in reversed(resultados):
+        for r in resultado:
+            numero = r.get("receipt_number")
+            if numero is not None:
+                if numero in vistos:
+                    continue
+                vistos.add(numero)
+            all_receipts.append(r)
+
+    return all_receipts
 
 
 def _clasificar_documento(customer: dict) -> tuple:
@@ -1,58 +1,60 @@
 # loyverse_api.py
-from datetime import date, datetime
-from collections import defaultdict
+import json
+from datetime import date
 
-import asyncio
-from fastapi import APIRouter, Query
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Query, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from loyverse import get_receipts_between, normalize_receipt, get_customer
-from json_db import obtener_factura, obtener_nota_credito
+from loyverse import iterar_paginas_receipts, normalize_receipt
+from loyverse_clientes import completar_clientes
+from receipts_mirror import leer_espejo, procesar_receipts_rango
+from refund_matcher import estado_sin_reembolsos, matchear_reembolsos
+from json_db import obtener_facturas_bulk, obtener_notas_credito_bulk
 
 router = APIRouter(prefix="/api", tags=["ventas"])
 
 
-def parse_fecha(fecha_str: str) -> datetime:
-    return datetime.fromisoformat(fecha_str.replace("Z", "+00:00"))
+def _notas_credito(refund_to_sale: dict) -> dict:
+    """NC emitidas de los reembolsos asociados a una venta (una consulta)."""
+    return obtener_notas_credito_bulk([ref_id for ref_id, sale_id in refund_to_sale.items() if sale_id])
+
+
+def _datos_reembolso(sale_id, nc) -> dict:
+    return {
+        "refund_status": "REFUND",
+        "refund_for": sale_id,
+        "already_invoiced": False,
+        "invoice": None,
+        "nota_credito": nc,
+    }
 
 
 @router.get("/ventas")
 async def listar_ventas(
+    response: Response,
     desde: date = Query(...),
     hasta: date = Query(...),
+    formato: str = Query("json"),
 ):
-    receipts_raw = await get_receipts_between(desde, hasta)
+    if formato == "ndjson":
+        return await _listar_ventas_ndjson(desde, hasta)
+
+    # FETCH CLIENTES FALTANTES (concurrencia acotada, reintentos ante 429):
+    # arranca con cada página de recibos, sin esperar a que llegue el rango entero
+    async def completar(pagina):
+        await completar_clientes(pagina)
+        return pagina
+
+    paginas, sincronizado = await procesar_receipts_rango(desde, hasta, completar)
+    if sincronizado:
+        response.headers["X-Datos-Sincronizados"] = sincronizado
 
-    if not isinstance(receipts_raw, list):
+    if not isinstance(paginas, list):
         return JSONResponse(
             status_code=500,
             content={"error": "Respuesta inválida de Loyverse"}
         )
-
-    # FETCH CLIENTES FALTANTES
-    customer_ids_faltantes = list({
-        r["customer_id"]
-        for r in receipts_raw
-        if r.get("customer_id") and not r.get("customer")
-    })
-
-    if customer_ids_faltantes:
-        clientes_fetched = await asyncio.gather(
-            *[get_customer(cid) for cid in customer_ids_faltantes]
-        )
-        clientes_map = {
-            cid: data
-            for cid, data in zip(customer_ids_faltantes, clientes_fetched)
-            if data is not None
-        }
-    else:
-        clientes_map = {}
-
-    for r in receipts_raw:
-        if r.get("customer_id") and not r.get("customer"):
-            cliente = clientes_map.get(r["customer_id"])
-            if cliente:
-                r["customer"] = cliente
+    receipts_raw = [r for pagina in paginas for r in pagina]
 
     # NORMALIZAR
     sales = []
@@ -65,116 +67,109 @@ async def listar_ventas(
         elif normalized["receipt_type"] == "REFUND":
             refunds.append(normalized)
 
-    # INDEXAR REEMBOLSOS POR PRODUCTO
-    refunds_by_product = defaultdict(list)
-    for refund in refunds:
-        for item in refund.get("items", []):
-            refunds_by_product[item["nombre"]].append(refund)
+    estados, refund_to_sale = matchear_reembolsos(sales, refunds)
 
-    # PROCESAR VENTAS y construir mapa refund_id → sale_id
-    refund_to_sale = {}
-    resultado = []
-
-    for sale in sales:
-        sale_date = parse_fecha(sale["fecha"])
-        total_refund = 0
-        refunded_items = []
-        remaining_items = []
-
-        for item in sale.get("items", []):
-            qty_left = item["cantidad"]
-            unit_price = item["precio_unitario"]
-            posibles = refunds_by_product.get(item["nombre"], [])
-
-            for ref in posibles:
-                ref_date = parse_fecha(ref["fecha"])
-                if ref_date <= sale_date:
-                    continue
-
-                for ref_item in ref.get("items", []):
-                    if ref_item["nombre"] != item["nombre"]:
-                        continue
-
-                    ref_qty = min(qty_left, ref_item["cantidad"])
-                    if ref_qty <= 0:
-                        continue
-
-                    importe = ref_qty * unit_price
-                    total_refund += importe
-                    qty_left -= ref_qty
-
-                    refunded_items.append({
-                        "nombre": item["nombre"],
-                        "cantidad": ref_qty,
-                        "importe": importe,
-                        "refund_receipt_id": ref["receipt_id"],
-                    })
-
-                    refund_to_sale[ref["receipt_id"]] = sale["receipt_id"]
-
-            if qty_left > 0:
-                remaining_items.append({
-                    "nombre": item["nombre"],
-                    "cantidad": qty_left,
-                    "precio_unitario": unit_price,
-                })
-
-        max_facturable = round(sale["total"] - total_refund, 2)
-
-        if total_refund == 0:
-            refund_status = "NONE"
-        elif max_facturable == 0:
-            refund_status = "TOTAL"
-        else:
-            refund_status = "PARTIAL"
-
-        factura = obtener_factura(sale["receipt_id"])
+    # Estado de facturación de todas las ventas en una sola consulta
+    facturas = obtener_facturas_bulk([sale["receipt_id"] for sale in sales])
 
+    resultado = []
+    for sale, estado in zip(sales, estados):
+        factura = facturas.get(sale["receipt_id"])
         sale.update({
-            "refunded_amount": total_refund,
-            "refund_status": refund_status,
-            "max_facturable": max_facturable,
-            "items_facturables": remaining_items,
-            "refunded_items": refunded_items,
+            **estado,
             "already_invoiced": factura is not None,
             "invoice": factura,
         })
-
         resultado.append(sale)
 
-    # SEGUNDO PASE: reembolsos sin match por items → cruzar por cliente_id + factura existente
-    for ref in refunds:
-        if ref["receipt_id"] in refund_to_sale:
-            continue
-
-        ref_date = parse_fecha(ref["fecha"])
-        ref_cliente = ref.get("cliente_id")
-        ref_total = ref.get("total", 0)
-
-        for sale in sales:
-            sale_date = parse_fecha(sale["fecha"])
-            if sale_date >= ref_date:
-                continue
-            if ref_cliente and sale.get("cliente_id") != ref_cliente:
-                continue
-            if sale.get("total", 0) < ref_total:
-                continue
-            refund_to_sale[ref["receipt_id"]] = sale["receipt_id"]
-            break
-
     # AGREGAR REEMBOLSOS CON refund_for
+    notas = _notas_credito(refund_to_sale)
     for ref in refunds:
-        sale_id = refund_to_sale.get(ref["receipt_id"])
-        nc = obtener_nota_credito(ref["receipt_id"]) if sale_id else None
-
-        ref.update({
-            "refund_status": "REFUND",
-            "refund_for": sale_id,
-            "already_invoiced": False,
-            "invoice": None,
-            "nota_credito": nc,
-        })
+        ref.update(_datos_reembolso(refund_to_sale.get(ref["receipt_id"]), notas.get(ref["receipt_id"])))
         resultado.append(ref)
 
     resultado.sort(key=lambda x: x["fecha"], reverse=True)
     return resultado
+
+
+# ============================================================
+# MODO STREAMING (formato=ndjson)
+#   Una línea JSON por evento, a medida que llegan las páginas de Loyverse:
+#     {"tipo": "venta" | "reembolso", "data": {...}}  fila normalizada, con los
+#                                                     campos de "sin reembolsos"
+#     {"tipo": "patch", "receipt_id": ..., "data": {...}}  al final, cambios del
+#                                                     cruce ventas ↔ reembolsos
+#     {"tipo": "error", ...}                          Loyverse falló a mitad
+#     {"tipo": "fin", "total": N}
+#   Las filas no vienen ordenadas por fecha: el cliente ordena.
+# ============================================================
+def _linea(evento: dict) -> bytes:
+    return (json.dumps(evento, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+async def _listar_ventas_ndjson(desde: date, hasta: date) -> StreamingResponse:
+    espejo = await leer_espejo(desde, hasta)
+    headers = {}
+    if espejo is not None and espejo[1]:
+        headers["X-Datos-Sincronizados"] = espejo[1]
+
+    async def paginas():
+        if espejo is not None:
+            receipts = espejo[0]
+            for i in range(0, len(receipts), 250):
+                yield receipts[i:i + 250]
+        else:
+            async for pagina in iterar_paginas_receipts(desde, hasta):
+                yield pagina
+
+    async def eventos():
+        sales = []
+        refunds = []
+        async for pagina in paginas():
+            if isinstance(pagina, dict):
+                yield _linea({"tipo": "error", "error": "Respuesta inválida de Loyverse", "detalle": pagina})
+                return
+
+            await completar_clientes(pagina)
+            normalizados = [normalize_receipt(r) for r in pagina]
+            facturas = obtener_facturas_bulk(
+                [n["receipt_id"] for n in normalizados if n["receipt_type"] == "SALE"]
+            )
+            for normalized in normalizados:
+                if normalized["receipt_type"] == "SALE":
+                    sales.append(normalized)
+                    factura = facturas.get(normalized["receipt_id"])
+                    fila = {
+                        **normalized,
+                        **estado_sin_reembolsos(normalized),
+                        "already_invoiced": factura is not None,
+                        "invoice": factura,
+                    }
+                    yield _linea({"tipo": "venta", "data": fila})
+                elif normalized["receipt_type"] == "REFUND":
+                    refunds.append(normalized)
+                    fila = {**normalized, **_datos_reembolso(None, None)}
+                    yield _linea({"tipo": "reembolso", "data": fila})
+
+        # Cruce con todas las filas ya enviadas: sólo viajan las diferencias.
+        # El cruce depende del orden, así que se usa el mismo que el modo json
+        # (más nuevo primero; el sort es estable dentro de cada ventana).
+        sales.sort(key=lambda x: x["fecha"], reverse=True)
+        refunds.sort(key=lambda x: x["fecha"], reverse=True)
+        estados, refund_to_sale = matchear_reembolsos(sales, refunds)
+        for sale, estado in zip(sales, estados):
+            if estado["refund_status"] != "NONE":
+                yield _linea({"tipo": "patch", "receipt_id": sale["receipt_id"], "data": estado})
+        notas = _notas_credito(refund_to_sale)
+        for ref in refunds:
+            sale_id = refund_to_sale.get(ref["receipt_id"])
+            if sale_id:
+                yield _linea({
+                    "tipo": "patch",
+                    "receipt_id": ref["receipt_id"],
+                    "data": {"refund_for": sale_id, "nota_credito": notas.get(ref["receipt_id"])},
+                })
+
+        yield _linea({"tipo": "fin", "total": len(sales) + len(refunds)})
+
+    return StreamingResponse(eventos(), media_type="application/x-ndjson", headers=headers)
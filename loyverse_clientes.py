@@ -0,0 +1,542 @@
+# loyverse_clientes.py
+# Descarga de clientes de Loyverse para los recibos que vienen sin
+# "customer" expandido. Reemplaza el asyncio.gather sin límite de
+# listar_ventas / resumen_admin:
+#   - como mucho LOYVERSE_CLIENTES_CONCURRENCIA pedidos a la vez (global,
+#     compartido entre requests: el rate limit de Loyverse es por token)
+#   - ante un 429 se respeta Retry-After y se frena a todos los workers
+#   - 429 / 5xx / errores de red se reintentan con backoff + jitter
+#   - métricas por lote (log + /api/admin/clientes/metricas)
+#   - caché TTL + LRU por customer_id, con dedup de pedidos concurrentes
+#     (single-flight) y persistencia opcional en disco
+#   - modo "bulk" (LOYVERSE_CLIENTES_MODO=bulk): tabla local de clientes
+#     sincronizada en segundo plano con /customers?updated_at_min=...; los
+#     requests completan clientes sin llamadas HTTP
+import os
+import json
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from loyverse import BASE_URL, backoff, esperar_en_curso, get_client, paginar, retry_after
+
+LOYVERSE_CLIENTES_CONCURRENCIA = int(os.environ.get("LOYVERSE_CLIENTES_CONCURRENCIA", "8"))
+LOYVERSE_CLIENTES_REINTENTOS = int(os.environ.get("LOYVERSE_CLIENTES_REINTENTOS", "4"))
+
+LOYVERSE_CLIENTES_TTL = float(os.environ.get("LOYVERSE_CLIENTES_TTL", str(6 * 3600)))
+LOYVERSE_CLIENTES_CACHE_MAX = int(os.environ.get("LOYVERSE_CLIENTES_CACHE_MAX", "5000"))
+# Vacío = sin persistencia (la caché arranca fría en cada reinicio)
+LOYVERSE_CLIENTES_CACHE_PATH = os.environ.get("LOYVERSE_CLIENTES_CACHE_PATH", "")
+# Los lotes marcan la caché como modificada; se escribe a disco como mucho
+# una vez cada N segundos, fuera del event loop
+LOYVERSE_CLIENTES_GUARDADO_SEG = float(os.environ.get("LOYVERSE_CLIENTES_GUARDADO_SEG", "30"))
+
+LOYVERSE_CLIENTES_MODO = os.environ.get("LOYVERSE_CLIENTES_MODO", "individual")  # "individual" | "bulk"
+LOYVERSE_CLIENTES_SYNC_SEG = float(os.environ.get("LOYVERSE_CLIENTES_SYNC_SEG", "300"))
+SYNC_A_DEMANDA_MIN_SEG = 30  # entre sincronizaciones disparadas por clientes desconocidos
+NO_ENCONTRADOS_MAX = 1000    # ids con 404 recordados (se descartan los más viejos)
+LOYVERSE_CLIENTES_TABLA_PATH = os.environ.get("LOYVERSE_CLIENTES_TABLA_PATH", "clientes_loyverse.json")
+
+_SEMAFORO = asyncio.Semaphore(LOYVERSE_CLIENTES_CONCURRENCIA)
+_PAUSA_HASTA = 0.0   # time.monotonic() hasta el que nadie pide (después de un 429)
+_ULTIMAS_METRICAS: Dict[str, Any] = {}
+
+
+# ============================================================
+# CACHÉ DE CLIENTES
+# ============================================================
+class CacheClientes:
+    """
+    TTL + LRU por customer_id. Se usa sólo desde el event loop, así que no
+    necesita locks; los misses concurrentes del mismo id comparten un único
+    pedido a Loyverse. Un cliente visto con un updated_at más nuevo (p. ej.
+    expandido en un recibo) reemplaza al cacheado.
+    """
+
+    def __init__(self, ttl: float, max_items: int, path: str = ""):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.path = path
+        self._datos: "OrderedDict[str, tuple]" = OrderedDict()  # customer_id → (guardado_ts, customer)
+        self._en_vuelo: Dict[str, asyncio.Future] = {}
+        self._cargado = False
+        self._sucio = False
+        self._version = 0          # instantáneas tomadas
+        self._version_escrita = 0  # última instantánea escrita a disco
+        self._lock_escritura = threading.Lock()
+        self.contadores = {
+            "hits": 0,
+            "misses": 0,
+            "compartidos": 0,
+            "expirados": 0,
+            "desalojados": 0,
+            "invalidados": 0,
+        }
+
+    def _vigente(self, customer_id: str) -> Optional[dict]:
+        entrada = self._datos.get(customer_id)
+        if entrada is None:
+            return None
+        guardado, customer = entrada
+        if time.time() - guardado > self.ttl:
+            del self._datos[customer_id]
+            self.contadores["expirados"] += 1
+            return None
+        self._datos.move_to_end(customer_id)
+        return customer
+
+    def _poner(self, customer_id: str, customer: dict) -> None:
+        self._datos[customer_id] = (time.time(), customer)
+        self._datos.move_to_end(customer_id)
+        self._sucio = True
+        while len(self._datos) > self.max_items:
+            self._datos.popitem(last=False)
+            self.contadores["desalojados"] += 1
+
+    def observar(self, customer: dict) -> None:
+        """Cliente obtenido por otra vía (recibo expandido, sync): actualiza la caché."""
+        self._cargar()
+        customer_id = customer.get("id")
+        if not customer_id:
+            return
+        entrada = self._datos.get(customer_id)
+        if entrada is not None:
+            nuevo = customer.get("updated_at") or ""
+            actual = entrada[1].get("updated_at") or ""
+            if nuevo < actual:
+                return
+            if nuevo == actual:
+                # Sin cambios: sólo se renueva el TTL
+                self._datos[customer_id] = (time.time(), entrada[1])
+                self._datos.move_to_end(customer_id)
+                return
+            self.contadores["invalidados"] += 1
+        self._poner(customer_id, customer)
+
+    async def obtener(self, customer_id: str, fetch) -> Optional[dict]:
+        self._cargar()
+        customer = self._vigente(customer_id)
+        if customer is not None:
+            self.contadores["hits"] += 1
+            return customer
+
+        en_vuelo = self._en_vuelo.get(customer_id)
+        if en_vuelo is not None:
+            self.contadores["compartidos"] += 1
+            return await en_vuelo
+
+        self.contadores["misses"] += 1
+        futuro = asyncio.get_running_loop().create_future()
+        self._en_vuelo[customer_id] = futuro
+        customer = None
+        try:
+            customer = await fetch(customer_id)
+            if customer is not None:
+                self._poner(customer_id, customer)
+            return customer
+        finally:
+            # Si el pedido falla o se cancela, los que esperaban reciben None
+            futuro.set_result(customer)
+            self._en_vuelo.pop(customer_id, None)
+
+    def _cargar(self) -> None:
+        if self._cargado:
+            return
+        self._cargado = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                datos = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Caché de clientes ilegible, se descarta: {e}")
+            return
+        ahora = time.time()
+        for customer_id, (guardado, customer) in sorted(datos.items(), key=lambda x: x[1][0]):
+            if ahora - guardado <= self.ttl:
+                self._datos[customer_id] = (guardado, customer)
+        print(f"DEBUG Loyverse clientes → caché cargada con {len(self._datos)} clientes")
+
+    def instantanea(self) -> Optional[tuple]:
+        """(versión, datos) a persistir, o None si no hay cambios. Desde el event loop."""
+        if not self.path or not self._sucio:
+            return None
+        self._sucio = False
+        self._version += 1
+        return self._version, {k: list(v) for k, v in self._datos.items()}
+
+    def escribir(self, version: int, datos: dict) -> None:
+        """Escribe una instantánea (puede correr en otro thread); nunca pisa una más nueva."""
+        with self._lock_escritura:
+            if version <= self._version_escrita:
+                return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(datos, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._version_escrita = version
+
+    def guardar(self) -> None:
+        instantanea = self.instantanea()
+        if instantanea is None:
+            return
+        try:
+            self.escribir(*instantanea)
+        except Exception:
+            self._sucio = True
+            raise
+
+    def estado(self) -> Dict[str, Any]:
+        consultas = self.contadores["hits"] + self.contadores["misses"] + self.contadores["compartidos"]
+        return {
+            **self.contadores,
+            "hit_ratio": round(self.contadores["hits"] / consultas, 3) if consultas else None,
+            "tamaño": len(self._datos),
+            "max": self.max_items,
+            "ttl_seg": self.ttl,
+            "persistida": bool(self.path),
+        }
+
+
+CACHE_CLIENTES = CacheClientes(
+    LOYVERSE_CLIENTES_TTL, LOYVERSE_CLIENTES_CACHE_MAX, LOYVERSE_CLIENTES_CACHE_PATH
+)
+
+
+_TAREA_GUARDADO: Optional[asyncio.Task] = None
+
+
+def guardar_cache_clientes() -> None:
+    """Guardado sincrónico (al apagar la app)."""
+    try:
+        CACHE_CLIENTES.guardar()
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar la caché de clientes: {e}")
+
+
+async def _guardar_diferido() -> None:
+    await asyncio.sleep(LOYVERSE_CLIENTES_GUARDADO_SEG)
+    instantanea = CACHE_CLIENTES.instantanea()
+    if instantanea is None:
+        return
+    try:
+        await asyncio.to_thread(CACHE_CLIENTES.escribir, *instantanea)
+    except Exception as e:
+        CACHE_CLIENTES._sucio = True
+        print(f"⚠️ No se pudo guardar la caché de clientes: {e}")
+
+
+def _programar_guardado() -> None:
+    """Agenda un guardado dentro de LOYVERSE_CLIENTES_GUARDADO_SEG, si no hay uno pendiente."""
+    global _TAREA_GUARDADO
+    if not CACHE_CLIENTES.path or not CACHE_CLIENTES._sucio:
+        return
+    if _TAREA_GUARDADO is not None and not _TAREA_GUARDADO.done():
+        return
+    _TAREA_GUARDADO = asyncio.get_running_loop().create_task(_guardar_diferido())
+
+
+# ============================================================
+# TABLA LOCAL DE CLIENTES (modo bulk)
+# ============================================================
+class TablaClientes:
+    """
+    Copia local de todos los clientes de Loyverse. La primera sincronización
+    pagina /customers completo; las siguientes piden sólo lo modificado
+    desde el updated_at más alto visto.
+    """
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.clientes: Dict[str, dict] = {}
+        self.updated_at_max = ""
+        self.ultima_sync: Optional[float] = None
+        self.ultimo_error: Optional[str] = None
+        self.no_encontrados: "OrderedDict[str, float]" = OrderedDict()  # customer_id → time.time() del 404
+        self._lock = asyncio.Lock()
+        self._cargado = False
+
+    def _cargar(self) -> None:
+        if self._cargado:
+            return
+        self._cargado = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                datos = json.load(f)
+            self.clientes = datos.get("clientes", {})
+            self.updated_at_max = datos.get("updated_at_max", "")
+            print(f"DEBUG Loyverse clientes → tabla local cargada con {len(self.clientes)} clientes")
+        except Exception as e:
+            print(f"⚠️ Tabla local de clientes ilegible, se sincroniza completa: {e}")
+            self.clientes, self.updated_at_max = {}, ""
+
+    def _escribir(self, updated_at_max: str, clientes: Dict[str, dict]) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"updated_at_max": updated_at_max, "clientes": clientes}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    async def guardar(self) -> None:
+        """Escribe la tabla a disco fuera del event loop (llamar con el lock tomado)."""
+        if not self.path:
+            return
+        # Copia del dict: los clientes se reemplazan, nunca se modifican
+        await asyncio.to_thread(self._escribir, self.updated_at_max, dict(self.clientes))
+
+    async def sincronizar(self) -> int:
+        """Trae los clientes nuevos o modificados. Devuelve cuántos cambiaron."""
+        self._cargar()
+        if await esperar_en_curso(self._lock):
+            return 0
+
+        async with self._lock:
+            params: Dict[str, Any] = {"limit": 250}
+            if self.updated_at_max:
+                params["updated_at_min"] = self.updated_at_max
+            # updated_at_min es inclusivo: el último cliente visto vuelve en
+            # cada sync, así que sólo cuenta (y se guarda) lo que cambió
+            cambios = 0
+            try:
+                async for customers in paginar("/customers", params, "customers"):
+                    for c in customers:
+                        if not c.get("id") or self.clientes.get(c["id"]) == c:
+                            continue
+                        self.clientes[c["id"]] = c
+                        self.updated_at_max = max(self.updated_at_max, c.get("updated_at") or "")
+                        cambios += 1
+            except Exception as e:
+                self.ultimo_error = str(e)
+                raise
+            finally:
+                if cambios:
+                    await self.guardar()
+
+            self.ultima_sync = time.time()
+            self.ultimo_error = None
+            print(f"DEBUG Loyverse clientes → sync: {cambios} clientes nuevos/modificados, {len(self.clientes)} en tabla")
+            return cambios
+
+    def marcar_no_encontrado(self, customer_id: str) -> None:
+        """Loyverse respondió 404 (p. ej. cliente borrado): no se reintenta por un rato."""
+        ahora = time.time()
+        self.no_encontrados.pop(customer_id, None)
+        self.no_encontrados[customer_id] = ahora
+        # Orden de inserción = orden de 404: los vencidos y los excedentes están al principio
+        while self.no_encontrados:
+            customer_id, marcado = next(iter(self.no_encontrados.items()))
+            if ahora - marcado <= LOYVERSE_CLIENTES_SYNC_SEG and len(self.no_encontrados) <= NO_ENCONTRADOS_MAX:
+                break
+            del self.no_encontrados[customer_id]
+
+    def no_encontrado_reciente(self, customer_id: str) -> bool:
+        marcado = self.no_encontrados.get(customer_id)
+        if marcado is None:
+            return False
+        if time.time() - marcado > LOYVERSE_CLIENTES_SYNC_SEG:
+            del self.no_encontrados[customer_id]
+            return False
+        return True
+
+    def estado(self) -> Dict[str, Any]:
+        return {
+            "clientes": len(self.clientes),
+            "updated_at_max": self.updated_at_max or None,
+            "ultima_sync": self.ultima_sync,
+            "ultimo_error": self.ultimo_error,
+        }
+
+
+TABLA_CLIENTES = TablaClientes(LOYVERSE_CLIENTES_TABLA_PATH)
+_TAREA_SYNC: Optional[asyncio.Task] = None
+
+
+async def _loop_sync_clientes() -> None:
+    while True:
+        try:
+            await TABLA_CLIENTES.sincronizar()
+        except Exception as e:
+            print(f"⚠️ Loyverse → falló la sincronización de clientes: {e}")
+        await asyncio.sleep(LOYVERSE_CLIENTES_SYNC_SEG)
+
+
+def iniciar_sync_clientes() -> None:
+    """En modo bulk, lanza la sincronización periódica (llamar desde el event loop)."""
+    global _TAREA_SYNC
+    if LOYVERSE_CLIENTES_MODO != "bulk" or _TAREA_SYNC is not None:
+        return
+    _TAREA_SYNC = asyncio.get_running_loop().create_task(_loop_sync_clientes())
+
+
+async def detener_sync_clientes() -> None:
+    global _TAREA_SYNC
+    if _TAREA_SYNC is None:
+        return
+    _TAREA_SYNC.cancel()
+    try:
+        await _TAREA_SYNC
+    except asyncio.CancelledError:
+        pass
+    _TAREA_SYNC = None
+
+
+async def _clientes_de_tabla(customer_ids: List[str]) -> Dict[str, dict]:
+    tabla = TABLA_CLIENTES
+    ahora = time.time()
+    # Los que dieron 404 hace poco no se vuelven a buscar (p. ej. clientes borrados)
+    customer_ids = [cid for cid in customer_ids if not tabla.no_encontrado_reciente(cid)]
+
+    faltantes = [cid for cid in customer_ids if cid not in tabla.clientes]
+    reciente = tabla.ultima_sync is not None and ahora - tabla.ultima_sync < SYNC_A_DEMANDA_MIN_SEG
+    if faltantes and not reciente:
+        # Clientes dados de alta después de la última sincronización
+        try:
+            await tabla.sincronizar()
+        except Exception as e:
+            print(f"⚠️ Loyverse → falló la sincronización de clientes: {e}")
+
+    clientes_map = {cid: tabla.clientes[cid] for cid in customer_ids if cid in tabla.clientes}
+    restantes = [cid for cid in customer_ids if cid not in clientes_map]
+    if restantes:
+        # Los 404 los registra _fetch_cliente; un 429 / 5xx / error de red
+        # no marca al cliente y se vuelve a pedir en el próximo request
+        clientes_map.update(await get_customers(restantes))
+    return clientes_map
+
+
+# ============================================================
+# DESCARGA CON CONCURRENCIA ACOTADA
+# ============================================================
+async def _esperar_pausa() -> None:
+    espera = _PAUSA_HASTA - time.monotonic()
+    if espera > 0:
+        await asyncio.sleep(espera)
+
+
+async def _fetch_cliente(customer_id: str, metricas: Dict[str, Any]) -> Optional[dict]:
+    global _PAUSA_HASTA
+    url = f"{BASE_URL}/customers/{customer_id}"
+
+    for intento in range(LOYVERSE_CLIENTES_REINTENTOS + 1):
+        if intento:
+            metricas["reintentos"] += 1
+
+        async with _SEMAFORO:
+            await _esperar_pausa()
+            # Mientras esperaba turno pudo llegar expandido en otra página de
+            # recibos (completar_clientes por página): no hace falta pedirlo
+            cacheado = CACHE_CLIENTES._vigente(customer_id)
+            if cacheado is not None:
+                metricas["observados_en_espera"] += 1
+                return cacheado
+            try:
+                r = await get_client().get(url)
+            except httpx.TransportError as e:
+                print(f"⚠️ Loyverse → error de red pidiendo cliente {customer_id}: {e}")
+                r = None
+
+        if r is not None:
+            if r.status_code == 200:
+                metricas["ok"] += 1
+                return r.json()
+            if r.status_code == 404:
+                metricas["no_encontrados"] += 1
+                TABLA_CLIENTES.marcar_no_encontrado(customer_id)
+                return None
+            if r.status_code == 429:
+                metricas["rate_limited"] += 1
+                espera = retry_after(r)
+                if espera is None:
+                    espera = backoff(intento)
+                # Se frena a todos los workers, no sólo a este
+                _PAUSA_HASTA = max(_PAUSA_HASTA, time.monotonic() + espera)
+                metricas["espera_seg"] += espera
+                continue
+            if r.status_code < 500:
+                print(f"⚠️ Loyverse → cliente {customer_id}: status {r.status_code}")
+                break
+
+        espera = backoff(intento)
+        metricas["espera_seg"] += espera
+        await asyncio.sleep(espera)
+
+    metricas["fallidos"] += 1
+    metricas["ids_fallidos"].append(customer_id)
+    return None
+
+
+async def get_customers(customer_ids: List[str]) -> Dict[str, dict]:
+    """{customer_id: customer} de los clientes que se pudieron obtener."""
+    metricas = {
+        "solicitados": len(customer_ids),
+        "ok": 0,
+        "no_encontrados": 0,
+        "fallidos": 0,
+        "reintentos": 0,
+        "rate_limited": 0,
+        "espera_seg": 0.0,
+        "observados_en_espera": 0,
+        "ids_fallidos": [],
+    }
+    hits_antes = CACHE_CLIENTES.contadores["hits"]
+    inicio = time.monotonic()
+    clientes = await asyncio.gather(*[
+        CACHE_CLIENTES.obtener(cid, lambda c: _fetch_cliente(c, metricas))
+        for cid in customer_ids
+    ])
+    metricas["cache_hits"] = CACHE_CLIENTES.contadores["hits"] - hits_antes
+    metricas["espera_seg"] = round(metricas["espera_seg"], 2)
+    metricas["duracion_seg"] = round(time.monotonic() - inicio, 2)
+    _programar_guardado()
+
+    _ULTIMAS_METRICAS.clear()
+    _ULTIMAS_METRICAS.update(metricas)
+    print(
+        f"DEBUG Loyverse clientes → {metricas['solicitados']} pedidos, {metricas['cache_hits']} en caché, {metricas['ok']} ok, "
+        f"{metricas['no_encontrados']} no encontrados, {metricas['fallidos']} fallidos, "
+        f"{metricas['reintentos']} reintentos ({metricas['rate_limited']} por 429), "
+        f"{metricas['duracion_seg']}s"
+    )
+    return {cid: data for cid, data in zip(customer_ids, clientes) if data is not None}
+
+
+async def completar_clientes(receipts_raw: List[dict]) -> None:
+    """Agrega r["customer"] a los recibos que traen customer_id sin el cliente expandido."""
+    for r in receipts_raw:
+        if r.get("customer"):
+            CACHE_CLIENTES.observar(r["customer"])
+
+    customer_ids_faltantes = list({
+        r["customer_id"]
+        for r in receipts_raw
+        if r.get("customer_id") and not r.get("customer")
+    })
+    if not customer_ids_faltantes:
+        return
+
+    if LOYVERSE_CLIENTES_MODO == "bulk":
+        clientes_map = await _clientes_de_tabla(customer_ids_faltantes)
+    else:
+        clientes_map = await get_customers(customer_ids_faltantes)
+    for r in receipts_raw:
+        if r.get("customer_id") and not r.get("customer"):
+            cliente = clientes_map.get(r["customer_id"])
+            if cliente:
+                r["customer"] = cliente
+
+
+def ultimas_metricas() -> Dict[str, Any]:
+    return dict(_ULTIMAS_METRICAS)
+
+
+def estado_cache() -> Dict[str, Any]:
+    estado = CACHE_CLIENTES.estado()
+    estado["modo"] = LOYVERSE_CLIENTES_MODO
+    if LOYVERSE_CLIENTES_MODO == "bulk":
+        estado["tabla"] = TABLA_CLIENTES.estado()
+    return estado
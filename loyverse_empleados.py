@@ -0,0 +1,77 @@
+# loyverse_empleados.py
+# Directorio de empleados de Loyverse (employee_id → nombre) para el dashboard.
+# Reemplaza el /employees?limit=250 que se pedía en cada /api/admin/resumen:
+#   - se carga la primera vez que se necesita y se refresca cada
+#     LOYVERSE_EMPLEADOS_TTL segundos, paginando /employees con cursor
+#   - un employee_id desconocido (empleado nuevo) fuerza un refresco, como
+#     mucho uno cada REFRESCO_MIN_SEG
+#   - si Loyverse falla se sigue usando el último directorio
+import os
+import time
+import asyncio
+from typing import Any, Dict, Iterable, Optional
+
+from loyverse import esperar_en_curso, paginar
+
+LOYVERSE_EMPLEADOS_TTL = float(os.environ.get("LOYVERSE_EMPLEADOS_TTL", "3600"))
+REFRESCO_MIN_SEG = 30  # entre refrescos por vencimiento o por ids desconocidos
+
+
+class DirectorioEmpleados:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.nombres: Dict[str, str] = {}
+        self.cargado: Optional[float] = None         # time.time() de la última carga completa
+        self.ultimo_intento: Optional[float] = None
+        self.ultimo_error: Optional[str] = None
+        self._lock = asyncio.Lock()
+
+    async def refrescar(self) -> None:
+        """Vuelve a bajar el directorio completo (todas las páginas)."""
+        if await esperar_en_curso(self._lock):
+            return
+
+        async with self._lock:
+            self.ultimo_intento = time.time()
+            nombres = {}
+            try:
+                async for empleados in paginar("/employees", {"limit": 250}, "employees"):
+                    for e in empleados:
+                        nombres[e["id"]] = f"{e.get('first_name', '')} {e.get('last_name', '')}".strip() or "Sin nombre"
+            except Exception as e:
+                self.ultimo_error = str(e)
+                raise
+
+            self.nombres = nombres
+            self.cargado = time.time()
+            self.ultimo_error = None
+            print(f"DEBUG Loyverse empleados → directorio cargado: {len(nombres)} empleados")
+
+    async def nombres_para(self, employee_ids: Iterable[str] = ()) -> Dict[str, str]:
+        """
+        {employee_id: nombre}. Refresca antes de responder si el directorio
+        venció o si aparece algún id que no conoce.
+        """
+        await esperar_en_curso(self._lock)
+
+        ahora = time.time()
+        vencido = self.cargado is None or ahora - self.cargado > self.ttl
+        desconocidos = any(eid and eid not in self.nombres for eid in employee_ids)
+        reciente = self.ultimo_intento is not None and ahora - self.ultimo_intento < REFRESCO_MIN_SEG
+        if (vencido or desconocidos) and not reciente:
+            try:
+                await self.refrescar()
+            except Exception as e:
+                print(f"⚠️ Loyverse → falló la carga de empleados, se usa el directorio anterior: {e}")
+        return self.nombres
+
+    def estado(self) -> Dict[str, Any]:
+        return {
+            "empleados": len(self.nombres),
+            "cargado": self.cargado,
+            "ultimo_intento": self.ultimo_intento,
+            "ultimo_error": self.ultimo_error,
+        }
+
+
+DIRECTORIO_EMPLEADOS = DirectorioEmpleados(LOYVERSE_EMPLEADOS_TTL)
@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from loyverse_api import router as ventas_router
@@ -6,8 +7,32 @@ from email_api import router as email_router
 from nota_credito_api import router as nota_credito_router
 from facturas_api import router as facturas_router
 from admin_api import router as admin_router
+from afip import cerrar_wsfe_client, iniciar_renovacion_wsaa, detener_renovacion_wsaa
+from json_db import estado_backup, flush_backup
+from loyverse import BASE_URL, get_client, iniciar_cliente, cerrar_cliente
+from loyverse_clientes import guardar_cache_clientes, iniciar_sync_clientes, detener_sync_clientes
+from receipts_mirror import iniciar_sync_receipts, detener_sync_receipts
+from sqlite_db import cerrar as cerrar_sqlite
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    iniciar_renovacion_wsaa()
+    await iniciar_cliente()
+    iniciar_sync_clientes()
+    iniciar_sync_receipts()
+    yield
+    await detener_sync_receipts()
+    await detener_sync_clientes()
+    await cerrar_cliente()
+    guardar_cache_clientes()
+    detener_renovacion_wsaa()
+    cerrar_wsfe_client()
+    flush_backup()
+    cerrar_sqlite()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,6 +40,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Datos-Sincronizados"],
 )
 
 app.include_router(ventas_router)
@@ -24,6 +50,7 @@ app.include_router(nota_credito_router)
 app.include_router(facturas_router)
 app.include_router(admin_router)
 
+
 @app.get("/")
 def root():
     return {"status": "ok"}
@@ -32,12 +59,12 @@ def root():
 def health():
     return {"status": "ok"}
 
+@app.get("/health/backup")
+def health_backup():
+    return estado_backup()
+
 @app.get("/debug/recibo/{receipt_id}")
 async def debug_recibo(receipt_id: str):
-    import httpx
-    import os
-    token = os.environ.get("LOYVERSE_TOKEN")
-    url = f"https://api.loyverse.com/v1.0/receipts?receipt_number={receipt_id}&expand=customer"
-    async with httpx.AsyncClient() as client:
-        r = await client.get(url, headers={"Authorization": f"Bearer {token}"})
-        return r.json()
+    url = f"{BASE_URL}/receipts?receipt_number={receipt_id}&expand=customer"
+    r = await get_client().get(url)
+    return r.json()
@@ -8,7 +8,7 @@ router = APIRouter(prefix="/api", tags=["nota_credito"])
 
 
 @router.post("/nota_credito")
-async def emitir_nota_credito(payload: dict):
+def emitir_nota_credito(payload: dict):
     """
     Payload esperado desde frontend:
     {
@@ -0,0 +1,408 @@
+# receipts_mirror.py
+# Espejo local (SQLite) de los recibos de Loyverse: LOYVERSE_RECEIPTS_MODO=espejo.
+# En vez de bajar todo el rango pedido en cada /api/ventas o /api/admin/resumen:
+#   - la primera sincronización baja los últimos LOYVERSE_RECEIPTS_DIAS_INICIALES días
+#   - las siguientes piden sólo lo modificado (updated_at_min + cursor)
+#   - los endpoints leen el rango de la base local
+# Si el rango pedido es anterior a lo que cubre el espejo, o la sincronización
+# en segundo plano todavía no terminó nunca o quedó atrasada, se consulta a
+# Loyverse directo como antes (los requests nunca esperan una sincronización).
+#
+# Además guarda un rollup por día UTC (ver admin_metricas) para el dashboard:
+# cada sync recalcula los días que tocó y /api/admin/resumen combina los
+# rollups del rango. El día en curso se calcula en vivo desde los recibos.
+# Al facturar una venta se recalcula su día (marcar_facturada).
+import os
+import json
+import asyncio
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from admin_metricas import rollup_de_receipts
+from loyverse import esperar_en_curso, iterar_paginas_receipts, paginar
+
+LOYVERSE_RECEIPTS_MODO = os.environ.get("LOYVERSE_RECEIPTS_MODO", "directo")  # "directo" | "espejo"
+RECEIPTS_DB_PATH = os.environ.get("LOYVERSE_RECEIPTS_DB_PATH", "receipts_mirror.sqlite3")
+DIAS_INICIALES = int(os.environ.get("LOYVERSE_RECEIPTS_DIAS_INICIALES", "400"))
+SYNC_SEG = float(os.environ.get("LOYVERSE_RECEIPTS_SYNC_SEG", "60"))
+# Si al leer la última sync es más vieja que esto, se lee directo de Loyverse
+MAX_EDAD_SEG = float(os.environ.get("LOYVERSE_RECEIPTS_MAX_EDAD_SEG", "120"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    receipt_number TEXT PRIMARY KEY,
+    created_at     TEXT,
+    updated_at     TEXT,
+    data           TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_receipts_created_at ON receipts(created_at);
+
+CREATE TABLE IF NOT EXISTS rollups (
+    dia  TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    clave TEXT PRIMARY KEY,
+    valor TEXT
+);
+"""
+
+_UPSERT_RECEIPT = """
+INSERT OR REPLACE INTO receipts (receipt_number, created_at, updated_at, data)
+VALUES (?, ?, ?, ?)
+"""
+
+# Formato de los rollups guardados: si cambia, se recalculan todos
+_ROLLUPS_VERSION = "2"
+
+_CONN: sqlite3.Connection | None = None
+_LOCK = threading.RLock()
+# Un recálculo de rollups a la vez: el que lee la DB de facturas después
+# es el que escribe después
+_ROLLUPS_LOCK = threading.Lock()
+_SYNC_LOCK: asyncio.Lock | None = None
+_TAREA_SYNC: Optional[asyncio.Task] = None
+_ULTIMO_ERROR: Optional[str] = None
+
+
+def _iso(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+# -------------------------
+# BASE LOCAL
+# -------------------------
+def _conectar() -> sqlite3.Connection:
+    global _CONN
+    with _LOCK:
+        if _CONN is None:
+            conn = sqlite3.connect(RECEIPTS_DB_PATH, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            _CONN = conn
+        return _CONN
+
+
+def _meta(clave: str) -> Optional[str]:
+    conn = _conectar()
+    with _LOCK:
+        fila = conn.execute("SELECT valor FROM meta WHERE clave = ?", (clave,)).fetchone()
+    return fila[0] if fila else None
+
+
+def _guardar(receipts: List[dict], meta: Dict[str, str]) -> None:
+    """Upsert de una página de recibos + avance de la marca, en una transacción."""
+    conn = _conectar()
+    with _LOCK:
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(_UPSERT_RECEIPT, [
+                (r["receipt_number"], r.get("created_at"), r.get("updated_at"), json.dumps(r, ensure_ascii=False))
+                for r in receipts
+                if r.get("receipt_number")
+            ])
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (clave, valor) VALUES (?, ?)", list(meta.items())
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def _leer_rango(created_at_min: str, created_at_max: str) -> List[dict]:
+    conn = _conectar()
+    with _LOCK:
+        filas = conn.execute(
+            "SELECT data FROM receipts WHERE created_at BETWEEN ? AND ? ORDER BY created_at DESC",
+            (created_at_min, created_at_max),
+        ).fetchall()
+    return [json.loads(data) for (data,) in filas]
+
+
+def _actualizar_rollups(dias: set) -> None:
+    """
+    Recalcula el rollup de los días UTC indicados ("YYYY-MM-DD") desde los
+    recibos guardados. La primera vez (o si cambió el formato) recalcula
+    todos los días del espejo.
+    """
+    conn = _conectar()
+    with _ROLLUPS_LOCK:
+        if _meta("rollups_completos") != _ROLLUPS_VERSION:
+            with _LOCK:
+                conn.execute("DELETE FROM rollups")
+                dias = {
+                    dia for (dia,) in conn.execute(
+                        "SELECT DISTINCT substr(created_at, 1, 10) FROM receipts WHERE created_at IS NOT NULL"
+                    )
+                }
+        elif not dias:
+            return
+
+        filas = []
+        for dia in sorted(dias):
+            receipts = _leer_rango(f"{dia}T00:00:00.000Z", f"{dia}T23:59:59.999Z")
+            filas.append((dia, json.dumps(rollup_de_receipts(receipts), ensure_ascii=False)))
+
+        with _LOCK:
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO rollups (dia, data) VALUES (?, ?)", filas)
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (clave, valor) VALUES ('rollups_completos', ?)",
+                    (_ROLLUPS_VERSION,),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+
+def marcar_facturada(receipt_id: str) -> None:
+    """
+    Recalcula el rollup del día de una venta recién facturada (llamar después
+    de guardar la factura). Si la venta todavía no está en el espejo, la sync
+    que la traiga calcula su día con la factura ya guardada. No lanza: la
+    factura ya está emitida.
+    """
+    if LOYVERSE_RECEIPTS_MODO != "espejo":
+        return
+    try:
+        if _meta("rollups_completos") != _ROLLUPS_VERSION:
+            return
+        conn = _conectar()
+        with _LOCK:
+            fila = conn.execute(
+                "SELECT created_at FROM receipts WHERE receipt_number = ?", (receipt_id,)
+            ).fetchone()
+        if fila and fila[0]:
+            _actualizar_rollups({fila[0][:10]})
+    except Exception as e:
+        print(f"⚠️ receipts_mirror → no se pudo recalcular el rollup de {receipt_id}: {e}")
+
+
+def _leer_rollups(dia_min: str, dia_max: str) -> List[dict]:
+    """Rollups guardados entre dos días (inclusive), del más nuevo al más viejo."""
+    conn = _conectar()
+    with _LOCK:
+        filas = conn.execute(
+            "SELECT data FROM rollups WHERE dia BETWEEN ? AND ? ORDER BY dia DESC",
+            (dia_min, dia_max),
+        ).fetchall()
+    return [json.loads(data) for (data,) in filas]
+
+
+# -------------------------
+# SINCRONIZACIÓN
+# -------------------------
+async def sincronizar() -> int:
+    """
+    Trae los recibos nuevos o modificados desde la última sincronización.
+    Devuelve cuántos llegaron.
+    """
+    global _SYNC_LOCK, _ULTIMO_ERROR
+    if _SYNC_LOCK is None:
+        _SYNC_LOCK = asyncio.Lock()
+    if await esperar_en_curso(_SYNC_LOCK):
+        return 0
+
+    async with _SYNC_LOCK:
+        updated_at_max = await asyncio.to_thread(_meta, "updated_at_max")
+        cubre_desde = await asyncio.to_thread(_meta, "cubre_desde")
+        inicio = datetime.now(timezone.utc)
+
+        params: Dict[str, Any] = {"limit": 250, "expand": "customer"}
+        if updated_at_max and cubre_desde:
+            params["updated_at_min"] = updated_at_max
+        else:
+            # Primera vez: últimos DIAS_INICIALES días
+            cubre_desde = (inicio - timedelta(days=DIAS_INICIALES)).strftime("%Y-%m-%d")
+            params["created_at_min"] = f"{cubre_desde}T00:00:00.000Z"
+            updated_at_max = ""
+
+        recibidos = 0
+        dias = set()
+        try:
+            async for receipts in paginar("/receipts", params, "receipts"):
+                for r in receipts:
+                    updated_at_max = max(updated_at_max, r.get("updated_at") or "")
+                    if r.get("created_at"):
+                        dias.add(r["created_at"][:10])
+                recibidos += len(receipts)
+                await asyncio.to_thread(_guardar, receipts, {})
+
+            # Las marcas avanzan sólo al terminar la cadena: si se corta a
+            # mitad, la próxima sync repite desde la marca anterior
+            await asyncio.to_thread(_guardar, [], {
+                "updated_at_max": updated_at_max,
+                "cubre_desde": cubre_desde,
+                "ultima_sync": _iso(inicio),
+            })
+            await asyncio.to_thread(_actualizar_rollups, dias)
+        except Exception as e:
+            _ULTIMO_ERROR = str(e)
+            raise
+
+        _ULTIMO_ERROR = None
+        print(f"DEBUG receipts_mirror → sync: {recibidos} recibos nuevos/modificados")
+        return recibidos
+
+
+async def _loop_sync() -> None:
+    while True:
+        try:
+            await sincronizar()
+        except Exception as e:
+            print(f"⚠️ receipts_mirror → falló la sincronización: {e}")
+        await asyncio.sleep(SYNC_SEG)
+
+
+def iniciar_sync_receipts() -> None:
+    """En modo espejo, lanza la sincronización periódica (llamar desde el event loop)."""
+    global _TAREA_SYNC
+    if LOYVERSE_RECEIPTS_MODO != "espejo" or _TAREA_SYNC is not None:
+        return
+    _TAREA_SYNC = asyncio.get_running_loop().create_task(_loop_sync())
+
+
+async def detener_sync_receipts() -> None:
+    global _TAREA_SYNC
+    if _TAREA_SYNC is None:
+        return
+    _TAREA_SYNC.cancel()
+    try:
+        await _TAREA_SYNC
+    except asyncio.CancelledError:
+        pass
+    _TAREA_SYNC = None
+
+
+def _edad_seg(ultima_sync: Optional[str]) -> Optional[float]:
+    if not ultima_sync:
+        return None
+    dt = datetime.strptime(ultima_sync, "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - dt).total_seconds()
+
+
+def estado() -> Dict[str, Any]:
+    if LOYVERSE_RECEIPTS_MODO != "espejo":
+        return {"modo": LOYVERSE_RECEIPTS_MODO}
+    conn = _conectar()
+    with _LOCK:
+        cantidad = conn.execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+    ultima_sync = _meta("ultima_sync")
+    edad = _edad_seg(ultima_sync)
+    return {
+        "modo": LOYVERSE_RECEIPTS_MODO,
+        "recibos": cantidad,
+        "cubre_desde": _meta("cubre_desde"),
+        "ultima_sync": ultima_sync,
+        "edad_seg": round(edad) if edad is not None else None,
+        "ultimo_error": _ULTIMO_ERROR,
+    }
+
+
+# -------------------------
+# LECTURA
+# -------------------------
+async def _espejo_cubre(desde) -> bool:
+    """
+    Dice si el espejo puede responder un rango que empieza en desde. False en
+    modo directo, rango no cubierto, o si la sincronización en segundo plano
+    nunca terminó o está atrasada: no se sincroniza en el request.
+    """
+    if LOYVERSE_RECEIPTS_MODO != "espejo":
+        return False
+
+    edad = _edad_seg(await asyncio.to_thread(_meta, "ultima_sync"))
+    if edad is None or edad > MAX_EDAD_SEG:
+        print("DEBUG receipts_mirror → espejo sin sincronizar o atrasado, se consulta a Loyverse")
+        return False
+
+    cubre_desde = await asyncio.to_thread(_meta, "cubre_desde")
+    if not cubre_desde or desde.strftime("%Y-%m-%d") < cubre_desde:
+        print("DEBUG receipts_mirror → rango fuera del espejo, se consulta a Loyverse")
+        return False
+    return True
+
+
+async def leer_espejo(desde, hasta):
+    """
+    (receipts, ultima_sync) del rango leídos del espejo, o None si hay que ir
+    a Loyverse directo (ver _espejo_cubre).
+    """
+    if not await _espejo_cubre(desde):
+        return None
+
+    receipts = await asyncio.to_thread(
+        _leer_rango,
+        desde.strftime("%Y-%m-%dT00:00:00.000Z"),
+        hasta.strftime("%Y-%m-%dT23:59:59.999Z"),
+    )
+    return receipts, await asyncio.to_thread(_meta, "ultima_sync")
+
+
+async def leer_rollups(desde, hasta):
+    """
+    (rollups, ultima_sync) de los días del rango, del más nuevo al más viejo,
+    o None si el espejo no puede responder (ver leer_espejo). Los días desde
+    hoy (UTC) se agregan en vivo desde los recibos.
+    """
+    if not await _espejo_cubre(desde):
+        return None
+    if await asyncio.to_thread(_meta, "rollups_completos") != _ROLLUPS_VERSION:
+        return None
+
+    hoy = datetime.now(timezone.utc).date()
+    rollups = []
+    if hasta >= hoy:
+        receipts = await asyncio.to_thread(
+            _leer_rango,
+            max(desde, hoy).strftime("%Y-%m-%dT00:00:00.000Z"),
+            hasta.strftime("%Y-%m-%dT23:59:59.999Z"),
+        )
+        rollups.append(rollup_de_receipts(receipts))
+    if desde < hoy:
+        rollups.extend(await asyncio.to_thread(
+            _leer_rollups,
+            desde.strftime("%Y-%m-%d"),
+            min(hasta, hoy - timedelta(days=1)).strftime("%Y-%m-%d"),
+        ))
+    return rollups, await asyncio.to_thread(_meta, "ultima_sync")
+
+
+async def procesar_receipts_rango(desde, hasta, procesar):
+    """
+    Recibos creados entre desde y hasta (date, inclusive), del espejo si lo
+    cubre o directo de Loyverse, sin esperar a tener todo el rango: cada
+    página se pasa a procesar(pagina) (async) apenas llega de Loyverse, en
+    paralelo con la descarga del resto. Devuelve (resultados, ultima_sync)
+    con los resultados en el orden de los recibos (más nuevo primero), o
+    (dict de error, None). Del espejo se procesa todo el rango de una vez.
+    """
+    espejo = await leer_espejo(desde, hasta)
+    if espejo is not None:
+        receipts, ultima_sync = espejo
+        return [await procesar(receipts)], ultima_sync
+
+    tareas = []  # (created_at del primer recibo, tarea)
+    try:
+        async for pagina in iterar_paginas_receipts(desde, hasta):
+            if isinstance(pagina, dict):
+                for _, tarea in tareas:
+                    tarea.cancel()
+                return pagina, None
+            tareas.append((pagina[0].get("created_at") or "", asyncio.create_task(procesar(pagina))))
+    except BaseException:
+        for _, tarea in tareas:
+            tarea.cancel()
+        raise
+
+    # Las páginas llegan sin orden entre ventanas: se ordenan por su primer
+    # recibo (las ventanas no se solapan y el sort es estable dentro de cada una)
+    tareas.sort(key=lambda t: t[0], reverse=True)
+    return await asyncio.gather(*[tarea for _, tarea in tareas]), None
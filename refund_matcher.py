@@ -0,0 +1,178 @@
+# refund_matcher.py
+# Cruce de reembolsos con ventas para /api/ventas.
+#
+# Primer pase (por producto): cada ítem de una venta descuenta cantidades de
+# los ítems reembolsados del mismo producto con fecha posterior a la venta.
+# Lo descontado se consume: un mismo ítem reembolsado no se imputa a dos ventas.
+#
+# Segundo pase (reembolsos sin match por ítems): se asocia a la venta más nueva
+# anterior al reembolso, del mismo cliente si el reembolso tiene cliente, y con
+# total >= al del reembolso.
+#
+# Se espera que ventas y reembolsos vengan de más nuevo a más viejo, como los
+# entregan Loyverse y el espejo: con ese orden "el primero de la lista" y "el
+# más nuevo" son el mismo, y los índices por fecha recorren igual que la lista.
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import datetime
+
+
+def parse_fecha(fecha_str: str) -> datetime:
+    return datetime.fromisoformat(fecha_str.replace("Z", "+00:00"))
+
+
+def estado_reembolso(sale: dict, total_refund, refunded_items: list, remaining_items: list) -> dict:
+    max_facturable = round(sale["total"] - total_refund, 2)
+
+    if total_refund == 0:
+        refund_status = "NONE"
+    elif max_facturable == 0:
+        refund_status = "TOTAL"
+    else:
+        refund_status = "PARTIAL"
+
+    return {
+        "refunded_amount": total_refund,
+        "refund_status": refund_status,
+        "max_facturable": max_facturable,
+        "items_facturables": remaining_items,
+        "refunded_items": refunded_items,
+    }
+
+
+def estado_sin_reembolsos(sale: dict) -> dict:
+    """Campos de reembolso de una venta que no tiene reembolsos asociados."""
+    return estado_reembolso(sale, 0, [], [
+        {
+            "nombre": item["nombre"],
+            "cantidad": item["cantidad"],
+            "precio_unitario": item["precio_unitario"],
+        }
+        for item in sale.get("items", [])
+        if item["cantidad"] > 0
+    ])
+
+
+# -------------------------
+# ÍNDICES
+# -------------------------
+def _indice_por_producto(refunds: list) -> dict:
+    """
+    nombre → (fechas, pendientes), ordenadas por (fecha, -posición) ascendente:
+    recorriendo de atrás hacia adelante se ve el orden de la lista de reembolsos.
+    pendientes[i] = [cantidad sin imputar, receipt_id del reembolso].
+    """
+    entradas = defaultdict(list)
+    for orden, ref in enumerate(refunds):
+        fecha = parse_fecha(ref["fecha"])
+        for orden_item, item in enumerate(ref.get("items", [])):
+            if item["cantidad"] > 0:
+                entradas[item["nombre"]].append(
+                    (fecha, -orden, -orden_item, [item["cantidad"], ref["receipt_id"]])
+                )
+
+    indice = {}
+    for nombre, lista in entradas.items():
+        lista.sort(key=lambda e: e[:3])
+        indice[nombre] = ([e[0] for e in lista], [e[3] for e in lista])
+    return indice
+
+
+def _indice_por_cliente(sales: list, fechas_sales: list):
+    """
+    (por_cliente, todas): cliente_id → (fechas, ventas) y lo mismo para todas
+    las ventas, ordenadas por (fecha, -posición) ascendente.
+    """
+    ordenadas = sorted(
+        range(len(sales)), key=lambda i: (fechas_sales[i], -i)
+    )
+    por_cliente = defaultdict(lambda: ([], []))
+    todas = ([], [])
+    for i in ordenadas:
+        sale = sales[i]
+        for fechas, ventas in (todas, por_cliente[sale.get("cliente_id")]):
+            fechas.append(fechas_sales[i])
+            ventas.append(sale)
+    return por_cliente, todas
+
+
+# -------------------------
+# CRUCE
+# -------------------------
+def matchear_reembolsos(sales: list, refunds: list):
+    """
+    Cruza reembolsos con ventas. Devuelve (estados, refund_to_sale):
+    estados[i] son los campos de reembolso de sales[i].
+    """
+    por_producto = _indice_por_producto(refunds)
+    fechas_sales = [parse_fecha(sale["fecha"]) for sale in sales]
+
+    # PRIMER PASE: por producto, sólo reembolsos posteriores a la venta
+    refund_to_sale = {}
+    estados = []
+
+    for sale, sale_date in zip(sales, fechas_sales):
+        total_refund = 0
+        refunded_items = []
+        remaining_items = []
+
+        for item in sale.get("items", []):
+            qty_left = item["cantidad"]
+            unit_price = item["precio_unitario"]
+            fechas, pendientes = por_producto.get(item["nombre"], ((), ()))
+
+            # Posteriores a la venta: de la posición desde hasta el final
+            desde = bisect_right(fechas, sale_date)
+            i = len(pendientes) - 1
+            while i >= desde and qty_left > 0:
+                pendiente = pendientes[i]
+                ref_qty = min(qty_left, pendiente[0])
+
+                importe = ref_qty * unit_price
+                total_refund += importe
+                qty_left -= ref_qty
+
+                refunded_items.append({
+                    "nombre": item["nombre"],
+                    "cantidad": ref_qty,
+                    "importe": importe,
+                    "refund_receipt_id": pendiente[1],
+                })
+
+                refund_to_sale[pendiente[1]] = sale["receipt_id"]
+
+                pendiente[0] -= ref_qty
+                if pendiente[0] <= 0:
+                    del pendientes[i]
+                    del fechas[i]
+                i -= 1
+
+            if qty_left > 0:
+                remaining_items.append({
+                    "nombre": item["nombre"],
+                    "cantidad": qty_left,
+                    "precio_unitario": unit_price,
+                })
+
+        estados.append(estado_reembolso(sale, total_refund, refunded_items, remaining_items))
+
+    # SEGUNDO PASE: reembolsos sin match por items → cruzar por cliente_id + factura existente
+    por_cliente, todas = _indice_por_cliente(sales, fechas_sales)
+
+    for ref in refunds:
+        if ref["receipt_id"] in refund_to_sale:
+            continue
+
+        ref_cliente = ref.get("cliente_id")
+        ref_total = ref.get("total", 0)
+        fechas, ventas = por_cliente.get(ref_cliente, ((), ())) if ref_cliente else todas
+
+        # La más nueva anterior al reembolso que alcance a cubrir el total
+        i = bisect_left(fechas, parse_fecha(ref["fecha"])) - 1
+        while i >= 0:
+            if ventas[i].get("total", 0) >= ref_total:
+                refund_to_sale[ref["receipt_id"]] = ventas[i]["receipt_id"]
+                break
+            i -= 1
+
+    return estados, refund_to_sale
@@ -0,0 +1,385 @@
+# sqlite_db.py
+# Backend SQLite (modo WAL) para json_db: FACTURAS_DB_BACKEND=sqlite.
+# Cada comprobante se guarda como JSON en la columna `data`; las columnas
+# sueltas existen sólo para indexar las búsquedas de facturas_api.
+#
+# Importación manual desde un facturas_db.json existente:
+#     python sqlite_db.py facturas_db.json
+import os
+import sys
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+SQLITE_PATH = os.environ.get("FACTURAS_SQLITE_PATH", "facturas_db.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS facturas (
+    receipt_id     TEXT PRIMARY KEY,
+    cbte_nro       INTEGER,
+    fecha          TEXT,
+    cliente_nombre TEXT,
+    cliente_dni    TEXT,
+    cliente_cuit   TEXT,
+    fecha_ord      INTEGER,
+    data           TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_facturas_cbte_nro ON facturas(cbte_nro);
+CREATE INDEX IF NOT EXISTS idx_facturas_orden ON facturas(COALESCE(cbte_nro, 0), receipt_id);
+CREATE INDEX IF NOT EXISTS idx_facturas_fecha ON facturas(fecha);
+CREATE INDEX IF NOT EXISTS idx_facturas_cliente_dni ON facturas(cliente_dni);
+CREATE INDEX IF NOT EXISTS idx_facturas_cliente_cuit ON facturas(cliente_cuit);
+
+CREATE TABLE IF NOT EXISTS notas_credito (
+    refund_receipt_id TEXT PRIMARY KEY,
+    cbte_nro          INTEGER,
+    fecha             TEXT,
+    sale_receipt_id   TEXT,
+    fecha_ord         INTEGER,
+    data              TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_nc_cbte_nro ON notas_credito(cbte_nro);
+CREATE INDEX IF NOT EXISTS idx_nc_fecha ON notas_credito(fecha);
+CREATE INDEX IF NOT EXISTS idx_nc_sale_receipt_id ON notas_credito(sale_receipt_id);
+
+CREATE TABLE IF NOT EXISTS meta (
+    clave TEXT PRIMARY KEY,
+    valor TEXT
+);
+"""
+
+# Columnas agregadas después de la primera versión del esquema:
+# (tabla, columna, tipo, índice)
+_MIGRACIONES = [
+    ("facturas", "fecha_ord", "INTEGER", "idx_facturas_fecha_ord"),
+    ("notas_credito", "fecha_ord", "INTEGER", "idx_nc_fecha_ord"),
+]
+
+_CONN: sqlite3.Connection | None = None
+_LOCK = threading.RLock()
+_FTS = False  # facturas_busqueda disponible (SQLite compilado con FTS5)
+_LOTE_IN = 500  # ids por consulta en las lecturas bulk (límite de parámetros de SQLite)
+
+
+def conectar(path: str = SQLITE_PATH) -> sqlite3.Connection:
+    global _CONN
+    with _LOCK:
+        if _CONN is None:
+            conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            _migrar(conn)
+            _crear_busqueda(conn)
+            _CONN = conn
+        return _CONN
+
+
+def _migrar(conn: sqlite3.Connection) -> None:
+    from json_db import _fecha_ord
+
+    for tabla, columna, tipo, indice in _MIGRACIONES:
+        columnas = {fila[1] for fila in conn.execute(f"PRAGMA table_info({tabla})")}
+        if columna not in columnas:
+            print(f"DEBUG sqlite_db → agregando columna {tabla}.{columna}")
+            conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}")
+        if columna == "fecha_ord":
+            # Backfill de filas viejas (NULL): se parsea la fecha una sola vez
+            filas = conn.execute(f"SELECT rowid, fecha FROM {tabla} WHERE fecha_ord IS NULL").fetchall()
+            if filas:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    f"UPDATE {tabla} SET fecha_ord = ? WHERE rowid = ?",
+                    [(_fecha_ord(fecha), rowid) for rowid, fecha in filas],
+                )
+                conn.execute("COMMIT")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {indice} ON {tabla}({columna})")
+
+
+def cerrar() -> None:
+    global _CONN
+    with _LOCK:
+        if _CONN is not None:
+            _CONN.close()
+            _CONN = None
+
+
+def esta_vacia() -> bool:
+    conn = conectar()
+    with _LOCK:
+        fila = conn.execute(
+            "SELECT (SELECT COUNT(*) FROM facturas) + (SELECT COUNT(*) FROM notas_credito)"
+        ).fetchone()
+    return fila[0] == 0
+
+
+def _crear_busqueda(conn: sqlite3.Connection) -> None:
+    """
+    Índice FTS5 (tokenizer trigram) sobre nombre/DNI/CUIT para el filtro
+    `cliente`. Sin FTS5 el filtro se resuelve recorriendo las facturas.
+    """
+    global _FTS
+    existia = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'facturas_busqueda'"
+    ).fetchone() is not None
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS facturas_busqueda "
+            "USING fts5(texto, tokenize = 'trigram')"
+        )
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ sqlite_db → sin FTS5 trigram, búsqueda por cliente sin índice: {e}")
+        _FTS = False
+        return
+    _FTS = True
+    if not existia:
+        _reconstruir_busqueda(conn)
+
+
+def _reconstruir_busqueda(conn: sqlite3.Connection) -> None:
+    filas = conn.execute("SELECT rowid, data FROM facturas").fetchall()
+    conn.execute("BEGIN")
+    conn.execute("DELETE FROM facturas_busqueda")
+    conn.executemany(
+        "INSERT INTO facturas_busqueda (rowid, texto) VALUES (?, ?)",
+        [(rowid, _texto_busqueda(json.loads(data))) for rowid, data in filas],
+    )
+    conn.execute("COMMIT")
+
+
+def _texto_busqueda(info: Dict[str, Any]) -> str:
+    return "\n".join([
+        (info.get("cliente_nombre", "Consumidor Final") or "").lower(),
+        info.get("cliente_dni") or "",
+        info.get("cliente_cuit") or "",
+    ])
+
+
+def _fila_factura(receipt_id: str, info: Dict[str, Any]) -> tuple:
+    return (
+        receipt_id,
+        info.get("cbte_nro"),
+        info.get("fecha"),
+        info.get("cliente_nombre"),
+        info.get("cliente_dni"),
+        info.get("cliente_cuit"),
+        info.get("fecha_ord"),
+        json.dumps(info, ensure_ascii=False),
+    )
+
+
+def _fila_nota_credito(refund_receipt_id: str, info: Dict[str, Any]) -> tuple:
+    asociada_a = info.get("asociada_a") or {}
+    return (
+        refund_receipt_id,
+        info.get("cbte_nro"),
+        info.get("fecha"),
+        asociada_a.get("sale_receipt_id"),
+        info.get("fecha_ord"),
+        json.dumps(info, ensure_ascii=False),
+    )
+
+
+# ON CONFLICT (y no INSERT OR REPLACE) para conservar el rowid: es la clave
+# de facturas_busqueda y el orden de emisión de las notas de crédito.
+_UPSERT_FACTURA = """
+INSERT INTO facturas
+    (receipt_id, cbte_nro, fecha, cliente_nombre, cliente_dni, cliente_cuit, fecha_ord, data)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(receipt_id) DO UPDATE SET
+    cbte_nro = excluded.cbte_nro,
+    fecha = excluded.fecha,
+    cliente_nombre = excluded.cliente_nombre,
+    cliente_dni = excluded.cliente_dni,
+    cliente_cuit = excluded.cliente_cuit,
+    fecha_ord = excluded.fecha_ord,
+    data = excluded.data
+"""
+
+_UPSERT_BUSQUEDA = """
+INSERT OR REPLACE INTO facturas_busqueda (rowid, texto)
+SELECT rowid, ? FROM facturas WHERE receipt_id = ?
+"""
+
+_UPSERT_NOTA_CREDITO = """
+INSERT INTO notas_credito
+    (refund_receipt_id, cbte_nro, fecha, sale_receipt_id, fecha_ord, data)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(refund_receipt_id) DO UPDATE SET
+    cbte_nro = excluded.cbte_nro,
+    fecha = excluded.fecha,
+    sale_receipt_id = excluded.sale_receipt_id,
+    fecha_ord = excluded.fecha_ord,
+    data = excluded.data
+"""
+
+
+# -------------------------
+# IMPORTACIÓN DESDE JSON
+# -------------------------
+def importar_json(data: Dict[str, Any]) -> Tuple[int, int]:
+    """
+    Carga en una sola transacción el contenido de facturas_db.json
+    (formato actual o formato viejo plano). Devuelve (facturas, notas).
+    """
+    from json_db import _normalizar_db, _completar_fecha_ord
+
+    data = _normalizar_db(dict(data))
+    _completar_fecha_ord(data)
+    facturas = data["facturas"]
+    notas = data["notas_credito"]
+
+    conn = conectar()
+    with _LOCK:
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(_UPSERT_FACTURA, (_fila_factura(k, v) for k, v in facturas.items()))
+            conn.executemany(_UPSERT_NOTA_CREDITO, (_fila_nota_credito(k, v) for k, v in notas.items()))
+            conn.execute("INSERT OR REPLACE INTO meta (clave, valor) VALUES ('importado_json', '1')")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if _FTS:
+            _reconstruir_busqueda(conn)
+
+    print(f"DEBUG sqlite_db → importadas {len(facturas)} facturas y {len(notas)} notas de crédito")
+    return len(facturas), len(notas)
+
+
+# -------------------------
+# FACTURAS (VENTAS)
+# -------------------------
+def obtener_factura(receipt_id: str) -> Optional[Dict[str, Any]]:
+    conn = conectar()
+    with _LOCK:
+        fila = conn.execute("SELECT data FROM facturas WHERE receipt_id = ?", (receipt_id,)).fetchone()
+    return json.loads(fila[0]) if fila else None
+
+
+def _obtener_bulk(tabla: str, columna: str, ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """{id: data} de los ids que existen, con `IN (...)` de a _LOTE_IN ids."""
+    ids = list(dict.fromkeys(ids))
+    conn = conectar()
+    resultado = {}
+    for i in range(0, len(ids), _LOTE_IN):
+        lote = ids[i:i + _LOTE_IN]
+        marcas = ", ".join("?" * len(lote))
+        with _LOCK:
+            filas = conn.execute(
+                f"SELECT {columna}, data FROM {tabla} WHERE {columna} IN ({marcas})", lote
+            ).fetchall()
+        for clave, data in filas:
+            resultado[clave] = json.loads(data)
+    return resultado
+
+
+def obtener_facturas_bulk(receipt_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    return _obtener_bulk("facturas", "receipt_id", receipt_ids)
+
+
+def guardar_factura(receipt_id: str, info: Dict[str, Any]) -> None:
+    conn = conectar()
+    with _LOCK:
+        conn.execute("BEGIN")
+        try:
+            conn.execute(_UPSERT_FACTURA, _fila_factura(receipt_id, info))
+            if _FTS:
+                conn.execute(_UPSERT_BUSQUEDA, (_texto_busqueda(info), receipt_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def iterar_facturas_desc(desde_clave: tuple | None, desde_ord: int | None = None,
+                         hasta_ord: int | None = None, cliente: str | None = None,
+                         lote: int = 200):
+    """
+    (clave_orden, receipt_id, info) por (cbte_nro, receipt_id) descendente,
+    paginando por clave (keyset) de a `lote` filas. desde_ord / hasta_ord
+    (YYYYMMDD) limitan el rango de fechas usando idx_facturas_fecha_ord;
+    `cliente` preselecciona con facturas_busqueda (json_db verifica el filtro).
+    """
+    q = cliente.lower() if cliente else ""
+    conn = conectar()
+    clave = desde_clave
+    while True:
+        condiciones, params = [], []
+        if clave is not None:
+            condiciones.append("(COALESCE(cbte_nro, 0), receipt_id) < (?, ?)")
+            params += [clave[0], clave[1]]
+        if desde_ord is not None:
+            condiciones.append("fecha_ord >= ?")
+            params.append(desde_ord)
+        if hasta_ord is not None:
+            condiciones.append("fecha_ord <= ?")
+            params.append(hasta_ord)
+        if _FTS and len(q) >= 3:
+            condiciones.append("rowid IN (SELECT rowid FROM facturas_busqueda WHERE facturas_busqueda MATCH ?)")
+            params.append('"' + q.replace('"', '""') + '"')
+        where = ("WHERE " + " AND ".join(condiciones)) if condiciones else ""
+        with _LOCK:
+            filas = conn.execute(
+                "SELECT COALESCE(cbte_nro, 0), receipt_id, data FROM facturas "
+                f"{where} ORDER BY COALESCE(cbte_nro, 0) DESC, receipt_id DESC LIMIT ?",
+                (*params, lote),
+            ).fetchall()
+        for cbte_nro, receipt_id, data in filas:
+            clave = (cbte_nro, receipt_id)
+            yield clave, receipt_id, json.loads(data)
+        if len(filas) < lote:
+            return
+
+
+# -------------------------
+# NOTAS DE CRÉDITO (REEMBOLSOS)
+# -------------------------
+def obtener_nota_credito(refund_receipt_id: str) -> Optional[Dict[str, Any]]:
+    conn = conectar()
+    with _LOCK:
+        fila = conn.execute(
+            "SELECT data FROM notas_credito WHERE refund_receipt_id = ?", (refund_receipt_id,)
+        ).fetchone()
+    return json.loads(fila[0]) if fila else None
+
+
+def obtener_notas_credito_bulk(refund_receipt_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    return _obtener_bulk("notas_credito", "refund_receipt_id", refund_receipt_ids)
+
+
+def guardar_nota_credito(refund_receipt_id: str, info: Dict[str, Any]) -> None:
+    conn = conectar()
+    with _LOCK:
+        conn.execute(_UPSERT_NOTA_CREDITO, _fila_nota_credito(refund_receipt_id, info))
+
+
+def notas_credito_de_venta(sale_receipt_id: str) -> list:
+    conn = conectar()
+    with _LOCK:
+        filas = conn.execute(
+            "SELECT refund_receipt_id, data FROM notas_credito WHERE sale_receipt_id = ? ORDER BY rowid",
+            (sale_receipt_id,),
+        ).fetchall()
+    return [(refund_id, json.loads(data)) for refund_id, data in filas]
+
+
+# -------------------------
+# BACKUP
+# -------------------------
+def exportar_copia(destino: str) -> None:
+    """Copia consistente de la base (incluye lo que todavía está en el WAL)."""
+    conn = conectar()
+    with _LOCK:
+        copia = sqlite3.connect(destino)
+        try:
+            conn.backup(copia)
+        finally:
+            copia.close()
+
+
+if __name__ == "__main__":
+    origen = sys.argv[1] if len(sys.argv) > 1 else "facturas_db.json"
+    with open(origen, "r", encoding="utf-8") as f:
+        importar_json(json.load(f))
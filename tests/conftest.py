@@ -0,0 +1,6 @@
+import os
+import sys
+
+# loyverse.py exige el token al importarse
+os.environ.setdefault("LOYVERSE_TOKEN", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
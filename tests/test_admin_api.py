@@ -0,0 +1,42 @@
+# /api/admin/resumen: la carga de empleados en paralelo no queda suelta si
+# la respuesta sale antes por un error de Loyverse.
+import asyncio
+from datetime import date
+
+from fastapi import Response
+
+import admin_api
+
+
+def test_error_de_ventas_cancela_la_carga_de_empleados(monkeypatch):
+    estado = {"cancelada": False}
+
+    async def nombres_lentos(employee_ids=()):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            estado["cancelada"] = True
+            raise
+        return {}
+
+    async def sin_espejo(desde, hasta):
+        return None
+
+    async def loyverse_caido(desde, hasta, procesar):
+        await asyncio.sleep(0.01)  # la carga de empleados ya arrancó
+        return {"error": "Loyverse devolvió error", "status": 503}, None
+
+    monkeypatch.setattr(admin_api.DIRECTORIO_EMPLEADOS, "nombres_para", nombres_lentos)
+    monkeypatch.setattr(admin_api, "leer_rollups", sin_espejo)
+    monkeypatch.setattr(admin_api, "procesar_receipts_rango", loyverse_caido)
+
+    async def pedir():
+        respuesta = await admin_api.resumen_admin(Response(), desde=date(2026, 3, 1), hasta=date(2026, 3, 31))
+        await asyncio.sleep(0)  # deja correr la cancelación
+        # Antes de que asyncio.run cancele lo que quede pendiente
+        return respuesta, estado["cancelada"]
+
+    respuesta, cancelada = asyncio.run(pedir())
+
+    assert respuesta.status_code == 500
+    assert cancelada
@@ -0,0 +1,230 @@
+# Backends de json_db: arranque de "sqlite" contra un Supabase que falla o
+# que todavía no tiene la base, y mismos resultados en "json" y "sqlite"
+# (contra una búsqueda sin índices).
+import copy
+import os
+import random
+
+import httpx
+import pytest
+
+import facturas_api
+import json_db
+import sqlite_db
+
+
+class UploaderManual:
+    def marcar(self):
+        pass
+
+
+@pytest.fixture
+def sqlite(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sqlite_db, "_CONN", None)
+    monkeypatch.setattr(json_db, "_SQLITE_LISTO", False)
+    monkeypatch.setattr(json_db, "DB_BACKEND", "sqlite")
+    monkeypatch.setattr(json_db, "_UPLOADER", UploaderManual())
+    monkeypatch.setattr(json_db, "download_facturas_sqlite", lambda path: False)
+    monkeypatch.setattr(json_db, "download_facturas_db", lambda path: {})
+    yield
+    sqlite_db.cerrar()
+
+
+def _nc(n: int, venta: str) -> dict:
+    return {"cbte_nro": n, "fecha": "10/03/2026", "asociada_a": {"sale_receipt_id": venta}}
+
+
+def test_falla_de_supabase_no_importa_el_json_viejo(sqlite, monkeypatch):
+    def caido(path):
+        raise httpx.ConnectError("sin red")
+
+    importado = []
+    monkeypatch.setattr(json_db, "download_facturas_sqlite", caido)
+    monkeypatch.setattr(json_db, "download_facturas_db", lambda path: importado.append(path) or {})
+
+    with pytest.raises(Exception, match="facturas_db.sqlite3"):
+        json_db.obtener_factura("v1")
+    assert importado == []
+    assert not os.path.exists(sqlite_db.SQLITE_PATH)
+
+    # Al volver Supabase, el próximo uso la descarga (acá: todavía no existe)
+    monkeypatch.setattr(json_db, "download_facturas_sqlite", lambda path: False)
+    assert json_db.obtener_factura("v1") is None
+    assert importado == [json_db.LOCAL_PATH]
+
+
+def test_sin_base_en_supabase_migra_el_json(sqlite, monkeypatch):
+    monkeypatch.setattr(json_db, "download_facturas_db", lambda path: {
+        "facturas": {"v1": {"cbte_nro": 1, "fecha": "01/03/2026"}},
+        "notas_credito": {},
+    })
+
+    assert json_db.obtener_factura("v1")["cbte_nro"] == 1
+
+
+def test_volver_a_guardar_una_nc_conserva_su_orden(sqlite):
+    json_db.guardar_nota_credito("r1", _nc(1, "v1"))
+    json_db.guardar_nota_credito("r2", _nc(2, "v1"))
+    json_db.guardar_nota_credito("r1", {**_nc(1, "v1"), "drive_url": "https://x/1.pdf"})
+
+    notas = json_db.notas_credito_de_venta("v1")
+
+    assert [refund_id for refund_id, _ in notas] == ["r1", "r2"]
+    assert notas[0][1]["drive_url"] == "https://x/1.pdf"
+
+
+# -------------------------
+# PARIDAD JSON / SQLITE
+# -------------------------
+NOMBRES = ["Ana Pérez", "Juan Gómez", "María Ana López", "Consumidor Final", "Pedro Anaya"]
+
+
+def _datos(n: int, seed: int) -> dict:
+    """Facturas con fechas, clientes y números repetidos (y alguna sin cbte_nro)."""
+    rng = random.Random(seed)
+    facturas = {}
+    for i in range(n):
+        dni = str(rng.randint(20000000, 45000000)) if rng.random() < 0.5 else None
+        facturas[f"v{i:04d}"] = {
+            "cbte_nro": rng.choice([None, rng.randint(1, n // 2)]) if rng.random() < 0.05 else rng.randint(1, n),
+            "fecha": f"{rng.randint(1, 28):02d}/{rng.randint(1, 4):02d}/2026",
+            "cliente_nombre": rng.choice(NOMBRES),
+            "cliente_dni": dni,
+            "cliente_cuit": f"20{dni}9" if dni and rng.random() < 0.3 else None,
+            "total": rng.randint(1, 50) * 500,
+        }
+    return {"facturas": facturas, "notas_credito": {}}
+
+
+def _esperado(facturas: dict, desde=None, hasta=None, cliente=None, nro=None) -> list:
+    """Filtro y orden recorriendo todas las facturas, sin índices."""
+    def ord_(fecha):
+        d, m, y = fecha.split("/")
+        return int(y) * 10000 + int(m) * 100 + int(d)
+
+    filas = []
+    for receipt_id, info in facturas.items():
+        if desde and ord_(info["fecha"]) < ord_(desde):
+            continue
+        if hasta and ord_(info["fecha"]) > ord_(hasta):
+            continue
+        if cliente:
+            q = cliente.lower()
+            textos = [info["cliente_nombre"].lower(), info["cliente_dni"] or "", info["cliente_cuit"] or ""]
+            if not any(q in t for t in textos):
+                continue
+        if nro and str(info["cbte_nro"]) != nro:
+            continue
+        filas.append(((info["cbte_nro"] or 0, receipt_id), receipt_id))
+    return [receipt_id for _, receipt_id in sorted(filas, reverse=True)]
+
+
+def _buscar_paginado(limit: int, **filtros) -> list:
+    receipt_ids, cursor = [], None
+    while True:
+        filas, cursor = json_db.buscar_facturas(limit=limit, cursor=cursor, **filtros)
+        receipt_ids += [receipt_id for receipt_id, _ in filas]
+        if cursor is None:
+            return receipt_ids
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, monkeypatch, tmp_path):
+    """Carga un juego de datos en el backend y devuelve las facturas originales."""
+    def cargar(datos: dict) -> dict:
+        monkeypatch.setattr(json_db, "download_facturas_db", lambda path: copy.deepcopy(datos))
+        if request.param == "json":
+            monkeypatch.setattr(json_db, "_DB_CACHE", None)
+            monkeypatch.setattr(json_db, "DB_BACKEND", "json")
+        return datos["facturas"]
+
+    if request.param == "sqlite":
+        request.getfixturevalue("sqlite")
+    else:
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(json_db, "_UPLOADER", UploaderManual())
+    return cargar
+
+
+FILTROS = [
+    {},
+    {"desde": "10/02/2026"},
+    {"hasta": "05/01/2026"},
+    {"desde": "01/02/2026", "hasta": "28/02/2026"},
+    {"desde": "15/03/2026", "hasta": "15/03/2026"},
+    {"cliente": "ana"},
+    {"cliente": "Ana Pérez"},
+    {"cliente": "pe"},
+    {"cliente": "zzz"},
+    {"cliente": "ana", "desde": "01/03/2026"},
+    {"nro": "17"},
+]
+
+
+def test_buscar_facturas_igual_en_todos_los_backends(backend):
+    facturas = backend(_datos(600, seed=12))
+    # Filtros por DNI/CUIT tomados de los datos (subcadenas incluidas)
+    dni = next(info["cliente_dni"] for info in facturas.values() if info["cliente_dni"])
+    cuit = next(info["cliente_cuit"] for info in facturas.values() if info["cliente_cuit"])
+    filtros = FILTROS + [{"cliente": dni}, {"cliente": dni[2:6]}, {"cliente": cuit}]
+
+    for filtro in filtros:
+        esperado = _esperado(facturas, **filtro)
+        filas, cursor = json_db.buscar_facturas(**filtro)
+        assert [receipt_id for receipt_id, _ in filas] == esperado, filtro
+        assert cursor is None
+        for limit in (1, 7, 250):
+            assert _buscar_paginado(limit, **filtro) == esperado, (filtro, limit)
+
+
+def test_nuevas_facturas_aparecen_en_la_busqueda(backend):
+    facturas = backend(_datos(50, seed=13))
+    nueva = {"cbte_nro": 999, "fecha": "20/03/2026", "cliente_nombre": "Zoe Anaya",
+             "cliente_dni": "30111222", "cliente_cuit": None}
+    json_db.guardar_factura("nueva", nueva)
+    # Reemplazo: el viejo nombre deja de encontrarse
+    json_db.guardar_factura("v0001", {**facturas["v0001"], "cliente_nombre": "Renombrado"})
+
+    assert [r for r, _ in json_db.buscar_facturas(cliente="zoe")[0]] == ["nueva"]
+    assert [r for r, _ in json_db.buscar_facturas(cliente="30111")[0]] == ["nueva"]
+    assert "v0001" in [r for r, _ in json_db.buscar_facturas(cliente="renombr")[0]]
+    viejo = facturas["v0001"]["cliente_nombre"].lower()
+    assert "v0001" not in [r for r, _ in json_db.buscar_facturas(cliente=viejo)[0]]
+
+
+def test_notas_credito_de_venta_igual_en_todos_los_backends(backend):
+    rng = random.Random(9)
+    ventas = [f"v{i}" for i in range(15)]
+    datos = {"facturas": {}, "notas_credito": {
+        f"r{i:03d}": _nc(i, rng.choice(ventas)) for i in range(40)
+    }}
+    backend(datos)
+    # Orden de alta, como lo guarda cada backend
+    alta = list(datos["notas_credito"])
+    asociada = {refund_id: nc["asociada_a"]["sale_receipt_id"] for refund_id, nc in datos["notas_credito"].items()}
+
+    for i in range(40, 120):
+        refund_id = f"r{i:03d}" if rng.random() < 0.6 else rng.choice(alta)
+        venta = rng.choice(ventas)
+        if refund_id not in asociada:
+            alta.append(refund_id)
+        asociada[refund_id] = venta
+        json_db.guardar_nota_credito(refund_id, _nc(i, venta))
+
+    for venta in ventas + ["sin-nc"]:
+        esperado = [refund_id for refund_id in alta if asociada[refund_id] == venta]
+        notas = json_db.notas_credito_de_venta(venta)
+        assert [refund_id for refund_id, _ in notas] == esperado, venta
+        assert all(nc["asociada_a"]["sale_receipt_id"] == venta for _, nc in notas)
+
+
+def test_listado_paginado_devuelve_la_cantidad_de_la_pagina(backend):
+    backend(_datos(30, seed=10))
+
+    todo = facturas_api.listar_facturas(limit=None)
+    assert todo["total"] == 30 and len(todo["facturas"]) == 30
+
+    pagina = facturas_api.listar_facturas(limit=7)
+    assert "total" not in pagina
+    assert pagina["cantidad"] == 7 and pagina["next_cursor"]
@@ -0,0 +1,141 @@
+# Backend "journal" de json_db contra un Supabase en memoria: lo que se
+# escribió se recupera al reiniciar (snapshot + segmentos + journal local) y
+# la compactación no pierde líneas si la subida del snapshot falla.
+import json
+
+import pytest
+
+import json_db
+
+
+class SupabaseFalso:
+    def __init__(self):
+        self.snapshot = None
+        self.segmentos = {}
+        self.falla_snapshot = False
+        self.al_subir_snapshot = None
+
+    def download_facturas_db(self, local_path="facturas_db.json"):
+        if self.snapshot is None:
+            return {}
+        with open(local_path, "w", encoding="utf-8") as f:
+            f.write(self.snapshot)
+        return json.loads(self.snapshot)
+
+    def upload_facturas_db(self, local_path="facturas_db.json"):
+        if self.al_subir_snapshot:
+            self.al_subir_snapshot()
+        if self.falla_snapshot:
+            return False
+        with open(local_path, "r", encoding="utf-8") as f:
+            self.snapshot = f.read()
+        return True
+
+    def upload_journal_segment(self, nombre, contenido):
+        self.segmentos[nombre] = contenido
+        return True
+
+    def list_journal_segments(self):
+        return sorted(self.segmentos)
+
+    def download_journal_segment(self, nombre):
+        return self.segmentos.get(nombre)
+
+    def remove_journal_segments(self, nombres):
+        for nombre in nombres:
+            self.segmentos.pop(nombre, None)
+
+
+class UploaderManual:
+    def marcar(self):
+        pass
+
+
+def _reiniciar(monkeypatch):
+    """Estado del módulo como recién arrancado el proceso."""
+    monkeypatch.setattr(json_db, "_DB_CACHE", None)
+    monkeypatch.setattr(json_db, "_JOURNAL_PENDIENTE", [])
+    monkeypatch.setattr(json_db, "_JOURNAL_SEQ_SNAPSHOT", 0)
+    monkeypatch.setattr(json_db, "_JOURNAL_ULTIMO_SEQ", 0)
+
+
+@pytest.fixture
+def supabase(monkeypatch, tmp_path):
+    supabase = SupabaseFalso()
+    monkeypatch.chdir(tmp_path)
+    for nombre in ("download_facturas_db", "upload_facturas_db", "upload_journal_segment",
+                   "list_journal_segments", "download_journal_segment", "remove_journal_segments"):
+        monkeypatch.setattr(json_db, nombre, getattr(supabase, nombre))
+    monkeypatch.setattr(json_db, "DB_BACKEND", "journal")
+    monkeypatch.setattr(json_db, "COMPACTAR_CADA", 3)
+    monkeypatch.setattr(json_db, "_UPLOADER", UploaderManual())
+    _reiniciar(monkeypatch)
+    return supabase
+
+
+def _factura(n: int) -> dict:
+    return {"cbte_nro": n, "fecha": f"0{n}/03/2026", "total": 1000 * n}
+
+
+def _lineas_journal() -> list:
+    with open(json_db.JOURNAL_PATH, "r", encoding="utf-8") as f:
+        return [json.loads(linea)["seq"] for linea in f if linea.strip()]
+
+
+def test_reinicio_reproduce_segmentos_y_journal_local(supabase, monkeypatch):
+    json_db.guardar_factura("v1", _factura(1))
+    json_db.guardar_factura("v2", _factura(2))
+    assert json_db._journal_subir_pendiente()
+    # Escrita pero nunca subida (el proceso se cayó antes)
+    json_db.guardar_factura("v3", _factura(3))
+
+    _reiniciar(monkeypatch)
+
+    assert json_db.obtener_factura("v1")["cbte_nro"] == 1
+    assert json_db.obtener_factura("v3")["cbte_nro"] == 3
+    assert json_db._JOURNAL_ULTIMO_SEQ == 3
+    # La línea local pendiente se sube en la próxima pasada
+    assert [json.loads(linea)["seq"] for linea in json_db._JOURNAL_PENDIENTE] == [3]
+
+
+def test_compactacion_sube_snapshot_y_borra_segmentos(supabase, monkeypatch):
+    for n in (1, 2, 3):
+        json_db.guardar_factura(f"v{n}", _factura(n))
+
+    assert json_db._journal_subir()
+
+    assert json.loads(supabase.snapshot)["journal_seq"] == 3
+    assert supabase.segmentos == {}
+    assert _lineas_journal() == []
+
+    _reiniciar(monkeypatch)
+    assert sorted(json_db._load_db()["facturas"]) == ["v1", "v2", "v3"]
+
+
+def test_compactacion_fallida_no_recorta_el_journal(supabase, monkeypatch):
+    for n in (1, 2, 3):
+        json_db.guardar_factura(f"v{n}", _factura(n))
+    supabase.falla_snapshot = True
+
+    assert not json_db._journal_subir()
+
+    assert _lineas_journal() == [1, 2, 3]
+    assert json_db._JOURNAL_SEQ_SNAPSHOT == 0
+    # Aunque se pierdan los segmentos, el journal local alcanza para recuperar
+    supabase.segmentos.clear()
+    _reiniciar(monkeypatch)
+    assert sorted(json_db._load_db()["facturas"]) == ["v1", "v2", "v3"]
+
+
+def test_escrituras_durante_la_subida_quedan_en_el_journal(supabase, monkeypatch):
+    for n in (1, 2, 3):
+        json_db.guardar_factura(f"v{n}", _factura(n))
+    supabase.al_subir_snapshot = lambda: json_db.guardar_factura("v4", _factura(4))
+
+    assert json_db._journal_subir()
+
+    assert json.loads(supabase.snapshot)["journal_seq"] == 3
+    assert _lineas_journal() == [4]
+
+    _reiniciar(monkeypatch)
+    assert sorted(json_db._load_db()["facturas"]) == ["v1", "v2", "v3", "v4"]
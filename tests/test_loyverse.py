@@ -0,0 +1,226 @@
+# Helpers compartidos de loyverse.py (reintentos, paginado, recibos por
+# ventanas) contra un Loyverse falso (httpx.MockTransport).
+import asyncio
+import time
+from datetime import date, datetime, timedelta
+
+import httpx
+import pytest
+
+import loyverse
+import loyverse_empleados
+
+
+class LoyverseFalso:
+    """Responde con las respuestas encoladas y después pagina `items`."""
+
+    def __init__(self, items=(), por_pagina: int = 2, fallas=()):
+        self.items = list(items)
+        self.por_pagina = por_pagina
+        self.fallas = list(fallas)   # httpx.Response (o excepción) para los primeros pedidos
+        self.pedidos = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.pedidos.append(request)
+        await asyncio.sleep(0.01)
+        if self.fallas:
+            falla = self.fallas.pop(0)
+            if isinstance(falla, Exception):
+                raise falla
+            return falla
+        inicio = int(request.url.params.get("cursor", 0))
+        pagina = self.items[inicio:inicio + self.por_pagina]
+        fin = inicio + self.por_pagina
+        return httpx.Response(200, json={
+            "employees": pagina,
+            "cursor": str(fin) if fin < len(self.items) else None,
+        })
+
+
+@pytest.fixture
+def loyverse_falso(monkeypatch):
+    def crear(**kwargs):
+        falso = LoyverseFalso(**kwargs)
+        cliente = httpx.AsyncClient(transport=httpx.MockTransport(falso))
+        monkeypatch.setattr(loyverse, "get_client", lambda: cliente)
+        return falso
+
+    backoffs = []
+    monkeypatch.setattr(loyverse, "backoff", lambda intento: backoffs.append(intento) or 0)
+    crear.backoffs = backoffs
+    return crear
+
+
+def _empleados(n: int) -> list:
+    return [{"id": f"e{i}", "first_name": f"Empleado {i}"} for i in range(n)]
+
+
+def test_reintenta_429_respetando_retry_after_y_5xx(loyverse_falso):
+    falso = loyverse_falso(items=_empleados(1), fallas=[
+        httpx.Response(429, headers={"Retry-After": "0.2"}),
+        httpx.Response(503),
+        httpx.ConnectError("sin red"),
+    ])
+
+    inicio = time.monotonic()
+    data = asyncio.run(loyverse.get_con_reintentos("/employees", {"limit": 250}))
+
+    assert data["employees"] == _empleados(1)
+    assert len(falso.pedidos) == 4
+    assert time.monotonic() - inicio >= 0.2
+    # El 429 con Retry-After no usa backoff; el 503 y el error de red sí
+    assert loyverse_falso.backoffs == [1, 2]
+
+
+def test_no_reintenta_errores_del_pedido(loyverse_falso):
+    falso = loyverse_falso(fallas=[httpx.Response(401, text="token inválido")])
+
+    with pytest.raises(Exception, match="401"):
+        asyncio.run(loyverse.get_con_reintentos("/employees"))
+    assert len(falso.pedidos) == 1
+
+
+def test_se_rinde_despues_de_los_reintentos(loyverse_falso, monkeypatch):
+    monkeypatch.setattr(loyverse, "LOYVERSE_REINTENTOS", 2)
+    falso = loyverse_falso(fallas=[httpx.Response(500)] * 5)
+
+    with pytest.raises(Exception, match="500"):
+        asyncio.run(loyverse.get_con_reintentos("/employees"))
+    assert len(falso.pedidos) == 3
+
+
+def test_paginar_sigue_el_cursor(loyverse_falso):
+    falso = loyverse_falso(items=_empleados(5), por_pagina=2)
+
+    async def todas():
+        return [pagina async for pagina in loyverse.paginar("/employees", {"limit": 2}, "employees")]
+
+    paginas = asyncio.run(todas())
+
+    assert [len(p) for p in paginas] == [2, 2, 1]
+    assert [p.url.params.get("cursor") for p in falso.pedidos] == [None, "2", "4"]
+
+
+def test_cargas_concurrentes_del_directorio_piden_una_vez(loyverse_falso):
+    falso = loyverse_falso(items=_empleados(3), por_pagina=2)
+    directorio = loyverse_empleados.DirectorioEmpleados(ttl=3600)
+
+    async def tres_a_la_vez():
+        return await asyncio.gather(*[directorio.nombres_para() for _ in range(3)])
+
+    resultados = asyncio.run(tres_a_la_vez())
+
+    assert all(r == {"e0": "Empleado 0", "e1": "Empleado 1", "e2": "Empleado 2"} for r in resultados)
+    assert len(falso.pedidos) == 2
+
+
+# -------------------------
+# RECIBOS POR VENTANAS
+# -------------------------
+class ReceiptsFalso:
+    """
+    /receipts como Loyverse: del más nuevo al más viejo, de a 250 con cursor.
+    Repite el último recibo de cada página al principio de la siguiente
+    (como cuando un recibo cambia mientras se pagina).
+    """
+
+    def __init__(self, receipts: list, falla_en: str | None = None):
+        self.receipts = sorted(receipts, key=lambda r: r["created_at"], reverse=True)
+        self.falla_en = falla_en
+        self.ventanas = set()
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(0.001)
+        desde = request.url.params["created_at_min"]
+        hasta = request.url.params["created_at_max"]
+        self.ventanas.add((desde, hasta))
+        if self.falla_en and desde.startswith(self.falla_en):
+            return httpx.Response(500, text="error")
+        en_rango = [r for r in self.receipts if desde <= r["created_at"] <= hasta]
+        inicio = int(request.url.params.get("cursor", 0))
+        pagina = en_rango[max(0, inicio - 1) if inicio else 0:inicio + 250]
+        fin = inicio + 250
+        return httpx.Response(200, json={
+            "receipts": pagina,
+            "cursor": str(fin) if fin < len(en_rango) else None,
+        })
+
+
+def _receipts(dias: int, por_dia: int) -> list:
+    inicio = datetime(2026, 1, 1)
+    return [
+        {
+            "receipt_number": f"{d}-{n}",
+            "created_at": (inicio + timedelta(days=d, minutes=7 * n)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        }
+        for d in range(dias)
+        for n in range(por_dia)
+    ]
+
+
+@pytest.fixture
+def receipts_falso(monkeypatch):
+    def crear(receipts, **kwargs):
+        falso = ReceiptsFalso(receipts, **kwargs)
+        cliente = httpx.AsyncClient(transport=httpx.MockTransport(falso))
+        monkeypatch.setattr(loyverse, "get_client", lambda: cliente)
+        monkeypatch.setattr(loyverse, "LOYVERSE_RECEIPTS_VENTANA_DIAS", 7)
+        return falso
+    return crear
+
+
+def test_ventanas_cubren_el_rango_sin_solaparse():
+    d = date(2026, 1, 1)
+    assert loyverse._ventanas(d, d, 7) == [(d, d)]
+    assert loyverse._ventanas(d, d - timedelta(days=1), 7) == []
+
+    ventanas = loyverse._ventanas(d, date(2026, 2, 15), 7)
+    assert ventanas[0][0] == d and ventanas[-1][1] == date(2026, 2, 15)
+    for (_, fin), (inicio, _) in zip(ventanas, ventanas[1:]):
+        assert inicio == fin + timedelta(days=1)
+    # 46 días: seis ventanas de 7 y una de 4
+    assert [(fin - inicio).days + 1 for inicio, fin in ventanas] == [7] * 6 + [4]
+
+
+def test_paginas_del_rango_sin_repetidos(receipts_falso):
+    receipts = _receipts(dias=31, por_dia=60)   # ~420 por ventana: dos páginas cada una
+    falso = receipts_falso(receipts)
+
+    async def todas():
+        return [pagina async for pagina in loyverse.iterar_paginas_receipts(date(2026, 1, 3), date(2026, 1, 28))]
+
+    paginas = asyncio.run(todas())
+
+    numeros = [r["receipt_number"] for pagina in paginas for r in pagina]
+    esperados = {r["receipt_number"] for r in receipts if "2026-01-03" <= r["created_at"][:10] <= "2026-01-28"}
+    assert len(numeros) == len(set(numeros))
+    assert set(numeros) == esperados
+    assert len(falso.ventanas) == 4
+    # Dentro de cada página, del más nuevo al más viejo
+    for pagina in paginas:
+        fechas = [r["created_at"] for r in pagina]
+        assert fechas == sorted(fechas, reverse=True)
+
+
+def test_receipts_between_ordenado_del_mas_nuevo_al_mas_viejo(receipts_falso):
+    receipts = _receipts(dias=20, por_dia=45)
+    receipts_falso(receipts)
+
+    resultado = asyncio.run(loyverse.get_receipts_between(date(2026, 1, 1), date(2026, 1, 20)))
+
+    esperado = sorted(receipts, key=lambda r: r["created_at"], reverse=True)
+    assert [r["receipt_number"] for r in resultado] == [r["receipt_number"] for r in esperado]
+
+
+def test_error_de_una_ventana_corta_el_rango(receipts_falso):
+    receipts_falso(_receipts(dias=20, por_dia=10), falla_en="2026-01-08")
+
+    async def todas():
+        return [pagina async for pagina in loyverse.iterar_paginas_receipts(date(2026, 1, 1), date(2026, 1, 20))]
+
+    paginas = asyncio.run(todas())
+
+    assert isinstance(paginas[-1], dict) and paginas[-1]["status"] == 500
+    assert all(isinstance(p, list) for p in paginas[:-1])
+    error = asyncio.run(loyverse.get_receipts_between(date(2026, 1, 1), date(2026, 1, 20)))
+    assert error["status"] == 500
@@ -0,0 +1,138 @@
+# Descarga de clientes contra un Loyverse falso que aplica rate limit:
+# como mucho LIMITE pedidos por VENTANA_SEG; el excedente recibe 429 con
+# Retry-After.
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+
+import loyverse
+import loyverse_clientes as lc
+
+LIMITE = 10
+VENTANA_SEG = 0.2
+
+
+class LoyverseConRateLimit:
+    def __init__(self, no_encontrados=()):
+        self.no_encontrados = set(no_encontrados)
+        self.aceptados = []   # time.monotonic() de cada pedido atendido
+        self.pedidos = 0
+        self.rechazados = 0
+        self.en_curso = 0
+        self.max_en_curso = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.pedidos += 1
+        ahora = time.monotonic()
+        recientes = [t for t in self.aceptados if ahora - t < VENTANA_SEG]
+        if len(recientes) >= LIMITE:
+            self.rechazados += 1
+            espera = VENTANA_SEG - (ahora - recientes[0])
+            return httpx.Response(429, headers={"Retry-After": f"{espera:.3f}"})
+        self.aceptados.append(ahora)
+
+        self.en_curso += 1
+        self.max_en_curso = max(self.max_en_curso, self.en_curso)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.en_curso -= 1
+
+        customer_id = request.url.path.rsplit("/", 1)[-1]
+        if customer_id in self.no_encontrados:
+            return httpx.Response(404)
+        return httpx.Response(200, json={"id": customer_id, "name": f"Cliente {customer_id}"})
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = LoyverseConRateLimit(no_encontrados={"borrado"})
+    cliente = httpx.AsyncClient(transport=httpx.MockTransport(stub))
+    monkeypatch.setattr(lc, "get_client", lambda: cliente)
+    # Estado global del módulo limpio para cada test (y atado a su event loop)
+    monkeypatch.setattr(lc, "_SEMAFORO", asyncio.Semaphore(lc.LOYVERSE_CLIENTES_CONCURRENCIA))
+    monkeypatch.setattr(lc, "_PAUSA_HASTA", 0.0)
+    monkeypatch.setattr(lc, "CACHE_CLIENTES", lc.CacheClientes(3600, 5000))
+    monkeypatch.setattr(lc, "backoff", lambda intento: 0.01)
+    return stub
+
+
+def test_respeta_rate_limit_y_trae_todos(stub):
+    ids = [f"c{i}" for i in range(60)]
+
+    clientes = asyncio.run(lc.get_customers(ids))
+
+    assert sorted(clientes) == sorted(ids)
+    assert all(clientes[cid]["id"] == cid for cid in ids)
+    assert stub.max_en_curso <= lc.LOYVERSE_CLIENTES_CONCURRENCIA
+
+    metricas = lc.ultimas_metricas()
+    assert metricas["ok"] == 60
+    assert metricas["fallidos"] == 0
+    assert metricas["rate_limited"] == stub.rechazados > 0
+    # Después de un 429 se frena a todos: los rechazos no crecen con los ids
+    assert stub.rechazados < len(ids)
+
+
+def test_404_no_es_fallo(stub):
+    clientes = asyncio.run(lc.get_customers(["c1", "borrado"]))
+
+    assert list(clientes) == ["c1"]
+    metricas = lc.ultimas_metricas()
+    assert metricas["no_encontrados"] == 1
+    assert metricas["fallidos"] == 0
+
+
+def test_ids_repetidos_y_cacheados_no_se_piden_de_nuevo(stub):
+    async def dos_lotes():
+        await asyncio.gather(
+            lc.get_customers(["c1", "c2"]),
+            lc.get_customers(["c2", "c3"]),
+        )
+        return await lc.get_customers(["c1", "c2", "c3"])
+
+    clientes = asyncio.run(dos_lotes())
+
+    assert sorted(clientes) == ["c1", "c2", "c3"]
+    assert stub.pedidos == 3
+
+
+def test_tabla_solo_se_guarda_si_cambio_algo(monkeypatch, tmp_path):
+    clientes = [
+        {"id": "c1", "name": "Uno", "updated_at": "2026-03-01T10:00:00.000Z"},
+        {"id": "c2", "name": "Dos", "updated_at": "2026-03-02T10:00:00.000Z"},
+    ]
+
+    def listado(request: httpx.Request) -> httpx.Response:
+        # Como Loyverse: updated_at_min es inclusivo
+        desde = request.url.params.get("updated_at_min", "")
+        return httpx.Response(200, json={
+            "customers": [c for c in clientes if c["updated_at"] >= desde],
+            "cursor": None,
+        })
+
+    cliente = httpx.AsyncClient(transport=httpx.MockTransport(listado))
+    monkeypatch.setattr(loyverse, "get_client", lambda: cliente)
+
+    tabla = lc.TablaClientes(str(tmp_path / "clientes.json"))
+    escrituras = []
+    escribir = tabla._escribir
+    monkeypatch.setattr(tabla, "_escribir", lambda *a: escrituras.append(threading.get_ident()) or escribir(*a))
+
+    async def tres_syncs():
+        cambios = [await tabla.sincronizar(), await tabla.sincronizar()]
+        clientes.append({"id": "c3", "name": "Tres", "updated_at": "2026-03-03T10:00:00.000Z"})
+        cambios.append(await tabla.sincronizar())
+        return cambios
+
+    assert asyncio.run(tres_syncs()) == [2, 0, 1]
+    assert len(escrituras) == 2
+    # Fuera del event loop
+    assert threading.get_ident() not in escrituras
+
+    recargada = lc.TablaClientes(str(tmp_path / "clientes.json"))
+    recargada._cargar()
+    assert sorted(recargada.clientes) == ["c1", "c2", "c3"]
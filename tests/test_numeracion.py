@@ -0,0 +1,124 @@
+# Numeración local de comprobantes contra un WSFE falso: pedidos en paralelo
+# a /api/facturar (y /api/facturar/lote) no repiten ni saltean números, y
+# FECompUltimoAutorizado se consulta una sola vez por tipo.
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import afip
+import facturar_api
+from wsfe_falso import WSFEFalso
+
+TIPO_FACTURA_C = 11
+
+
+@pytest.fixture
+def wsfe(monkeypatch):
+    wsfe = WSFEFalso(latencia=0.005)
+    monkeypatch.setenv("AFIP_CUIT", "20111111112")
+    monkeypatch.setenv("AFIP_PTO_VTA", "1")
+    monkeypatch.setattr(afip, "get_wsfe_client", lambda: wsfe)
+    monkeypatch.setattr(afip, "obtener_auth_wsaa", lambda: ("token", "sign"))
+    monkeypatch.setattr(afip, "NUMERADOR", afip.NumeradorComprobantes())
+
+    registradas = {}
+
+    def registrar(req, result):
+        registradas[req.receipt_id] = result["cbte_nro"]
+        return {"drive_url": None, "cbte_nro": result["cbte_nro"]}, None
+
+    monkeypatch.setattr(facturar_api, "esta_facturada", lambda receipt_id: receipt_id in registradas)
+    monkeypatch.setattr(facturar_api, "_registrar_factura", registrar)
+    monkeypatch.setattr(facturar_api, "open", lambda *a, **k: open(os.devnull, "rb"), raising=False)
+    wsfe.registradas = registradas
+    return wsfe
+
+
+def _pedido(receipt_id: str, dni: str | None = None) -> facturar_api.FacturaRequest:
+    return facturar_api.FacturaRequest(
+        receipt_id=receipt_id,
+        cliente={"name": "Cliente", "dni": dni} if dni else None,
+        items=[{"nombre": "Café", "cantidad": 1, "precio_unitario": 1500}],
+        total=1500,
+    )
+
+
+def _factura_afip(dni: str | None = None) -> dict:
+    """Entrada de wsfe_facturar_lote, como la arma /api/facturar/lote."""
+    req = _pedido("x", dni)
+    return {"cliente": facturar_api._cliente_afip(req), "items": facturar_api._items_afip(req), "total": req.total}
+
+
+def test_facturar_en_paralelo_sin_numeros_repetidos(wsfe):
+    wsfe.ultimos[(1, TIPO_FACTURA_C)] = 41
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        respuestas = list(pool.map(facturar_api.facturar, [_pedido(f"v{i}") for i in range(60)]))
+
+    numeros = sorted(r["cbte_nro"] for r in respuestas)
+    assert numeros == list(range(42, 102))
+    assert sorted(n for *_, n, _ in wsfe.autorizados) == numeros
+    # Semilla una sola vez; ningún rechazo por secuencia
+    assert [p for p in wsfe.pedidos if p[0] == "FECompUltimoAutorizado"] == [("FECompUltimoAutorizado", 0)]
+    assert sum(1 for p in wsfe.pedidos if p[0] == "FECAESolicitar") == 60
+
+
+def test_facturar_y_lote_en_paralelo_comparten_la_numeracion(wsfe):
+    pedidos = [_pedido(f"v{i}") for i in range(20)]
+    lotes = [[_pedido(f"l{j}-{i}") for i in range(5)] for j in range(4)]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        sueltas = [pool.submit(facturar_api.facturar, p) for p in pedidos]
+        en_lote = [pool.submit(facturar_api.facturar_lote, lote) for lote in lotes]
+        sueltas = [f.result() for f in sueltas]
+        en_lote = [f.result() for f in en_lote]
+
+    assert all(r["facturadas"] == 5 for r in en_lote)
+    numeros = sorted(wsfe.registradas.values())
+    assert numeros == list(range(1, 41))
+
+
+def test_numero_desincronizado_se_resincroniza_una_vez(wsfe):
+    facturar_api.facturar(_pedido("v1"))
+    # Otro sistema autorizó comprobantes por fuera de esta instancia
+    wsfe.ultimos[(1, TIPO_FACTURA_C)] += 3
+
+    respuesta = facturar_api.facturar(_pedido("v2"))
+
+    assert respuesta["cbte_nro"] == 5
+    assert [p[0] for p in wsfe.pedidos].count("FECompUltimoAutorizado") == 2
+
+
+def test_lote_con_una_factura_rechazada_sigue_con_las_demas(wsfe, monkeypatch):
+    monkeypatch.setenv("AFIP_MAX_REG_X_REQ", "4")
+    wsfe.rechazar_doc = {30000002, 30000009}
+    facturas = [_factura_afip(str(30000000 + i)) for i in range(10)]
+
+    resultados = afip.wsfe_facturar_lote(TIPO_FACTURA_C, facturas)
+
+    rechazadas = [i for i, r in enumerate(resultados) if "error" in r]
+    assert rechazadas == [2, 9]
+    assert "DocNro invalido" in resultados[2]["error"]
+    # Las demás, autorizadas en orden y sin huecos
+    numeros = [r["cbte_nro"] for r in resultados if "cbte_nro" in r]
+    assert numeros == list(range(1, 9))
+    assert [doc for *_, doc in wsfe.autorizados] == [
+        30000000 + i for i in range(10) if i not in (2, 9)
+    ]
+    assert [p[0] for p in wsfe.pedidos].count("FECompUltimoAutorizado") == 1
+
+
+def test_lote_fuera_de_secuencia_no_reintenta_de_a_una(wsfe, monkeypatch):
+    monkeypatch.setenv("AFIP_MAX_REG_X_REQ", "4")
+    facturar_api.facturar(_pedido("v1"))
+    wsfe.ultimos[(1, TIPO_FACTURA_C)] += 3
+    # La resincronización no alcanza: AFIP sigue rechazando el número
+    monkeypatch.setattr(afip.ReservaNumeracion, "resincronizar", lambda self: None)
+    facturas = [_factura_afip() for _ in range(10)]
+
+    resultados = afip.wsfe_facturar_lote(TIPO_FACTURA_C, facturas)
+
+    assert all("error" in r for r in resultados)
+    assert "No enviada" in resultados[-1]["error"]
+    assert sum(1 for p in wsfe.pedidos if p[0] == "FECAESolicitar") == 1 + 2
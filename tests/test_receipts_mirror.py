@@ -0,0 +1,92 @@
+# Espejo de recibos: los requests leen del espejo sólo si la sincronización
+# en segundo plano ya terminó y está al día; nunca sincronizan ellos. Los
+# rollups diarios guardan sólo agregados y se recalculan al facturar.
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+import admin_metricas
+import loyverse
+import receipts_mirror
+
+
+@pytest.fixture
+def espejo(monkeypatch, tmp_path):
+    # Días anteriores a hoy: sus rollups quedan guardados
+    ahora = datetime.now(timezone.utc) - timedelta(days=1)
+    receipts = [
+        {
+            "receipt_number": f"1-{n}",
+            "created_at": (ahora - timedelta(hours=n)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "updated_at": (ahora - timedelta(hours=n)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "receipt_type": "SALE",
+            "total_money": 1000,
+        }
+        for n in range(5)
+    ]
+    pedidos = []
+
+    def listado(request: httpx.Request) -> httpx.Response:
+        pedidos.append(request)
+        return httpx.Response(200, json={"receipts": receipts, "cursor": None})
+
+    cliente = httpx.AsyncClient(transport=httpx.MockTransport(listado))
+    monkeypatch.setattr(loyverse, "get_client", lambda: cliente)
+    monkeypatch.setattr(receipts_mirror, "LOYVERSE_RECEIPTS_MODO", "espejo")
+    monkeypatch.setattr(receipts_mirror, "RECEIPTS_DB_PATH", str(tmp_path / "receipts.sqlite3"))
+    monkeypatch.setattr(receipts_mirror, "_CONN", None)
+    monkeypatch.setattr(receipts_mirror, "_SYNC_LOCK", None)
+    yield pedidos
+    if receipts_mirror._CONN is not None:
+        receipts_mirror._CONN.close()
+
+
+def _rango():
+    hoy = datetime.now(timezone.utc).date()
+    return hoy - timedelta(days=2), hoy
+
+
+def test_sin_sincronizar_va_directo_sin_sincronizar_en_el_request(espejo):
+    assert asyncio.run(receipts_mirror.leer_espejo(*_rango())) is None
+    assert asyncio.run(receipts_mirror.leer_rollups(*_rango())) is None
+    assert espejo == []
+
+
+def test_despues_de_la_sync_lee_del_espejo(espejo):
+    async def sync_y_leer():
+        await receipts_mirror.sincronizar()
+        return await receipts_mirror.leer_espejo(*_rango())
+
+    receipts, ultima_sync = asyncio.run(sync_y_leer())
+
+    assert [r["receipt_number"] for r in receipts] == [f"1-{n}" for n in range(5)]
+    assert ultima_sync is not None
+    assert len(espejo) == 1
+
+
+def test_espejo_atrasado_va_directo(espejo, monkeypatch):
+    asyncio.run(receipts_mirror.sincronizar())
+    viejo = (datetime.now(timezone.utc) - timedelta(seconds=receipts_mirror.MAX_EDAD_SEG + 5))
+    receipts_mirror._guardar([], {"ultima_sync": receipts_mirror._iso(viejo)})
+
+    assert asyncio.run(receipts_mirror.leer_espejo(*_rango())) is None
+    assert len(espejo) == 1
+
+
+def test_facturar_recalcula_el_rollup_del_dia(espejo, monkeypatch):
+    facturas = {}
+    monkeypatch.setattr(admin_metricas, "obtener_facturas_bulk",
+                        lambda ids: {i: facturas[i] for i in ids if i in facturas})
+    asyncio.run(receipts_mirror.sincronizar())
+
+    facturas["1-2"] = {"total": 900}
+    receipts_mirror.marcar_facturada("1-2")
+    rollups, _ = asyncio.run(receipts_mirror.leer_rollups(*_rango()))
+    agg = admin_metricas.combinar_rollups(rollups)
+
+    assert (agg["facturadas"], agg["monto_facturado"]) == (1, 900)
+    assert (agg["no_facturadas"], agg["monto_no_facturado"]) == (4, 4000)
+    # Sólo agregados: nada por recibo
+    assert "1-2" not in str(receipts_mirror._leer_rollups("0000-00-00", "9999-99-99"))
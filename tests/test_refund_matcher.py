@@ -0,0 +1,218 @@
+# refund_matcher contra el cruce anterior (los loops anidados de
+# loyverse_api._matchear_reembolsos, copiados abajo tal como estaban).
+#
+# El resultado tiene que ser idéntico salvo en un caso: antes un mismo ítem
+# reembolsado podía descontarse de varias ventas (se cobraba dos veces); ahora
+# la cantidad reembolsada se consume.
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from refund_matcher import estado_reembolso, matchear_reembolsos, parse_fecha
+
+
+def _matchear_anterior(sales: list, refunds: list):
+    """
+    Algoritmo anterior. Además devuelve si algún ítem reembolsado se imputó
+    por más de su cantidad (el caso que cambia).
+    """
+    refunds_by_product = defaultdict(list)
+    for refund in refunds:
+        for item in refund.get("items", []):
+            refunds_by_product[item["nombre"]].append(refund)
+
+    refund_to_sale = {}
+    estados = []
+    imputado = defaultdict(float)  # (refund receipt_id, índice del ítem) → cantidad
+
+    for sale in sales:
+        sale_date = parse_fecha(sale["fecha"])
+        total_refund = 0
+        refunded_items = []
+        remaining_items = []
+
+        for item in sale.get("items", []):
+            qty_left = item["cantidad"]
+            unit_price = item["precio_unitario"]
+            posibles = refunds_by_product.get(item["nombre"], [])
+
+            for ref in posibles:
+                ref_date = parse_fecha(ref["fecha"])
+                if ref_date <= sale_date:
+                    continue
+
+                for i, ref_item in enumerate(ref.get("items", [])):
+                    if ref_item["nombre"] != item["nombre"]:
+                        continue
+
+                    ref_qty = min(qty_left, ref_item["cantidad"])
+                    if ref_qty <= 0:
+                        continue
+
+                    importe = ref_qty * unit_price
+                    total_refund += importe
+                    qty_left -= ref_qty
+                    imputado[(ref["receipt_id"], i)] += ref_qty
+
+                    refunded_items.append({
+                        "nombre": item["nombre"],
+                        "cantidad": ref_qty,
+                        "importe": importe,
+                        "refund_receipt_id": ref["receipt_id"],
+                    })
+
+                    refund_to_sale[ref["receipt_id"]] = sale["receipt_id"]
+
+            if qty_left > 0:
+                remaining_items.append({
+                    "nombre": item["nombre"],
+                    "cantidad": qty_left,
+                    "precio_unitario": unit_price,
+                })
+
+        estados.append(estado_reembolso(sale, total_refund, refunded_items, remaining_items))
+
+    for ref in refunds:
+        if ref["receipt_id"] in refund_to_sale:
+            continue
+
+        ref_date = parse_fecha(ref["fecha"])
+        ref_cliente = ref.get("cliente_id")
+        ref_total = ref.get("total", 0)
+
+        for sale in sales:
+            sale_date = parse_fecha(sale["fecha"])
+            if sale_date >= ref_date:
+                continue
+            if ref_cliente and sale.get("cliente_id") != ref_cliente:
+                continue
+            if sale.get("total", 0) < ref_total:
+                continue
+            refund_to_sale[ref["receipt_id"]] = sale["receipt_id"]
+            break
+
+    cantidades = {
+        (ref["receipt_id"], i): item["cantidad"]
+        for ref in refunds
+        for i, item in enumerate(ref.get("items", []))
+    }
+    doble_imputacion = any(usado > cantidades[clave] for clave, usado in imputado.items())
+    return estados, refund_to_sale, doble_imputacion
+
+
+# -------------------------
+# DATOS
+# -------------------------
+INICIO = datetime(2026, 3, 1, tzinfo=timezone.utc)
+PRODUCTOS = {"Café": 1500.0, "Medialuna": 700.0, "Tostado": 3200.0, "Jugo": 2100.0}
+
+
+def _fecha(minutos: int) -> str:
+    return (INICIO + timedelta(minutes=minutos)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _recibo(prefijo: str, n: int, minutos: int, cliente, items: list) -> dict:
+    return {
+        "receipt_id": f"{prefijo}{n}",
+        "fecha": _fecha(minutos),
+        "cliente_id": cliente,
+        "total": round(sum(it["cantidad"] * it["precio_unitario"] for it in items), 2),
+        "items": items,
+    }
+
+
+def _items(rng: random.Random, max_items: int) -> list:
+    nombres = rng.sample(sorted(PRODUCTOS), rng.randint(1, max_items))
+    return [
+        {"nombre": nombre, "cantidad": rng.randint(0, 3), "precio_unitario": PRODUCTOS[nombre]}
+        for nombre in nombres
+    ]
+
+
+def _caso(rng: random.Random):
+    """Ventas y reembolsos de más nuevo a más viejo, como los entrega Loyverse."""
+    clientes = [None, "c1", "c2", "c3"]
+    # Minutos en un rango chico: hay fechas repetidas entre ventas y reembolsos
+    sales = [
+        _recibo("S", n, rng.randint(0, 60), rng.choice(clientes), _items(rng, 3))
+        for n in range(rng.randint(0, 12))
+    ]
+    refunds = [
+        _recibo("R", n, rng.randint(0, 60), rng.choice(clientes), _items(rng, 2))
+        for n in range(rng.randint(0, 6))
+    ]
+    for recibos in (sales, refunds):
+        recibos.sort(key=lambda r: r["fecha"], reverse=True)
+    return sales, refunds
+
+
+def _imputado_por_item(estados: list) -> dict:
+    total = defaultdict(float)
+    for estado in estados:
+        for it in estado["refunded_items"]:
+            total[(it["refund_receipt_id"], it["nombre"])] += it["cantidad"]
+    return total
+
+
+# -------------------------
+# TESTS
+# -------------------------
+def test_igual_al_algoritmo_anterior_sin_doble_imputacion():
+    rng = random.Random(20)
+    comparados = 0
+    for _ in range(3000):
+        sales, refunds = _caso(rng)
+        estados_ant, refund_to_sale_ant, doble = _matchear_anterior(sales, refunds)
+        if doble:
+            continue
+        assert matchear_reembolsos(sales, refunds) == (estados_ant, refund_to_sale_ant)
+        comparados += 1
+    assert comparados > 1000
+
+
+def test_con_doble_imputacion_no_se_cobra_de_mas():
+    rng = random.Random(21)
+    distintos = 0
+    for _ in range(3000):
+        sales, refunds = _caso(rng)
+        estados_ant, _, doble = _matchear_anterior(sales, refunds)
+        if not doble:
+            continue
+        estados, refund_to_sale = matchear_reembolsos(sales, refunds)
+        distintos += estados != estados_ant
+
+        # Cada ítem reembolsado se imputa como mucho por su cantidad
+        cantidades = defaultdict(float)
+        for ref in refunds:
+            for item in ref["items"]:
+                cantidades[(ref["receipt_id"], item["nombre"])] += item["cantidad"]
+        for clave, usado in _imputado_por_item(estados).items():
+            assert usado <= cantidades[clave]
+
+        # Y nunca se descuenta más que antes
+        for estado, anterior in zip(estados, estados_ant):
+            assert estado["refunded_amount"] <= anterior["refunded_amount"]
+        assert set(refund_to_sale.values()) <= {s["receipt_id"] for s in sales}
+    assert distintos > 100
+
+
+def test_un_reembolso_no_se_descuenta_de_dos_ventas():
+    cafe = PRODUCTOS["Café"]
+    sales = [
+        _recibo("S", 2, 20, None, [{"nombre": "Café", "cantidad": 1, "precio_unitario": cafe}]),
+        _recibo("S", 1, 10, None, [{"nombre": "Café", "cantidad": 1, "precio_unitario": cafe}]),
+    ]
+    refunds = [
+        _recibo("R", 1, 30, None, [{"nombre": "Café", "cantidad": 1, "precio_unitario": cafe}]),
+    ]
+
+    estados_ant, _, doble = _matchear_anterior(sales, refunds)
+    assert doble
+    assert [e["refund_status"] for e in estados_ant] == ["TOTAL", "TOTAL"]
+
+    estados, refund_to_sale = matchear_reembolsos(sales, refunds)
+    # Se imputa a la venta más nueva anterior al reembolso; la otra queda facturable
+    assert [e["refund_status"] for e in estados] == ["TOTAL", "NONE"]
+    assert estados[1]["max_facturable"] == cafe
+    assert estados[1]["items_facturables"] == [{"nombre": "Café", "cantidad": 1, "precio_unitario": cafe}]
+    assert refund_to_sale == {"R1": "S2"}
@@ -0,0 +1,92 @@
+# WSFE falso para los tests: numera como AFIP (cada comprobante tiene que ser
+# el siguiente del último autorizado, si no 10016) y responde el mismo XML
+# que leen afip._solicitar_cae / afip._parsear_fecae_lote.
+import re
+import threading
+import time
+
+
+class Respuesta:
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+
+class WSFEFalso:
+    def __init__(self, latencia: float = 0.0, rechazar_doc=()):
+        self.latencia = latencia
+        self.rechazar_doc = set(rechazar_doc)   # DocNro que AFIP rechaza por datos
+        self.ultimos = {}                       # (pto_vta, cbte_tipo) → último autorizado
+        self.autorizados = []                   # (pto_vta, cbte_tipo, cbte_nro, doc_nro)
+        self.pedidos = []                       # (soap_action, CantReg)
+        self.en_curso = 0
+        self.max_en_curso = 0
+        self._lock = threading.Lock()
+
+    def post(self, soap_action: str, soap_body: str) -> Respuesta:
+        with self._lock:
+            self.en_curso += 1
+            self.max_en_curso = max(self.max_en_curso, self.en_curso)
+        try:
+            time.sleep(self.latencia)
+            with self._lock:
+                if soap_action == "FECompUltimoAutorizado":
+                    return self._ultimo(soap_body)
+                return self._solicitar(soap_body)
+        finally:
+            with self._lock:
+                self.en_curso -= 1
+
+    def _clave(self, soap_body: str) -> tuple:
+        pto_vta = int(re.search(r"<ar:PtoVta>(\d+)</ar:PtoVta>", soap_body).group(1))
+        cbte_tipo = int(re.search(r"<ar:CbteTipo>(\d+)</ar:CbteTipo>", soap_body).group(1))
+        return pto_vta, cbte_tipo
+
+    def _ultimo(self, soap_body: str) -> Respuesta:
+        nro = self.ultimos.get(self._clave(soap_body), 0)
+        self.pedidos.append(("FECompUltimoAutorizado", 0))
+        return Respuesta(200, f"<r><CbteNro>{nro}</CbteNro></r>")
+
+    def _solicitar(self, soap_body: str) -> Respuesta:
+        clave = self._clave(soap_body)
+        detalles = re.findall(r"<ar:FECAEDetRequest>(.*?)</ar:FECAEDetRequest>", soap_body, re.S)
+        self.pedidos.append(("FECAESolicitar", len(detalles)))
+
+        xml = ""
+        codigos = set()
+        aprobados = 0
+        for det in detalles:
+            nro = int(re.search(r"<ar:CbteDesde>(\d+)<", det).group(1))
+            doc = int(re.search(r"<ar:DocNro>(\d+)<", det).group(1))
+            if nro != self.ultimos.get(clave, 0) + 1:
+                codigos.add("10016")
+                xml += self._det(nro, "R", obs=("10016", "El numero o fecha del comprobante no se corresponde con el proximo a autorizar"))
+            elif doc in self.rechazar_doc:
+                xml += self._det(nro, "R", obs=("10015", "DocNro invalido"))
+            else:
+                self.ultimos[clave] = nro
+                self.autorizados.append((*clave, nro, doc))
+                aprobados += 1
+                xml += self._det(nro, "A", cae=f"7{nro:013d}")
+
+        if aprobados == len(detalles):
+            resultado = "A"
+        else:
+            resultado = "P" if aprobados else "R"
+        errores = "".join(
+            f"<Err><Code>{c}</Code><Msg>Rechazo</Msg></Err>" for c in sorted(codigos)
+        )
+        return Respuesta(200, (
+            f"<r><FeCabResp><Resultado>{resultado}</Resultado></FeCabResp>"
+            f"<FeDetResp>{xml}</FeDetResp>"
+            f"{'<Errors>' + errores + '</Errors>' if errores else ''}</r>"
+        ))
+
+    @staticmethod
+    def _det(nro: int, resultado: str, cae: str = "", obs: tuple | None = None) -> str:
+        observaciones = f"<Observaciones><Obs><Code>{obs[0]}</Code><Msg>{obs[1]}</Msg></Obs></Observaciones>" if obs else ""
+        return (
+            f"<FECAEDetResponse><CbteDesde>{nro}</CbteDesde><CbteHasta>{nro}</CbteHasta>"
+            f"<Resultado>{resultado}</Resultado><CAE>{cae}</CAE>"
+            f"<CAEFchVto>{'20260131' if cae else ''}</CAEFchVto>{observaciones}</FECAEDetResponse>"
+        )